@@ -0,0 +1,116 @@
+"""
+Adaptive Metropolis proposals that learn the scale and correlation of the
+posterior from the chain, to keep acceptance rates away from 0 and 1.
+"""
+import math
+import numpy as np
+
+
+class AdaptiveMetropolis(object):
+    """
+    Gaussian random walk proposals with covariance learned from the chain
+    history (Haario et al. 2001), scaled by a factor that is adapted by
+    Robbins-Monro steps towards a target acceptance rate (Andrieu and
+    Thoms 2008).  The adaptation diminishes as 1/n for the covariance and
+    as n^-0.6 for the scale, so the chain keeps the right target.
+
+    Until [n0] states have been recorded, proposals use the initial
+    independent sigmas, times the adapted scale.  The scale is then reset
+    for the learned covariance, and with probability [beta] the initial
+    sigmas are used unscaled, so the chain cannot lock into a degenerate
+    covariance (Roberts and Rosenthal 2009).
+
+    With [componentwise], each proposal moves a single parameter, and a
+    separate scale is adapted for each one.
+
+    [sigmas] = initial proposal sd of each parameter, on the scale of the
+        vectors passed to draw() and update()
+    [target] = acceptance rate to adapt towards; defaults to 0.234, or
+        0.44 for component-wise updates (Roberts and Rosenthal 2001)
+    """
+
+    def __init__(self, sigmas, componentwise=False, target=None, n0=100, beta=0.05):
+        self.sigma0 = np.asarray(sigmas, dtype=float)
+        self.dim = len(self.sigma0)
+        self.componentwise = componentwise
+        self.target = target or (0.44 if componentwise else 0.234)
+        self.n0 = n0
+        self.beta = beta
+
+        # log of the factor applied to the proposal sd, per component if componentwise
+        self.log_scale = np.zeros(self.dim) if componentwise else np.zeros(1)
+        self.nsteps = 0
+        self.naccepted = 0
+
+        # running mean and sum of squared deviations of chain states
+        self.n = 0
+        self.mean = np.zeros(self.dim)
+        self.m2 = np.zeros((self.dim, self.dim))
+
+    def covariance(self):
+        """
+        Proposal covariance before scaling: the initial sigmas, or the
+        chain covariance times 2.38^2/d (Gelman et al. 1996) once there
+        are [n0] states, with a small ridge to keep it positive definite.
+        """
+        if self.n < self.n0:
+            return np.diag(self.sigma0**2)
+        d = 1 if self.componentwise else self.dim
+        cov = self.m2 / (self.n - 1) * 2.38**2 / d
+        return cov + 1e-10 * np.diag(self.sigma0**2)
+
+    def scale(self, component=None):
+        if self.componentwise:
+            return math.exp(self.log_scale[component]) if component is not None else np.exp(self.log_scale)
+        return math.exp(self.log_scale[0])
+
+    def draw(self, z, component=None):
+        """
+        :param z: current state
+        :param component: index of the parameter to move if componentwise
+        :return: proposed state
+        """
+        z = np.array(z, dtype=float)
+        if self.n < self.n0:
+            scale = self.scale(component)
+        elif np.random.random() < self.beta:
+            scale = 1.
+        else:
+            cov = self.covariance()
+            if self.componentwise:
+                z[component] += np.random.normal(0., math.sqrt(cov[component, component]) * self.scale(component))
+                return z
+            return np.random.multivariate_normal(z, cov * self.scale()**2)
+
+        if self.componentwise:
+            z[component] += np.random.normal(0., self.sigma0[component] * scale)
+            return z
+        return z + np.random.normal(0., 1., self.dim) * self.sigma0 * scale
+
+    def update(self, z, accepted, component=None):
+        """
+        Adapt after a step.
+        :param z: state of the chain after the step
+        :param accepted: whether the proposal was accepted
+        :param component: parameter moved by the proposal if componentwise
+        """
+        self.nsteps += 1
+        if accepted:
+            self.naccepted += 1
+        gamma = self.nsteps ** -0.6
+        if not self.componentwise:
+            self.log_scale[0] += gamma * (float(accepted) - self.target)
+        elif component is not None:
+            self.log_scale[component] += gamma * (float(accepted) - self.target)
+
+        z = np.asarray(z, dtype=float)
+        self.n += 1
+        delta = z - self.mean
+        self.mean += delta / self.n
+        self.m2 += np.outer(delta, z - self.mean)
+        if self.n == self.n0:
+            # scale so far was relative to the initial sigmas
+            self.log_scale[:] = 0.
+
+    def acceptance_rate(self):
+        return float(self.naccepted) / self.nsteps if self.nsteps else float('nan')
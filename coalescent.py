@@ -0,0 +1,369 @@
+"""
+Structured coalescent simulation of binary dated trees from the births,
+migrations and deme sizes of a demographic model, following
+simulate.binary.dated.tree.fgy in rcolgem, with all replicate trees
+simulated together as NumPy arrays.
+"""
+import numpy as np
+import fgy
+
+
+def _jitter_amount(x, factor):
+    """ Half-width of the uniform noise added by R's jitter(x, factor) """
+    z = x.max() - x.min()
+    if z == 0:
+        z = abs(x.min())
+    if z == 0:
+        z = 1.
+    xx = np.unique(np.round(x, int(3 - np.floor(np.log10(z)))))
+    if len(xx) > 1:
+        d = np.diff(xx).min()
+    else:
+        d = xx[0] / 10. if xx[0] != 0 else z / 10.
+    return factor / 5. * abs(d)
+
+
+def _approx(x, y, xout):
+    """
+    Linear interpolation as R's approx(x, y, xout), which sorts points by
+    x and replaces tied x by the mean of their y.
+    """
+    x, index = np.unique(x, return_inverse=True)
+    y = np.bincount(index, weights=y) / np.bincount(index)
+    return np.interp(xout, x, y, left=np.nan, right=np.nan)
+
+
+def _choose(weights):
+    """
+    Draw one column of each row with probability proportional to weights.
+    :return: tuple (indices, whether the weights of each row were valid)
+    """
+    total = weights.sum(axis=1)
+    ok = np.isfinite(total) & (total > 0) & (weights >= 0).all(axis=1)
+    cumulative = np.cumsum(weights, axis=1)
+    u = np.random.uniform(size=len(weights)) * total
+    indices = (cumulative <= u[:, np.newaxis]).sum(axis=1)
+    return np.minimum(indices, weights.shape[1] - 1), ok
+
+
+def _cmin1(x):
+    # min(1, x) as the C macro in dQAL, which returns x if x is NaN
+    return np.where(1 < x, 1., x)
+
+
+def _cmax0(x):
+    # max(0, x) as the C macro in dQAL, which returns 0 if x is NaN
+    return np.where(0 < x, x, 0.)
+
+
+class StructuredCoalescent(object):
+    """
+    Simulate binary dated trees for samples taken from a demographic model.
+
+    As in rcolgem, node heights are drawn from the expected number of
+    lineages over time, and each coalescent event then picks the pair of
+    lineages from the probabilities of the deme each lineage is in, which
+    are carried along the tree by the lineage state equations (dQAL).
+
+    [solution] = fgy.FGY, or anything with the same times, F, G and Y
+    [sample_times] = time of each sample
+    [sample_states] = array (sample, deme) of deme membership of each sample
+    """
+
+    def __init__(self, solution, sample_times, sample_states):
+        times = np.asarray(solution.times, dtype=float)
+        order = np.argsort(-times, kind='mergesort')  # present to past
+        self.F = np.asarray(solution.F, dtype=float)[order]
+        self.G = np.asarray(solution.G, dtype=float)[order]
+        self.Y = np.asarray(solution.Y, dtype=float)[order]
+        self.resolution = len(times)
+
+        sample_times = np.asarray(sample_times, dtype=float)
+        self.n = len(sample_times)
+        sample_states = np.asarray(sample_states, dtype=float).reshape(self.n, -1)
+        self.m = sample_states.shape[1]
+
+        max_sample_time = sample_times.max()
+        heights = max_sample_time - sample_times
+        ix = np.argsort(heights, kind='mergesort')
+        self.heights = heights[ix]
+        self.states = sample_states[ix]
+        self.unique_heights, self.groups = np.unique(self.heights, return_inverse=True)
+
+        self.span = times.max() - times.min()
+        self.max_height = max_sample_time - times.min()
+        self.hoffset = times.max() - max_sample_time
+        if self.hoffset < 0:
+            raise ValueError('Time axis does not cover the last sample time')
+
+        # forcing of the lineage state equations, clipped at zero
+        h = np.sort(max_sample_time - times)
+        h = h[(h <= self.max_height) & (h >= 0)]
+        index = self.index(h)
+        self.Fc = np.maximum(self.F[index], 0)
+        self.Gc = np.maximum(self.G[index], 0)
+        self.Yc = np.maximum(self.Y[index], 0)
+        self.hres = len(h)
+
+        # states of samples not yet taken, after the first j+1 samples
+        self.not_sampled = self.states.sum(axis=0) - np.cumsum(self.states, axis=0)
+        # sample heights are jittered to break ties when counting samples taken
+        self.jitter = _jitter_amount(self.heights, max(1e-6, self.heights[-1] / 1e6))
+        self.haxis = np.linspace(0, self.max_height, self.resolution)
+
+    def index(self, h):
+        """ Index into F, G and Y of height h, as get.index in rcolgem """
+        position = np.minimum(1 + self.resolution * (h + self.hoffset) / self.span, self.resolution)
+        return np.floor(position).astype(int) - 1
+
+    def not_sampled_yet(self, jittered, h):
+        """
+        :param jittered: array (replicate, sample) of sorted jittered sample heights
+        :param h: height, or array of heights per replicate
+        :return: array (replicate, deme) of states of samples above height h
+        """
+        count = (jittered <= np.reshape(h, (-1, 1))).sum(axis=1)
+        return self.not_sampled[np.maximum(count, 1) - 1]
+
+    def lineages(self, jittered):
+        """
+        Expected number of lineages in each deme on the grid of heights
+        haxis, including samples not taken yet.
+        :return: array (height, replicate, deme)
+        """
+        def derivative(A, h):
+            i = self.index(h)
+            F, G, Y = self.F[i], self.G[i], self.Y[i]
+            A_Y = (A - self.not_sampled_yet(jittered, h)) / Y
+            A_Y[np.isnan(A_Y)] = 0
+            return A_Y.dot(G.T) - (F + G).sum(axis=0) * A_Y + A_Y.dot(F.T) * np.maximum(1 - A_Y, 0)
+
+        A0 = np.tile(self.states.sum(axis=0), (len(jittered), 1))
+        return fgy.rk4(derivative, A0, self.haxis)
+
+    def node_heights(self, lineages):
+        """
+        Draw the heights of the n-1 internal nodes of a tree from the
+        decline of the expected number of lineages.
+        :param lineages: array (height, deme) for one replicate
+        :return: sorted array of node heights, or None if they cannot be drawn
+        """
+        total = lineages.sum(axis=1)
+        valid = ~np.isnan(total)
+        if not valid.any():
+            return None
+        total[~valid] = total[valid].min()
+        total -= total.min()
+        if not total.max() > 0:
+            return None
+        cdf = (total.max() - total) / total.max()
+        heights = np.sort(_approx(cdf, self.haxis, np.random.uniform(size=self.n - 1)))
+        return heights if np.isfinite(heights).all() else None
+
+    def derivative_QA(self, t, Q, A, Atotal):
+        """
+        Lineage state equations (dQAL in rcolgem) for a batch of replicates,
+        without the cumulative hazard, which trees do not depend on.
+        Q[k, z] is the probability that a lineage in deme z at the start of
+        the interval is in deme k.
+        """
+        i = np.minimum((self.hres * t / self.max_height).astype(int), self.hres - 1)
+        F, G, Y = self.Fc[i], self.Gc[i], self.Yc[i]
+        offdiag = 1. - np.eye(self.m)
+        offF = F * offdiag
+        offFG = (F + G) * offdiag
+
+        r = Atotal / A.sum(axis=1)
+        a = np.where(Y > 0, r[:, np.newaxis] * A / Y, 1.)
+        Fa = np.einsum('rkl,rl->rk', F, a)
+        dA = (-a * a * np.diagonal(F, axis1=1, axis2=2) + _cmax0(1 - a) * np.einsum('rkl,rl->rk', offF, a) +
+              np.einsum('rkl,rl->rk', G * offdiag, a) - a * offFG.sum(axis=1))
+
+        P = _cmin1(Q / Y[:, :, np.newaxis])
+        dQ = np.einsum('rkl,rlz->rkz', offFG, P) - (offFG.sum(axis=1) + Fa)[:, :, np.newaxis] * P
+        return dQ, dA
+
+    def solve_Q(self, h0, h1, A0):
+        """
+        One RK4 step of the lineage state equations over each replicate's
+        interval from h0 to h1, as deSolve's rk4 with output at h0 and h1.
+        :return: array (replicate, deme, deme) of |Q| at h1
+        """
+        dt = h1 - h0
+        dtQ, dtA = dt[:, np.newaxis, np.newaxis], dt[:, np.newaxis]
+        Atotal = A0.sum(axis=1)
+        Q0 = np.tile(np.eye(self.m), (len(h0), 1, 1))
+        k1 = self.derivative_QA(h0, Q0, A0, Atotal)
+        k2 = self.derivative_QA(h0 + 0.5*dt, Q0 + 0.5*dtQ*k1[0], A0 + 0.5*dtA*k1[1], Atotal)
+        k3 = self.derivative_QA(h0 + 0.5*dt, Q0 + 0.5*dtQ*k2[0], A0 + 0.5*dtA*k2[1], Atotal)
+        k4 = self.derivative_QA(h1, Q0 + dtQ*k3[0], A0 + dtA*k3[1], Atotal)
+        return np.abs(Q0 + dtQ/6. * (k1[0] + 2.*k2[0] + 2.*k3[0] + k4[0]))
+
+    def simulate(self, nreps=1):
+        """
+        :return: list of (edge, edge_length) arrays of each tree, in ape's
+                 numbering as for CompactTree.from_edges; trees that fail
+                 to coalesce are left out, as in rcolgem
+        """
+        with np.errstate(all='ignore'):
+            return self._simulate(nreps)
+
+    def _simulate(self, nreps):
+        n, m = self.n, self.m
+        jittered = np.sort(self.heights + np.random.uniform(-self.jitter, self.jitter, (nreps, n)), axis=1)
+        lineages = self.lineages(jittered)
+
+        # events of each replicate: sample heights first on ties, then node heights
+        events, is_sample, keep = [], [], []
+        for rep in range(nreps):
+            nodes = self.node_heights(lineages[:, rep])
+            if nodes is None:
+                continue
+            heights = np.concatenate((self.unique_heights, nodes))
+            order = np.argsort(heights, kind='mergesort')
+            events.append(heights[order])
+            is_sample.append(order < len(self.unique_heights))
+            keep.append(rep)
+        if not keep:
+            return []
+        events, is_sample = np.array(events), np.array(is_sample)
+        group = np.where(is_sample, np.searchsorted(self.unique_heights, events), -1)
+        jittered, lineages = jittered[keep], lineages[:, keep]
+        nreps = len(keep)
+        reps = np.arange(nreps)
+
+        # lineages 0..n-1 are samples in order of height, n.. are internal nodes
+        mstates = np.zeros((nreps, 2*n - 1, m))
+        mstates[:, :n] = self.states
+        extant = np.zeros((nreps, 2*n - 1), dtype=bool)
+        extant[:, :n] = self.groups == 0
+        node_height = np.zeros((nreps, 2*n - 1))
+        node_height[:, :n] = self.heights
+        children = np.zeros((nreps, n - 1, 2), dtype=int)
+        ncoalesced = np.zeros(nreps, dtype=int)
+        alive = np.ones(nreps, dtype=bool)
+
+        for ih in range(events.shape[1] - 1):
+            h0, h1 = events[:, ih], events[:, ih+1]
+            nextant = extant.sum(axis=1)
+
+            # carry lineage states over the interval
+            A_index = np.minimum(np.floor(self.resolution * h0 / self.max_height).astype(int), self.resolution - 1)
+            A0 = lineages[A_index, reps] - self.not_sampled_yet(jittered, h0)
+            Q = self.solve_Q(h0, h1, A0)
+            Q[np.isnan(Q).any(axis=(1, 2))] = np.eye(m)
+            updated = np.einsum('rjz,rkz->rjk', mstates, Q)
+            updated /= np.abs(updated).sum(axis=2)[:, :, np.newaxis]
+            mstates = np.where(extant[:, :, np.newaxis], updated, mstates)
+            A = (mstates * extant[:, :, np.newaxis]).sum(axis=1)
+
+            sampled = is_sample[:, ih+1]
+            extant[:, :n] |= (self.groups == group[:, ih+1][:, np.newaxis]) & sampled[:, np.newaxis]
+
+            c = np.flatnonzero(~sampled & alive)
+            if len(c) == 0:
+                continue
+            i = self.index(h1[c])
+            F, Y = self.F[i], self.Y[i]
+            alive[c[(nextant[c] < 2) | (Y == 0).any(axis=1)]] = False
+
+            # transmission from deme k to deme l, then source u and recipient v
+            a = A[c] / Y
+            kl, ok = _choose((a[:, :, np.newaxis] * a[:, np.newaxis, :] * F).reshape(len(c), m*m))
+            k, l = kl // m, kl % m
+            probstates = mstates[c] * extant[c][:, :, np.newaxis]
+            u, ok_u = _choose(probstates[np.arange(len(c)), :, k])
+            probstates[np.arange(len(c)), u] = 0
+            v, ok_v = _choose(probstates[np.arange(len(c)), :, l])
+            alive[c[~(ok & ok_u & ok_v)]] = False
+
+            a_u = np.minimum(1, mstates[c, u] / Y)
+            a_v = np.minimum(1, mstates[c, v] / Y)
+            uv = a_u[:, :, np.newaxis] * a_v[:, np.newaxis, :] * F
+            vu = a_v[:, :, np.newaxis] * a_u[:, np.newaxis, :] * F
+            palpha = (uv + vu).sum(axis=2) / (uv + vu).sum(axis=(1, 2))[:, np.newaxis]
+
+            alpha = n + np.minimum(ncoalesced[c], n - 2)
+            mstates[c, alpha] = palpha
+            extant[c, alpha] = True
+            extant[c, u] = False
+            extant[c, v] = False
+            node_height[c, alpha] = h1[c]
+            children[c, alpha - n] = np.column_stack((np.minimum(u, v), np.maximum(u, v)))
+            ncoalesced[c] += 1
+
+        alive &= ncoalesced == n - 1
+
+        # ape numbering: tips 1..n, root n+1, then internal nodes towards the tips
+        ape_id = np.concatenate((np.arange(1, n + 1), np.arange(2*n - 1, n, -1)))
+        parents = np.repeat(np.arange(n, 2*n - 1), 2)
+        trees = []
+        for rep in np.flatnonzero(alive):
+            kids = children[rep].ravel()
+            edge = np.column_stack((ape_id[parents], ape_id[kids]))
+            edge_length = node_height[rep, parents] - node_height[rep, kids]
+            trees.append((edge, edge_length))
+        return trees
+
+
+def sample_states(Y, ntips, sample=False):
+    """
+    Deme membership of tips, as finish.setup in rcolgem.py: all in the
+    first deme, or drawn without replacement from the rounded deme sizes.
+    :param Y: deme sizes at the last sample
+    :return: array (tip, deme), or None if there are too few infected
+    """
+    m = len(Y)
+    states = np.zeros((ntips, m))
+    if not sample:
+        states[:, 0] = 1
+        return states
+
+    counts = np.round(Y).astype(int)
+    if counts.sum() < ntips or (counts < 0).any():
+        return None
+    drawn = []
+    remaining, pool = ntips, counts.sum()
+    for count in counts:
+        pool -= count
+        k = np.random.hypergeometric(count, pool, remaining) if remaining > 0 and count > 0 and pool > 0 \
+            else min(count, remaining)
+        drawn.append(k)
+        remaining -= k
+    labels = np.repeat(np.arange(m), drawn)
+    np.random.shuffle(labels)
+    states[np.arange(ntips), labels] = 1
+    return states
+
+
+class Simulator(object):
+    """
+    Python replacement of the simulate_*_trees functions of Rcolgem, to be
+    passed to Kamphir as simfunc.
+
+    [model] = 'SI', 'SI2', 'DiffRisk' or 'Stages'
+    """
+
+    def __init__(self, model, t0=0., fgy_resolution=500, integration_method='rk4'):
+        self.model = model
+        self.t0 = t0
+        self.fgy_resolution = int(fgy_resolution)
+        self.integration_method = integration_method
+
+    def simulate_trees(self, params, tree_height, tip_heights, nreps=1):
+        """
+        :return: list of (edge, edge_length) arrays, see StructuredCoalescent.simulate();
+                 empty if the model cannot produce this many tips
+        """
+        with np.errstate(all='ignore'):
+            solution = fgy.solve(self.model, params, tree_height, tip_heights, self.t0,
+                                 self.fgy_resolution, self.integration_method)
+        ntips = len(tip_heights)
+        if not solution.feasible(ntips):
+            return []
+
+        states = sample_states(solution.Y[0], ntips, fgy.MODELS[self.model].sample_states)
+        if states is None:
+            return []
+        sample_times = [float(tree_height) - float(h) for h in tip_heights]
+        return StructuredCoalescent(solution, sample_times, states).simulate(nreps)
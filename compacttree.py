@@ -0,0 +1,333 @@
+"""
+Compact array representation of binary trees for the tree shape kernel.
+"""
+import numpy as np
+
+
+class CompactTree(object):
+    """
+    Binary tree stored as parallel NumPy arrays over its internal nodes.
+    Nodes are numbered in postorder (children before parents), matching
+    Phylo.BaseTree.get_nonterminals(order='postorder'), so the root is last.
+
+    [left], [right] = index of left/right child among internal nodes,
+        or -1 if that child is a tip
+    [left_bl], [right_bl] = branch lengths of left/right child
+    [production] = 1 + number of tip children (0 is reserved for tips)
+    [left_production], [right_production] = production of each child
+    [sqbl] = sum of squared child branch lengths
+    """
+
+    def __init__(self, left, right, left_bl, right_bl):
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.left_bl = np.asarray(left_bl, dtype=np.float64)
+        self.right_bl = np.asarray(right_bl, dtype=np.float64)
+        self._levels = None
+        self._buckets = None
+        self._ranks = None
+        self._level_groups = None
+        self.annotate()
+
+    @classmethod
+    def from_phylo(cls, tree, ladderize=False, normalize='none'):
+        """
+        Convert a Bio.Phylo tree into a CompactTree in a single iterative
+        traversal, so that very deep (caterpillar-like) trees do not hit the
+        recursion limit of Bio.Phylo's own traversals.  The Phylo tree is
+        not modified.
+
+        :param tree: Phylo.BaseTree.Tree or Clade with strictly bifurcating nodes
+        :param ladderize: if True, order children as Phylo's ladderize() would
+        :param normalize: 'mean', 'median' or 'none', see normalize()
+        :return: CompactTree
+        """
+        left, right, left_bl, right_bl = [], [], [], []
+        done = []  # (index, branch length) of completed subtrees, -1 for tips
+        stack = [(getattr(tree, 'root', tree), False)]
+        while stack:
+            clade, expanded = stack.pop()
+            if not clade.clades:
+                done.append((-1, clade.branch_length or 0.))
+            elif not expanded:
+                if len(clade.clades) != 2:
+                    raise ValueError('CompactTree requires a binary tree, found node '
+                                     'with %d children' % len(clade.clades))
+                stack.append((clade, True))
+                stack.append((clade.clades[1], False))
+                stack.append((clade.clades[0], False))
+            else:
+                c2, bl2 = done.pop()
+                c1, bl1 = done.pop()
+                left.append(c1)
+                right.append(c2)
+                left_bl.append(bl1)
+                right_bl.append(bl2)
+                done.append((len(left) - 1, clade.branch_length or 0.))
+
+        tree = cls(left, right, left_bl, right_bl)
+        if ladderize:
+            tree.ladderize()
+        tree.normalize(normalize)
+        return tree
+
+    @classmethod
+    def from_edges(cls, edge, edge_length, ladderize=False, normalize='none'):
+        """
+        Convert an ape 'phylo' edge matrix into a CompactTree, e.g. as
+        returned by Rcolgem with edges=True, without going through Newick.
+        Tips are numbered 1..n and internal nodes n+1..2n-1 with the root
+        at n+1, as in ape.  Children keep the order of their edges.
+
+        :param edge: integer array of shape (2n-2, 2), parent and child of each edge
+        :param edge_length: array of 2n-2 branch lengths
+        :param ladderize: if True, order children as Phylo's ladderize() would
+        :param normalize: 'mean', 'median' or 'none', see normalize()
+        :return: CompactTree
+        """
+        edge = np.asarray(edge, dtype=np.int64).reshape(-1, 2)
+        edge_length = np.asarray(edge_length, dtype=np.float64)
+        nnodes = len(edge) // 2
+        ntips = nnodes + 1
+
+        # children of each internal node, one row per node from the root
+        order = np.argsort(edge[:, 0], kind='mergesort')
+        parents = edge[order, 0]
+        if len(edge) != 2 * nnodes or np.any(parents[0::2] != parents[1::2]) or \
+                np.any(parents[0::2] != np.arange(ntips + 1, ntips + nnodes + 1)):
+            raise ValueError('CompactTree requires a binary tree with ape node numbering')
+        children = (edge[order, 1] - ntips - 1).reshape(nnodes, 2).tolist()  # negative for tips
+        lengths = edge_length[order].reshape(nnodes, 2).tolist()
+
+        # postorder, walking from the root with an explicit stack
+        postorder = []  # reverse postorder: node, then right subtree, then left
+        stack = [0] if nnodes else []
+        while stack:
+            node = stack.pop()
+            postorder.append(node)
+            for child in children[node]:
+                if child >= 0:
+                    stack.append(child)
+        postorder.reverse()
+
+        index = [0] * nnodes
+        for i, node in enumerate(postorder):
+            index[node] = i
+
+        left = [index[children[n][0]] if children[n][0] >= 0 else -1 for n in postorder]
+        right = [index[children[n][1]] if children[n][1] >= 0 else -1 for n in postorder]
+        tree = cls(left, right, [lengths[n][0] for n in postorder], [lengths[n][1] for n in postorder])
+        if ladderize:
+            tree.ladderize()
+        tree.normalize(normalize)
+        return tree
+
+    def __getstate__(self):
+        # caches are cheap to rebuild, so keep pickles sent to workers small
+        state = self.__dict__.copy()
+        for key in ('_levels', '_buckets', '_ranks', '_level_groups', '_lists'):
+            state[key] = None
+        state.pop('height', None)
+        return state
+
+    @property
+    def nnodes(self):
+        """ Number of internal nodes """
+        return len(self.left)
+
+    @property
+    def ntips(self):
+        return len(self.left) + 1
+
+    def tip_depths(self):
+        """
+        Distances from the root to every tip, walking down from the root
+        (last in postorder) so that deep trees need no recursion.
+        The root branch is not stored and so never contributes.
+        :return: array of [ntips] depths, in no particular order
+        """
+        depth = [0.] * self.nnodes
+        tips = []
+        for i in xrange(self.nnodes - 1, -1, -1):
+            for child, bl in ((self.left[i], self.left_bl[i]), (self.right[i], self.right_bl[i])):
+                if child >= 0:
+                    depth[child] = depth[i] + bl
+                else:
+                    tips.append(depth[i] + bl)
+        return np.array(tips)
+
+    def levels(self):
+        """
+        Group internal nodes by height, where tips have height 0 and
+        cherries height 1.  Every child falls in an earlier level than its
+        parent, so levels can be processed in order as whole batches.
+        :return: list of index arrays, lowest level first
+        """
+        if self._levels is None:
+            height = [0] * self.nnodes
+            for i, (c1, c2) in enumerate(zip(self.left.tolist(), self.right.tolist())):
+                height[i] = 1 + max(height[c1] if c1 >= 0 else 0,
+                                    height[c2] if c2 >= 0 else 0)
+            self.height = np.array(height, dtype=np.int32)
+            order = np.argsort(self.height, kind='mergesort')
+            bounds = np.flatnonzero(np.diff(self.height[order])) + 1
+            self._levels = np.split(order, bounds)
+        return self._levels
+
+    def buckets(self):
+        """
+        Group internal nodes by production, as only nodes with the same
+        production can match in the kernel.
+        :return: dict keyed by production (1, 2, 3) of index arrays in postorder
+        """
+        if self._buckets is None:
+            self._buckets = dict((p, np.flatnonzero(self.production == p)) for p in (1, 2, 3))
+        return self._buckets
+
+    def ranks(self):
+        """
+        Position of each internal node within its production bucket, used
+        to address kernel DP entries that are stored per production.
+        """
+        if self._ranks is None:
+            self._ranks = np.empty(self.nnodes, dtype=np.int32)
+            for bucket in self.buckets().itervalues():
+                self._ranks[bucket] = np.arange(len(bucket))
+        return self._ranks
+
+    def level_groups(self):
+        """
+        Split each of levels() by production.
+        :return: list (lowest level first) of lists of (production, index array)
+        """
+        if self._level_groups is None:
+            self._level_groups = []
+            for level in self.levels():
+                groups = []
+                for p in (1, 2, 3):
+                    rows = level[self.production[level] == p]
+                    if len(rows) > 0:
+                        groups.append((p, rows))
+                self._level_groups.append(groups)
+        return self._level_groups
+
+    def split(self, nparts):
+        """
+        Split internal nodes into [nparts] groups of whole subtrees of
+        similar total size, so that every internal descendant of a node
+        falls in its group.  Subtrees hold at most 1/(2 nparts) of the
+        internal nodes, and the nodes above them (the spine) are left out.
+        In postorder, the subtree of node i is the range i-size+1 .. i.
+        :return: tuple (list of [nparts] index arrays, index array of spine)
+        """
+        size = [1] * self.nnodes
+        for i, (c1, c2) in enumerate(zip(self.left.tolist(), self.right.tolist())):
+            size[i] += (size[c1] if c1 >= 0 else 0) + (size[c2] if c2 >= 0 else 0)
+        size = np.array(size)
+
+        max_size = max(1, -(-self.nnodes // (2 * nparts)))
+        small = size <= max_size
+        parent = np.full(self.nnodes, self.nnodes - 1)  # root is its own parent
+        for child in (self.left, self.right):
+            internal = child >= 0
+            parent[child[internal]] = np.flatnonzero(internal)
+        roots = np.flatnonzero(small & ~small[parent])
+        if small.all():
+            roots = np.array([self.nnodes - 1])
+
+        # largest subtrees first, each to the smallest group so far
+        groups = [[] for _ in range(nparts)]
+        loads = [0] * nparts
+        for root in roots[np.argsort(-size[roots], kind='mergesort')]:
+            j = loads.index(min(loads))
+            groups[j].append(np.arange(root - size[root] + 1, root + 1))
+            loads[j] += size[root]
+        groups = [np.sort(np.concatenate(g)) if g else np.zeros(0, dtype=np.int64) for g in groups]
+        return groups, np.flatnonzero(~small)
+
+    def as_lists(self):
+        """
+        Node data as plain Python lists, which are much faster than NumPy
+        arrays for the scalar access of the node-by-node kernel loop.
+        :return: tuple (production, sqbl, left_bl, right_bl, children, buckets, ranks)
+            where children[i] = ((left, left production), (right, right production))
+            and buckets maps production to a list of node indices
+        """
+        if self._lists is None:
+            children = zip(zip(self.left.tolist(), self.left_production.tolist()),
+                           zip(self.right.tolist(), self.right_production.tolist()))
+            buckets = dict((p, b.tolist()) for p, b in self.buckets().iteritems())
+            self._lists = (self.production.tolist(), self.sqbl.tolist(), self.left_bl.tolist(),
+                           self.right_bl.tolist(), children, buckets, self.ranks().tolist())
+        return self._lists
+
+    def ladderize(self):
+        """
+        Put the child with fewer tips on the left at every node, keeping
+        the original order on ties as Phylo's ladderize() does.  Nodes are
+        renumbered to keep them in postorder.
+        """
+        left, right = self.left.tolist(), self.right.tolist()
+        left_bl, right_bl = self.left_bl.tolist(), self.right_bl.tolist()
+        nnodes = len(left)
+
+        ntips = [0] * nnodes
+        for i in xrange(nnodes):
+            c1, c2 = left[i], right[i]
+            n1 = ntips[c1] if c1 >= 0 else 1
+            n2 = ntips[c2] if c2 >= 0 else 1
+            if n1 > n2:
+                left[i], right[i] = c2, c1
+                left_bl[i], right_bl[i] = right_bl[i], left_bl[i]
+            ntips[i] = n1 + n2
+
+        # new postorder, walking from the root with an explicit stack
+        order = []  # reverse postorder: node, then right subtree, then left
+        stack = [nnodes - 1] if nnodes else []
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if left[node] >= 0:
+                stack.append(left[node])
+            if right[node] >= 0:
+                stack.append(right[node])
+        order.reverse()
+
+        index = [0] * nnodes
+        for i, node in enumerate(order):
+            index[node] = i
+
+        self.left = np.array([index[left[n]] if left[n] >= 0 else -1 for n in order], dtype=np.int32)
+        self.right = np.array([index[right[n]] if right[n] >= 0 else -1 for n in order], dtype=np.int32)
+        self.left_bl = np.array([left_bl[n] for n in order])
+        self.right_bl = np.array([right_bl[n] for n in order])
+        self._levels = self._buckets = self._ranks = self._level_groups = None
+        self.annotate()
+
+    def annotate(self):
+        """
+        Compute productions and squared branch lengths from the child arrays.
+        Must be called again if branch lengths are modified in place.
+        """
+        self.production = 1 + (self.left < 0).astype(np.int8) + (self.right < 0).astype(np.int8)
+        self.left_production = np.where(self.left < 0, 0, self.production[self.left])
+        self.right_production = np.where(self.right < 0, 0, self.production[self.right])
+        self.sqbl = self.left_bl**2 + self.right_bl**2
+        self._lists = None
+
+    def normalize(self, mode='median'):
+        """
+        Scale branch lengths by the mean or median branch length.
+        The root branch is not stored and so never contributes.
+        """
+        branch_lengths = np.concatenate((self.left_bl, self.right_bl))
+        if mode == 'mean':
+            scale = branch_lengths.sum() / len(branch_lengths)
+        elif mode == 'median':
+            scale = np.median(branch_lengths)
+        else:
+            return
+
+        self.left_bl /= scale
+        self.right_bl /= scale
+        self.annotate()
@@ -0,0 +1,152 @@
+"""
+Convergence diagnostics for ABC-MCMC chains, updated one sample at a time
+so that a run can be stopped once it has mixed.
+"""
+import math
+from collections import deque
+import numpy as np
+
+
+class OnlineAutocorrelation(object):
+    """
+    Autocovariance of a scalar trace up to [maxlag], from running sums of
+    lagged products, so that each sample costs O(maxlag).
+
+    Values are shifted by the first sample to limit cancellation.
+    """
+
+    def __init__(self, maxlag=500):
+        self.maxlag = maxlag
+        self.n = 0
+        self.shift = None
+        self.total = 0.
+        self.lagsums = np.zeros(maxlag + 1)
+        self.head = []  # first maxlag values
+        self.tail = deque(maxlen=maxlag + 1)  # most recent values, newest last
+
+    def add(self, x):
+        if self.shift is None:
+            self.shift = x
+        x -= self.shift
+        self.tail.append(x)
+        recent = np.array(self.tail)[::-1]  # lag 0, 1, 2, ...
+        self.lagsums[:len(recent)] += x * recent
+        if len(self.head) < self.maxlag:
+            self.head.append(x)
+        self.total += x
+        self.n += 1
+
+    def autocorrelation(self):
+        """
+        :return: array of autocorrelations at lags 0 .. min(maxlag, n-1),
+                 or None if the trace has not varied
+        """
+        n = self.n
+        nlags = min(self.maxlag, n - 1) + 1
+        k = np.arange(nlags)
+        mean = self.total / n
+        # sums of x_t over t >= k and over t < n-k
+        head = np.concatenate(([0.], np.cumsum(self.head)))[:nlags]
+        tail = np.concatenate(([0.], np.cumsum(list(self.tail)[::-1])))[:nlags]
+        cov = (self.lagsums[:nlags] - mean * (2*self.total - head - tail) + (n - k) * mean**2) / (n - k)
+        if cov[0] <= 0:
+            return None
+        return cov / cov[0]
+
+    def act(self):
+        """
+        Integrated autocorrelation time, summing autocorrelations over
+        Geyer's initial positive sequence of pairs of lags.  Infinite for
+        a trace that has not moved, e.g. a chain that accepted nothing.
+        """
+        if self.n < 4:
+            return float('nan')
+        rho = self.autocorrelation()
+        if rho is None:
+            return float('inf')
+        tau = -1.
+        for m in range(0, len(rho) - 1, 2):
+            pair = rho[m] + rho[m+1]
+            if pair <= 0:
+                break
+            tau += 2. * pair
+        return max(tau, 1. / self.n)
+
+    def ess(self):
+        return self.n / self.act()
+
+
+class ChainDiagnostics(object):
+    """
+    Effective sample size and integrated autocorrelation time of each
+    traced quantity, and the Gelman-Rubin potential scale reduction
+    factor across chains with the same target.
+
+    [names] = labels of the traced quantities, e.g. parameter names
+    [nchains] = number of chains
+    [maxlag] = longest lag of the autocorrelation estimates
+    """
+
+    def __init__(self, names, nchains=1, maxlag=500):
+        self.names = list(names)
+        self.nchains = nchains
+        self.traces = [[OnlineAutocorrelation(maxlag) for _ in self.names] for _ in range(nchains)]
+        # Welford running mean and sum of squared deviations per chain
+        self.n = [0] * nchains
+        self.means = np.zeros((nchains, len(self.names)))
+        self.m2 = np.zeros((nchains, len(self.names)))
+
+    def add(self, values, chain=0):
+        """
+        :param values: one sample of each traced quantity, in order of [names]
+        :param chain: index of chain the sample belongs to
+        """
+        values = np.asarray(values, dtype=float)
+        for trace, value in zip(self.traces[chain], values):
+            trace.add(value)
+        self.n[chain] += 1
+        delta = values - self.means[chain]
+        self.means[chain] += delta / self.n[chain]
+        self.m2[chain] += delta * (values - self.means[chain])
+
+    def ess(self):
+        """
+        :return: dict of effective sample size summed over chains
+        """
+        return dict((name, sum(self.traces[c][i].ess() for c in range(self.nchains)))
+                    for i, name in enumerate(self.names))
+
+    def act(self):
+        """
+        :return: dict of integrated autocorrelation time, averaged over chains
+        """
+        return dict((name, sum(self.traces[c][i].act() for c in range(self.nchains)) / self.nchains)
+                    for i, name in enumerate(self.names))
+
+    def rhat(self):
+        """
+        Potential scale reduction factor (Gelman and Rubin 1992) of each
+        traced quantity, using the length of the shortest chain.
+        :return: dict, or None if there are fewer than two chains
+        """
+        n = min(self.n)
+        if self.nchains < 2 or n < 2:
+            return None
+        within = (self.m2 / (np.array(self.n)[:, np.newaxis] - 1)).mean(axis=0)
+        between = n * self.means.var(axis=0, ddof=1)
+        pooled = (n - 1.) / n * within + between / n
+        retval = {}
+        for name, w, v in zip(self.names, within, pooled):
+            retval[name] = math.sqrt(v / w) if w > 0 else float('nan')
+        return retval
+
+    def summary(self):
+        """
+        :return: diagnostics as space-separated key=value items
+        """
+        items = ['n=%d' % sum(self.n)]
+        for label, values in (('ess', self.ess()), ('act', self.act()), ('rhat', self.rhat())):
+            if values is not None:
+                items.append('%s=%s' % (label, ','.join('%s:%1.3g' % (name, values[name])
+                                                       for name in self.names)))
+        return ' '.join(items)
@@ -27,6 +27,9 @@ try:
     infile = sys.argv[1]
     tipfile = sys.argv[2]
     outfile = sys.argv[3]
+    # MASTER writes unpruned trees here; only final trees go to outfile,
+    # which Kamphir reads while this script is running
+    rawfile = outfile + '.master'
 except:
     print 'Usage: python MASTER.SIR.py [input CSV] [tip labels CSV] [output NWK]'
     sys.exit(1)
@@ -133,7 +136,7 @@ context = {
     't_end': 30,    # length of simulation
     'ntips': 100,   # number of tips in tree
     'nreps': 10,    # number of trees to generate
-    'outfile': outfile
+    'outfile': rawfile
 }
 
 
@@ -160,8 +163,8 @@ handle.write(template.render(context))
 handle.close()
 
 # remove previous Newick output if it exists
-if os.path.exists(outfile):
-    os.remove(outfile)
+if os.path.exists(rawfile):
+    os.remove(rawfile)
 
 # call MASTER
 
@@ -176,7 +179,7 @@ elapsed = 0
 ntips = context['ntips']  # remember original number
 while 1:
     time.sleep(time_step)
-    handle = open(outfile, 'rU')
+    handle = open(rawfile, 'rU')
     lines = handle.readlines()
     if len(lines) == context['nreps']:
         # generated the requested number of replicates
@@ -206,7 +209,7 @@ p.kill()
 
 
 # sample tips to enforce size of tree
-trees = Phylo.parse(outfile, 'newick')
+trees = Phylo.parse(rawfile, 'newick')
 trees2 = []
 while True:
     try:
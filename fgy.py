@@ -0,0 +1,301 @@
+"""
+Python engine for the demographic ODEs of the rcolgem models, producing
+births (F), migrations (G) and deme sizes (Y) along a time grid as make.fgy
+does in R, without parsing and evaluating rate expressions at every step.
+"""
+import numpy as np
+from scipy.integrate import odeint
+
+
+class FGY(object):
+    """
+    Solution of a demographic ODE, laid out as the list returned by make.fgy.
+
+    [times] = time grid, latest time first, as rev(times)
+    [F] = array (time, deme, deme) of birth rates from row to column deme
+    [G] = array (time, deme, deme) of migration rates from row to column deme
+    [Y] = array (time, deme) of deme sizes
+    [ox] = array (time, variable) of the ODE solution, earliest time first,
+        with columns time, demes and non-deme variables as deSolve's ode()
+    """
+
+    def __init__(self, times, F, G, Y, ox):
+        self.times = times
+        self.F = F
+        self.G = G
+        self.Y = Y
+        self.ox = ox
+
+    def feasible(self, ntips):
+        """
+        Number of infected individuals at the last sample must not be less
+        than the number of tips, as checked by finish.setup in rcolgem.py.
+        """
+        total = self.Y[0].sum()
+        return bool(np.isfinite(self.ox).all() and total >= ntips)
+
+
+class FGYModel(object):
+    """
+    Demographic model with infected classes [demes] and other variables
+    [non_demes].  State vectors list demes first, as make.fgy reorders them.
+
+    Subclasses define the rates of the model as functions of the state,
+    vectorized over any leading axes of x, so that a whole trajectory can
+    be converted to F, G and Y at once.
+
+    [params] = dict of model parameters, with the names used by rcolgem.py
+    [sample_states] = whether tip states are drawn from the deme sizes at
+        the last sample, rather than all tips being in the first deme
+    """
+    demes = ()
+    non_demes = ()
+    sample_states = False
+
+    def __init__(self, params):
+        self.params = params
+
+    def initial(self):
+        """ :return: initial state vector """
+        raise NotImplementedError
+
+    def births(self, x):
+        """ :return: array (..., deme, deme) of birth rates """
+        raise NotImplementedError
+
+    def migrations(self, x):
+        """ :return: array (..., deme, deme) of migration rates """
+        return np.zeros(x.shape[:-1] + (len(self.demes), len(self.demes)))
+
+    def deaths(self, x):
+        """ :return: array (..., deme) of death rates """
+        raise NotImplementedError
+
+    def non_deme(self, x):
+        """ :return: array (..., non-deme) of derivatives of non-deme variables """
+        raise NotImplementedError
+
+    def derivative(self, x):
+        F = self.births(x)
+        G = self.migrations(x)
+        ddeme = F.sum(axis=-2) + G.sum(axis=-2) - G.sum(axis=-1) - self.deaths(x)
+        return np.concatenate((ddeme, self.non_deme(x)), axis=-1)
+
+    def solve(self, t0, t_end, t_last, resolution=500, method='rk4'):
+        """
+        Solve from t0 to t_last, the time of the last sample, as the model's
+        solve function in rcolgem.py does.
+        :param t_end: height of the tree, only used by models that switch
+                      parameters part way along the time grid
+        """
+        return make_fgy(self, self.initial(), t0, t_last, resolution, method)
+
+
+def rk4(func, y0, times):
+    """
+    Classical Runge-Kutta with one step per interval of [times], as
+    deSolve's rk4 with the default step size.
+    :param func: derivative func(y, t), as for odeint; y may have any shape
+    :return: array (time, ...) of states
+    """
+    y0 = np.asarray(y0, dtype=float)
+    y = np.empty((len(times),) + y0.shape)
+    y[0] = y0
+    for i in xrange(len(times) - 1):
+        t, h = times[i], times[i+1] - times[i]
+        k1 = func(y[i], t)
+        k2 = func(y[i] + 0.5*h*k1, t + 0.5*h)
+        k3 = func(y[i] + 0.5*h*k2, t + 0.5*h)
+        k4 = func(y[i] + h*k3, t + h)
+        y[i+1] = y[i] + h/6. * (k1 + 2.*k2 + 2.*k3 + k4)
+    return y
+
+
+def make_fgy(model, y0, t0, t1, resolution=500, method='rk4', rtol=1e-6, atol=1e-6):
+    """
+    Solve the model's ODE on [resolution] evenly spaced times from t0 to t1
+    and evaluate its rates along the solution, as make.fgy in rcolgem.R.
+    :param y0: initial state vector, demes first
+    :param method: 'rk4' for fixed steps, or 'lsoda' for adaptive steps
+                   with tolerances [rtol] and [atol], as in deSolve
+    :return: FGY
+    """
+    times = np.linspace(t0, t1, int(resolution))
+    y0 = np.asarray(y0, dtype=float)
+    derivative = lambda x, t: model.derivative(x)
+    if method == 'rk4':
+        y = rk4(derivative, y0, times)
+    elif method == 'lsoda':
+        y = odeint(derivative, y0, times, rtol=rtol, atol=atol)
+    else:
+        raise ValueError('Unknown integration method %s' % method)
+
+    ox = np.column_stack((times, y))
+    x = y[::-1]
+    return FGY(times[::-1], model.births(x), model.migrations(x), x[:, :len(model.demes)], ox)
+
+
+class SIModel(FGYModel):
+    demes = ('I',)
+    non_demes = ('S',)
+
+    def initial(self):
+        return [1., self.params['N'] - 1]
+
+    def rates(self):
+        p = self.params
+        return p['beta'], p['gamma'], p['mu'], p.get('lambd', p['mu'])
+
+    def births(self, x):
+        beta = self.rates()[0]
+        I, S = x[..., 0], x[..., 1]
+        return (beta * S * I / (S + I))[..., np.newaxis, np.newaxis]
+
+    def deaths(self, x):
+        _, gamma, mu, _ = self.rates()
+        return (mu + gamma) * x[..., :1]
+
+    def non_deme(self, x):
+        beta, gamma, mu, lambd = self.rates()
+        I, S = x[..., 0], x[..., 1]
+        return (-mu*S + lambd*S + (mu+gamma)*I - S*(beta*I) / (S+I))[..., np.newaxis]
+
+
+class SI2Model(SIModel):
+    """
+    SI model with transmission rate beta1 up to fraction t_break of the
+    time grid from t0 to t_end, and beta2 afterwards.
+    """
+
+    def solve(self, t0, t_end, t_last, resolution=500, method='rk4'):
+        resolution = int(resolution)
+        # numpy rounds half to even as R does
+        tp1 = int(np.round(resolution * self.params['t_break']))
+        tp2 = resolution - tp1
+
+        # if break is too close to either limit, return single ODE solution
+        if tp1 < 3 or tp2 < 3:
+            params = dict(self.params, beta=self.params['beta2' if tp1 < 3 else 'beta1'])
+            return SIModel(params).solve(t0, t_end, t_last, resolution, method)
+
+        times = np.linspace(t0, t_end, resolution)
+        first = SIModel(dict(self.params, beta=self.params['beta1']))
+        fgy1 = make_fgy(first, first.initial(), t0, times[tp1-1], tp1, method)
+
+        # second solution starts from the last state of the first, one grid step later
+        second = SIModel(dict(self.params, beta=self.params['beta2']))
+        fgy2 = make_fgy(second, fgy1.ox[-1, 1:], times[tp1], t_last, tp2, method)
+
+        return FGY(np.concatenate((fgy2.times, fgy1.times)), np.concatenate((fgy2.F, fgy1.F)),
+                   np.concatenate((fgy2.G, fgy1.G)), np.concatenate((fgy2.Y, fgy1.Y)),
+                   np.concatenate((fgy1.ox, fgy2.ox)))
+
+
+class DiffRiskModel(FGYModel):
+    """
+    SI model with two risk groups of contact rates c1 and c2, mixing
+    assortatively with probability rho.
+    """
+    demes = ('I1', 'I2')
+    non_demes = ('S1', 'S2')
+    sample_states = True
+
+    def initial(self):
+        p = self.params
+        return [1., 0., p['p'] * p['N'] - 1, (1 - p['p']) * p['N']]
+
+    def mixing(self, x):
+        """
+        :return: arrays of probability that an infection goes from group k to group l
+        """
+        p = self.params
+        I1, I2, S1, S2 = (x[..., k] for k in range(4))
+        contacts1 = p['c1'] * (S1 + I1)
+        contacts2 = p['c2'] * (S2 + I2)
+        total = contacts1 + contacts2
+        rho = p['rho']
+        return (rho + (1-rho) * contacts1 / total, (1-rho) * contacts2 / total,
+                (1-rho) * contacts1 / total, rho + (1-rho) * contacts2 / total)
+
+    def births(self, x):
+        p = self.params
+        I1, I2, S1, S2 = (x[..., k] for k in range(4))
+        p11, p12, p21, p22 = self.mixing(x)
+        F = np.empty(x.shape[:-1] + (2, 2))
+        F[..., 0, 0] = p['beta'] * p['c1'] * p11 * I1 / (S1+I1) * S1
+        F[..., 0, 1] = p['beta'] * p['c2'] * p21 * I1 / (S1+I1) * S2
+        F[..., 1, 0] = p['beta'] * p['c1'] * p12 * I2 / (S2+I2) * S1
+        F[..., 1, 1] = p['beta'] * p['c2'] * p22 * I2 / (S2+I2) * S2
+        return F
+
+    def deaths(self, x):
+        p = self.params
+        return (p['mu'] + p['gamma']) * x[..., :2]
+
+    def non_deme(self, x):
+        # deaths are replaced in the susceptible class of the same group
+        F = self.births(x)
+        return (self.params['mu'] + self.params['gamma']) * x[..., :2] - F.sum(axis=-2)
+
+
+class StagesModel(FGYModel):
+    """
+    SI model where infected individuals progress through acute, asymptomatic
+    and chronic stages, and only the chronic stage has excess mortality.
+    """
+    demes = ('I1', 'I2', 'I3')
+    non_demes = ('S',)
+    sample_states = True
+
+    def initial(self):
+        return [1., 0., 0., self.params['N'] - 1]
+
+    def births(self, x):
+        p = self.params
+        S = x[..., 3]
+        total = S + x[..., :3].sum(axis=-1)
+        beta = np.array([p['beta1'], p['beta2'], p['beta3']])
+        F = np.zeros(x.shape[:-1] + (3, 3))
+        F[..., :, 0] = beta * x[..., :3] * (S / total)[..., np.newaxis]
+        return F
+
+    def migrations(self, x):
+        p = self.params
+        G = np.zeros(x.shape[:-1] + (3, 3))
+        G[..., 0, 1] = p['alpha1'] * x[..., 0]
+        G[..., 1, 2] = p['alpha2'] * x[..., 1]
+        return G
+
+    def deaths(self, x):
+        p = self.params
+        return x[..., :3] * np.array([p['mu'], p['mu'], p['mu'] + p['gamma']])
+
+    def non_deme(self, x):
+        p = self.params
+        I1, I2, I3, S = (x[..., k] for k in range(4))
+        return (-p['mu']*S + p['mu']*(S+I1+I2) + (p['mu']+p['gamma'])*I3 -
+                self.births(x)[..., :, 0].sum(axis=-1))[..., np.newaxis]
+
+
+MODELS = {'SI': SIModel, 'SI2': SI2Model, 'DiffRisk': DiffRiskModel, 'Stages': StagesModel}
+
+
+def solve(model, params, tree_height, tip_heights, t0=0., resolution=500, method='rk4'):
+    """
+    Solve the ODE of an rcolgem model for a simulation call, with the
+    arguments of Rcolgem.simulate_*_trees.
+    :param model: 'SI', 'SI2', 'DiffRisk' or 'Stages'
+    :return: FGY
+    """
+    t_last = float(tree_height) - min(float(h) for h in tip_heights)
+    return MODELS[model](params).solve(float(t0), float(tree_height), t_last, resolution, method)
+
+
+def feasible(model, params, tree_height, tip_heights, t0=0., resolution=500, method='rk4'):
+    """
+    Check that an rcolgem model can produce trees with this many tips,
+    without calling R.
+    """
+    with np.errstate(all='ignore'):
+        fgy = solve(model, params, tree_height, tip_heights, t0, resolution, method)
+    return fgy.feasible(len(tip_heights))
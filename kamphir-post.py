@@ -7,6 +7,7 @@ Only rcolgem is supported for now.
 import sys
 from rcolgem import Rcolgem
 import argparse
+import random
 from Bio import Phylo
 from math import floor
 
@@ -30,9 +31,8 @@ def post_process(logfile, tree_height, tip_heights, model, ntrees, nrows, resol,
         sys.exit()
 
     # parse log data
-    logdata = {}
     header = []
-    ndata = 0
+    rows = []
     for line in logfile:
         if line.startswith('#'):
             continue
@@ -41,15 +41,27 @@ def post_process(logfile, tree_height, tip_heights, model, ntrees, nrows, resol,
         # use header to prepare container
         if len(header) == 0:
             header = items
-            for key in header:
-                logdata.update({key: []})
             continue
+        rows.append(map(float, items))
+
+    if 'weight' in header:
+        # ABC-SMC log: the final generation, resampled by weight, is the posterior sample
+        gen = header.index('generation')
+        wt = header.index('weight')
+        last = [row for row in rows if row[gen] == rows[-1][gen]]
+        total = sum(row[wt] for row in last)
+        rows = []
+        for _ in range(len(last)):
+            u = random.random() * total
+            for row in last:
+                u -= row[wt]
+                if u < 0:
+                    break
+            rows.append(row)
+    else:
+        rows = rows[burnin:]
 
-        ndata += 1  # the total number of data rows
-        if ndata <= burnin:
-            continue
-        for i, key in enumerate(header):
-            logdata[key].append(float(items[i]))
+    logdata = dict((key, [row[i] for row in rows]) for i, key in enumerate(header))
 
     maxrow = len(logdata.values()[0])
 
@@ -94,6 +106,8 @@ def post_process(logfile, tree_height, tip_heights, model, ntrees, nrows, resol,
         if step in nwksteps:
             nwkfile.write(trees[0]+'\n')
 
+    print 'ODE solution cache:', rcolgem.cache_summary()
+
 
 
 if __name__ == '__main__':
@@ -106,7 +120,8 @@ if __name__ == '__main__':
     parser.add_argument('nwk', help='<OUTPUT> file to write Newick tree strings')
     parser.add_argument('csv', help='<OUTPUT> file to write trajectories as CSV')
 
-    parser.add_argument('-burnin', type=int, default=100, help='Number of steps to skip as burnin.')
+    parser.add_argument('-burnin', type=int, default=100,
+                        help='Number of steps to skip as burnin.  Ignored for ABC-SMC logs.')
     parser.add_argument('-ntrees', type=int, default=100, help='Number of trees to output.')
     parser.add_argument('-nrows', type=int, default=100, help='Number of trajectories to output.')
     parser.add_argument('-resol', type=int, default=100, help='Resolution for numerical solution of ODE.')
@@ -0,0 +1,125 @@
+"""
+Score a reference set of simulated trees against the target tree over a grid
+of kernel settings (decay factor and Gaussian precision), to choose kernel
+settings for Kamphir without re-running the tree simulation for every pair.
+
+Trees are simulated once with Rcolgem at the initial parameter values of the
+settings JSON, or read from a Newick file (-trees), e.g. kamphir-post output.
+Each tree is then scored on the whole grid in a single kernel pass.
+"""
+import sys
+import json
+import argparse
+from Bio import Phylo
+import numpy as np
+from phyloK2 import PhyloKernel, PreparedTarget
+from newick import NewickReader
+
+
+def sweep(target, trees, kdecays, taus):
+    """
+    :param target: PreparedTarget for the observed tree
+    :param trees: iterable of Bio.Phylo trees or CompactTrees
+    :param kdecays: decay factors of the grid
+    :param taus: Gaussian precisions of the grid
+    :return: tuple (grid as list of (kdecay, tau), array of scores with one row per tree)
+    """
+    grid = [(kdecay, tau) for kdecay in kdecays for tau in taus]
+    decayFactors = [kdecay for kdecay, _ in grid]
+    gaussFactors = [tau for _, tau in grid]
+
+    scores = []
+    for tree in trees:
+        scores.append(target.score_multi(tree, decayFactors, gaussFactors))
+        print '(%d)' % len(scores)
+
+    return grid, np.array(scores)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KAMPHIR-sweep',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('tree', help='<INPUT> Newick tree string to fit model to')
+    parser.add_argument('csv', help='<OUTPUT> file to write mean kernel scores per setting as CSV')
+
+    parser.add_argument('-model', default=None, choices=['SI', 'SI2', 'DiffRisk', 'Stages'],
+                        help='Rcolgem model to simulate reference trees with.')
+    parser.add_argument('-settings', default=None,
+                        help='JSON file containing model parameter settings; trees are simulated at '
+                             'the initial values.')
+    parser.add_argument('-trees', default=None,
+                        help='<INPUT> file of simulated Newick tree strings to use instead of -model.')
+    parser.add_argument('-nreps', type=int, default=100, help='Number of replicate trees to simulate.')
+    parser.add_argument('-ncores', type=int, default=1, help='Number of processes for tree simulation.')
+    parser.add_argument('-resol', type=int, default=100, help='Resolution for numerical solution of ODE.')
+
+    parser.add_argument('-kdecay', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.4, 0.8],
+                        help='Decay factors to evaluate.')
+    parser.add_argument('-tau', type=float, nargs='+', default=[0.1, 0.5, 1.0, 2.0, 4.0],
+                        help='Gaussian precisions to evaluate.')
+    parser.add_argument('-normalize', default='mean', choices=['none', 'mean', 'median'],
+                        help='Scale branch lengths so trees of different lengths can be compared.')
+
+    args = parser.parse_args()
+
+    # open and parse tree
+    try:
+        tree = Phylo.read(args.tree, 'newick')
+    except:
+        print 'ERROR: Failed to parse tree from file', args.tree
+        raise
+
+    tree_height = max(tree.depths().values())
+    tip_heights = [0.] * len(tree.get_terminals())
+
+    kernel = PhyloKernel(normalize=args.normalize, engine='numpy')
+    tree.ladderize()
+    target = PreparedTarget(kernel, tree)
+
+    reader = NewickReader(normalize=args.normalize)
+    if args.trees is not None:
+        trees = reader.parse(open(args.trees, 'rU'))
+    else:
+        if args.model is None or args.settings is None:
+            print 'ERROR: Must specify either (-trees) or both (-model) and (-settings).'
+            sys.exit()
+
+        handle = open(args.settings, 'rU')
+        settings = json.loads(handle.read())
+        handle.close()
+        params = dict((key, v['initial']) for key, v in settings.iteritems())
+
+        import rcolgem
+        r = rcolgem.Rcolgem(ncores=args.ncores, nreps=args.nreps, fgy_resolution=args.resol)
+        if args.model == 'SI':
+            r.init_SI_model()
+            simfunc = r.simulate_SI_trees
+        elif args.model == 'SI2':
+            r.init_SI_model()
+            simfunc = r.simulate_SI2_trees
+        elif args.model == 'DiffRisk':
+            r.init_DiffRisk_model()
+            simfunc = r.simulate_DiffRisk_trees
+        else:
+            r.init_stages_model()
+            simfunc = r.simulate_stages_trees
+
+        newicks = simfunc(params, tree_height, tip_heights)
+        if len(newicks) == 0:
+            print 'ERROR: Simulation failed at initial parameter values.'
+            sys.exit()
+        trees = reader.parse(newicks)
+
+    grid, scores = sweep(target, trees, args.kdecay, args.tau)
+    if reader.nskipped > 0:
+        print 'Warning: discarded %d mangled trees' % reader.nskipped
+    if len(scores) == 0:
+        print 'ERROR: No reference trees to score.'
+        sys.exit()
+
+    with open(args.csv, 'w') as csvfile:
+        csvfile.write('kdecay,tau,mean,sd,n\n')
+        for i, (kdecay, tau) in enumerate(grid):
+            csvfile.write(','.join(map(str, [kdecay, tau, scores[:, i].mean(),
+                                             scores[:, i].std(), len(scores)])))
+            csvfile.write('\n')
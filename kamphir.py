@@ -3,27 +3,23 @@ Estimate epidemic model parameters by comparing simulations to "observed" phylog
 """
 import sys
 import os
+import subprocess
+import multiprocessing as mp
 from phyloK2 import *
+from newick import NewickReader
+from compacttree import CompactTree
+from diagnostics import ChainDiagnostics
+from adaptive import AdaptiveMetropolis
 import random
+import numpy as np
 
 from copy import deepcopy
 import time
-from cStringIO import StringIO
 import math
 from scipy import stats
 
 FNULL = open(os.devnull, 'w')
 
-# see http://stackoverflow.com/questions/8804830/python-multiprocessing-pickling-error/24673524#24673524
-import dill
-
-def run_dill_encoded(what):
-    fun, args = dill.loads(what)
-    return fun(*args)
-
-def apply_async(pool, fun, args):
-    return pool.apply_async(run_dill_encoded, (dill.dumps((fun, args)),))
-
 
 class Kamphir (PhyloKernel):
     """
@@ -43,7 +39,9 @@ class Kamphir (PhyloKernel):
     
     def __init__(self, settings, script, driver, simfunc,
                  ncores=1, nreps=10, nthreads=1, gibbs=False, use_priors=False,
-                 **kwargs):
+                 batchsize=None, sequential=False, seq_z=3., seq_min=3, surrogate=None,
+                 ntries=1, target_ess=0., target_rhat=0., diag_interval=100, diag_burnin=None,
+                 adaptive=False, feasibility=None, **kwargs):
         # call base class constructor
         PhyloKernel.__init__(self, **kwargs)
 
@@ -74,17 +72,63 @@ class Kamphir (PhyloKernel):
 
         # rcolgem functions
         self.simfunc = simfunc
+        # optional check of (params, tree_height, tip_heights) before simfunc,
+        # returning False if no trees can be simulated, e.g. fgy.feasible
+        self.feasibility = feasibility
+
+        # parse simulated trees directly into prepared CompactTrees
+        self.newick_reader = NewickReader(ladderize=True, normalize=self.normalize)
 
         self.ntips = []
         self.tip_heights = []  # list of lists
         self.tree_heights = []
-        self.ref_denom = []  # kernel score of target tree to itself
 
         self.ncores = ncores  # number of processes for rcolgem simulation
         self.nreps = nreps
         self.nthreads = nthreads  # number of processes for PhyloKernel
+
+        # sequential evaluation: stop simulating a proposal once the upper
+        # confidence bound (z-score seq_z) of its mean score, estimated from
+        # at least seq_min trees per target, falls below the acceptance threshold
+        self.sequential = sequential
+        self.seq_z = seq_z
+        self.seq_min = seq_min
+
+        # number of trees simulated per call to simfunc; smaller batches let the
+        # kernel pool score one batch while the next is being simulated
+        if batchsize is None:
+            batchsize = ncores if (nthreads > 1 or sequential) else nreps
+        self.batchsize = max(1, min(batchsize, nreps))
+        self.kernel_pool = None  # started by set_target_trees if nthreads > 1
+        # largest error bound of a normalized score from the approximate kernel (-cutoff)
+        self.max_score_error = 0.
         self.gibbs = gibbs
 
+        # delayed acceptance: screen proposals with an emulator of the mean
+        # kernel score (e.g. surrogate.GPSurrogate) before simulating trees
+        self.surrogate = surrogate
+
+        # multiple-try Metropolis: number of proposals per step, each evaluated
+        # in its own worker process (started by abc_mcmc)
+        self.ntries = ntries
+        self.try_pool = None
+
+        # convergence diagnostics, written to the log every diag_interval steps
+        # after diag_burnin; chains stop once both targets (if > 0) are met
+        self.target_ess = target_ess
+        self.target_rhat = target_rhat
+        self.diag_interval = diag_interval
+        self.diag_burnin = diag_burnin
+
+        # adaptive Metropolis: learn proposal covariance and scale of the
+        # varied parameters, on log scale where proposals are log-normal
+        self.adaptive = None
+        self.adaptive_component = None  # parameter moved by last gibbs proposal
+        if adaptive:
+            sigmas = [self.settings[key]['sigma'] for key in sorted(self.settings.iterkeys())
+                      if self.settings[key]['sigma'] > 0]
+            self.adaptive = AdaptiveMetropolis(sigmas, componentwise=gibbs)
+
 
     def set_target_trees(self, path, treenum, delimiter=None, position=None):
         """
@@ -101,25 +145,24 @@ class Kamphir (PhyloKernel):
         self.path_to_tree = path
 
         # reset lists
-        self.target_trees = []  # tuple (newick string, tree height, [tip heights], denom)
+        self.target_trees = []  # tuple (PreparedTarget, tree height, [tip heights])
 
         for index, tree in enumerate(Phylo.parse(path, 'newick')):
             if treenum is not None and index != treenum:
                 # user asked to process only one tree from this file
                 continue
 
-            # record this before normalizing
-            tree_height = max(tree.depths().values())
-
-            tree.ladderize()
-            self.normalize_tree(tree, self.normalize)
-            self.annotate_tree(tree)
-
-            ref_denom = self.kernel(tree, tree)
-
-            tips = tree.get_terminals()
+            # record this before normalizing; both steps avoid Phylo's recursive
+            # traversals, which fail on deep (caterpillar-like) trees
+            compact = CompactTree.from_phylo(tree, ladderize=True)
+            tree_height = compact.tip_depths().max() + (tree.root.branch_length or 0.)
+            tips = ladderized_terminals(tree)
             ntips = len(tips)
 
+            # cache target-side kernel data for scoring simulations
+            compact.normalize(self.normalize)
+            target = PreparedTarget(self, compact)
+
             # record tip heights (list of lists)
             if delimiter is None:
                 tip_heights = [0.] * ntips
@@ -141,7 +184,7 @@ class Kamphir (PhyloKernel):
 
                 tip_heights = [str(maxdate-t) if t else 0 for t in tipdates]
 
-            self.target_trees.append((tree, tree_height, tip_heights, ref_denom))
+            self.target_trees.append((target, tree_height, tip_heights))
 
         if len(self.target_trees) == 0:
             # we didn't read any of the trees from the file!
@@ -149,29 +192,45 @@ class Kamphir (PhyloKernel):
                   'or -treenum (%d) exceeds number of trees!' % (treenum, )
             sys.exit()
 
+        # hand prepared targets to kernel worker processes once
+        if self.nthreads > 1:
+            if self.kernel_pool is not None:
+                self.kernel_pool.close()
+            # size tree arena for nreps trees as large as the largest target
+            capacity = self.nreps * max(len(tip_heights) for _, _, tip_heights in self.target_trees)
+            self.kernel_pool = KernelPool([target for target, _, _ in self.target_trees],
+                                          self.nthreads, capacity=capacity)
+
 
-    def proposal (self, tuning=1.0, max_attempts=100):
+    def proposal (self, tuning=1.0, max_attempts=100, base=None):
         """
         Generate a deep copy of parameters and modify one
         parameter value, given constraints (if any).
         :param tuning = factor to adjust sigma
+        :param base = parameter values to propose from, defaults to current
         """
+        if base is None:
+            base = self.current
 
         # make deep copy
-        for key in self.current.iterkeys():
-            self.proposed[key] = self.current[key]
+        for key in base.iterkeys():
+            self.proposed[key] = base[key]
         
         if self.gibbs:
             # which parameter to adjust in proposal (component-wise)?
             choices = []
             for parameter in self.settings.iterkeys():
                 choices.extend([parameter] * int(self.settings[parameter]['weight']))
-            to_modify = random.sample(choices, 1)[0] # weighted sampling
-            #to_modify = random.sample(self.proposed.keys(), 1)[0] # uniform sampling
+            to_modify = random.sample(choices, 1) # weighted sampling
+            #to_modify = random.sample(self.proposed.keys(), 1) # uniform sampling
         else:
             # full dimensional update
             to_modify = self.settings.keys()
 
+        if self.adaptive is not None:
+            self.adaptive_proposal(base, to_modify, max_attempts)
+            return
+
         for key in to_modify:
             sigma = self.settings[key]['sigma'] * tuning
             if sigma == 0:
@@ -179,8 +238,6 @@ class Kamphir (PhyloKernel):
                 continue
 
             attempts = 0
-            this_min = self.settings[key].get('min', None)
-            this_max = self.settings[key].get('max', None)
             while True:
                 attempts += 1
                 if attempts > max_attempts:
@@ -188,27 +245,81 @@ class Kamphir (PhyloKernel):
                     sys.exit()
                 if self.settings[key]['log'].upper()=='TRUE':
                     # log-normal proposal - NOTE mean and sigma are on natural log scale
-                    proposal_value = random.lognormvariate(math.log(self.current[key]), sigma)
+                    proposal_value = random.lognormvariate(math.log(base[key]), sigma)
                 else:
                     # Gaussian
-                    proposal_value = random.normalvariate(self.current[key], sigma)
+                    proposal_value = random.normalvariate(base[key], sigma)
 
-                if this_min is not None and proposal_value < this_min:
-                    delta = this_min - proposal_value  # how far past the minimum are we?
-                    proposal_value = this_min + delta  # reflect this amount up from minimum
-
-                if this_max is not None and proposal_value > this_max:
-                    delta = proposal_value - this_max
-                    proposal_value = this_max - delta
-
-                # one more time to check that we are within bounds
-                if this_min is not None and proposal_value < this_min:
+                proposal_value = self.reflect(key, proposal_value)
+                if proposal_value is None:
                     continue  # try again
 
                 self.proposed[key] = proposal_value
                 break
 
+    def reflect(self, key, value):
+        """
+        Reflect a proposed value at the min/max settings of parameter [key].
+        :return: value within bounds, or None if the value is too far out
+        """
+        this_min = self.settings[key].get('min', None)
+        this_max = self.settings[key].get('max', None)
+
+        if this_min is not None and value < this_min:
+            delta = this_min - value  # how far past the minimum are we?
+            value = this_min + delta  # reflect this amount up from minimum
+
+        if this_max is not None and value > this_max:
+            delta = value - this_max
+            value = this_max - delta
+
+        # one more time to check that we are within bounds
+        if this_min is not None and value < this_min:
+            return None
+        return value
+
+    def adaptive_proposal(self, base, to_modify, max_attempts=100):
+        """
+        Update self.proposed from [base] with a draw from the adaptive
+        Metropolis proposal, reflected at min/max as in proposal().
+        :param to_modify: parameters chosen by proposal(); in gibbs mode,
+                          the single parameter to move
+        """
+        keys = [key for key in sorted(self.settings.iterkeys()) if self.settings[key]['sigma'] > 0]
+        self.adaptive_component = None
+        if self.gibbs:
+            if to_modify[0] not in keys:
+                return  # no modification
+            self.adaptive_component = keys.index(to_modify[0])
+            moved = [self.adaptive_component]
+        else:
+            moved = range(len(keys))
+
+        z = self.param_vector(base)
+        for _ in range(max_attempts):
+            values = self.adaptive.draw(z, self.adaptive_component)
+            proposal = {}
+            for i in moved:
+                key = keys[i]
+                value = math.exp(values[i]) if self.settings[key]['log'].upper()=='TRUE' else values[i]
+                proposal[key] = self.reflect(key, value)
+            if None not in proposal.values():
+                self.proposed.update(proposal)
+                return
+
+        print 'ERROR: Failed to update proposal, check initial/min/max settings.'
+        sys.exit()
+
     
+    def param_vector(self, params):
+        """
+        Values of parameters that are varied by proposal(), in alphabetical
+        order and on log scale where proposals are log-normal, for the surrogate.
+        """
+        keys = [key for key in sorted(self.settings.iterkeys()) if self.settings[key]['sigma'] > 0]
+        return [math.log(params[key]) if self.settings[key]['log'].upper()=='TRUE' else params[key]
+                for key in keys]
+
     def log_priors (self):
         """
         Calculate the natural log-transformed prior probabilities for current and proposed
@@ -222,65 +333,28 @@ class Kamphir (PhyloKernel):
         """
         return retval
 
-    def compute(self, tree, target_tree, ref_denom, output=None):
-        """
-        Calculate kernel score.  Allow for MP execution.
-        """
-        try:
-            tree.root.branch_length = 0.
-            tree.ladderize()
-            self.normalize_tree(tree, self.normalize)
-            self.annotate_tree(tree)
-        except:
-            print 'ERROR: failed to prepare tree for kernel computation'
-            print tree
-            raise
-
-        try:
-            k = self.kernel(target_tree, tree)
-            tree_denom = self.kernel(tree, tree)
-        except:
-            print 'ERROR: failed to compute kernel score for tree'
-            print tree
-            print target_tree
-            raise
-
-        #knorm = k / math.sqrt(self.ref_denom * tree_denom)
-        try:
-            knorm = math.exp(math.log(k) - 0.5*(math.log(ref_denom) + math.log(tree_denom)))
-        except:
-            print 'ERROR: failed to normalize kernel score'
-            print k, ref_denom, tree_denom
-            raise
-
-        if output is None:
-            return knorm
-
-        output.put(knorm)  # MP
-
-    def simulate_internal(self, tree_height, tip_heights):
+    def simulate_internal(self, tree_height, tip_heights, nreps=None):
         """
         Simulate trees using class function simfunc.
-        Convert resulting Newick tree strings into Phylo objects.
-        :return: List of Phylo BaseTree objects.
+        Convert resulting Newick tree strings, or (edge, edge_length) arrays
+        as returned by Rcolgem with edges=True, into prepared CompactTrees.
+        :param nreps: number of trees to simulate, defaults to self.nreps
+        :return: List of CompactTree objects.
         """
 
-        newicks = self.simfunc(self.proposed, tree_height, tip_heights)
-        trees = []
-        for newick in newicks:
-            try:
-                tree = Phylo.read(StringIO(newick), 'newick')
-            except:
-                continue
-            trees.append(tree)
+        trees = self.simfunc(self.proposed, tree_height, tip_heights, nreps=nreps or self.nreps)
+        if trees and not isinstance(trees[0], basestring):
+            return [CompactTree.from_edges(edge, edge_length, ladderize=True, normalize=self.normalize)
+                    for edge, edge_length in trees]
+        return list(self.newick_reader.parse(trees))
 
-        return trees
-
-    def simulate_external(self, tree_height, tip_heights, prune=True):
+    def simulate_external(self, tree_height, tip_heights):
         """
-        Estimate the mean kernel distance between the reference tree and
-        trees simulated under the given model parameters.
-        :returns List of Phylo Tree objects
+        Run the external tree simulator and tail its output file, so that
+        trees can be scored while the simulator is still running if the
+        driver writes each replicate as soon as it is done.
+        :yields lists of CompactTree objects as complete lines are appended;
+                a single empty list if the simulation failed
         """
         # TODO: allow user to set arbitrary driver Rscript
         # TODO: generalize tip label annotation
@@ -305,30 +379,133 @@ class Kamphir (PhyloKernel):
             ))
         handle.close()
 
+        # do not mistake output of the previous step for new trees
+        if os.path.exists(self.path_to_output_nwk):
+            os.remove(self.path_to_output_nwk)
+
         # external call to tree simulator script
-        os.system(' '.join([self.driver, self.path_to_script, self.path_to_input_csv,
-                            self.path_to_label_csv, self.path_to_output_nwk]) + ' >/dev/null')
+        process = subprocess.Popen([self.driver, self.path_to_script, self.path_to_input_csv,
+                                    self.path_to_label_csv, self.path_to_output_nwk], stdout=FNULL)
 
-        # retrieve trees from output file
-        trees = []
+        handle = None
+        partial = ''  # incomplete last line of output
+        ntrees = 0
         try:
-            handle = open(self.path_to_output_nwk, 'rU')
-        except IOError:
-            # file does not exist, simulation failed
-            return []
-        
-        for line in handle:
-            try:
-                tree = Phylo.read(StringIO(line), 'newick')
-            except:
-                # NewickError: Number of open/close parentheses do not match
-                #print 'WARNING: Discarding mangled tree.'
-                continue
+            while True:
+                running = process.poll() is None
+                if handle is None and os.path.exists(self.path_to_output_nwk):
+                    handle = open(self.path_to_output_nwk, 'rU')
+                if handle is not None:
+                    lines = (partial + handle.read()).split('\n')
+                    partial = '' if not running else lines.pop()
+
+                    # mangled trees (e.g. unbalanced parentheses) are counted and discarded
+                    trees = list(self.newick_reader.parse(lines))
+                    if trees:
+                        ntrees += len(trees)
+                        yield trees
+                if not running:
+                    break
+                time.sleep(0.1)
+        finally:
+            if handle is not None:
+                handle.close()
+            if process.poll() is None:
+                # consumer stopped early
+                process.kill()
+                process.wait()
+
+        if ntrees == 0:
+            # no output file or no readable trees, simulation failed
+            yield []
+
+    def simulate_batches(self, tree_height, tip_heights):
+        """
+        Simulate the replicate trees for one target in batches of
+        self.batchsize, or by tailing the external simulator.
+        :yields lists of CompactTree objects as they become available;
+                an empty list if the simulation failed, after which it stops
+        """
+        if self.simfunc is None:
+            for trees in self.simulate_external(tree_height, tip_heights):
+                yield trees
+            return
+
+        if self.feasibility is not None and not self.feasibility(self.proposed, tree_height, tip_heights):
+            yield []
+            return
+
+        nsimulated = 0
+        while nsimulated < self.nreps:
+            nreps = min(self.batchsize, self.nreps - nsimulated)
+            trees = self.simulate_internal(tree_height, tip_heights, nreps=nreps)
+            yield trees
+            if len(trees) == 0:
+                return
+            nsimulated += nreps
 
-            trees.append(tree)
-        handle.close()
+    def score_stream(self):
+        """
+        Pipeline of tree simulation and kernel scoring for the proposed
+        parameters.  With a kernel pool, each batch is scored in the
+        background while the next batch is simulated.
+        :yields (target index, list of kernel scores) per batch as scores
+                become available; (target index, None) if a simulation failed,
+                after which the stream ends
+        """
+        for index, (target, tree_height, tip_heights) in enumerate(self.target_trees):
+            if self.kernel_pool is not None:
+                self.kernel_pool.reset()
+
+            pending = []
+            for trees in self.simulate_batches(tree_height, tip_heights):
+                if len(trees) == 0:
+                    yield index, None
+                    return
+
+                if self.kernel_pool is None:
+                    yield index, self.record_errors(target.score_batch(trees))
+                    continue
+
+                # workers already hold the target and read trees from shared memory
+                pending.append(self.kernel_pool.submit(index, trees))
+
+                # in sequential mode, keep simulation at most one batch ahead of
+                # scoring, so that evaluate_sequential() can stop it early
+                while pending and (pending[0].ready() or (self.sequential and len(pending) > 1)):
+                    yield index, self.record_errors(pending.pop(0).get())
+
+            for result in pending:
+                yield index, self.record_errors(result.get())
+
+    def record_errors(self, results):
+        """
+        Split (score, error) tuples from PreparedTarget.score_batch() or the
+        kernel pool, keeping the largest error bound in max_score_error.
+        :return: list of scores
+        """
+        if results:
+            self.max_score_error = max(self.max_score_error, max(error for _, error in results))
+        return [score for score, _ in results]
+
+    def evaluate_pool(self, pool, proposals):
+        """
+        Evaluate parameter sets in a pool of forked evaluation workers,
+        keeping the largest error bound of their scores in max_score_error.
+        :param proposals: list of parameter dicts
+        :return: list of mean kernel scores, None where simulations failed
+        """
+        results = pool.map(_evaluate_params, proposals)
+        self.max_score_error = max([self.max_score_error] + [error for _, error in results])
+        return [score for score, _ in results]
 
-        return trees
+    def log_score_error(self, logfile, label):
+        """
+        Write the largest error bound of normalized scores so far to the log,
+        if the kernel is approximated.
+        """
+        if self.cutoff > 0:
+            logfile.write('# approximate kernel: max score error=%g at %s\n' % (self.max_score_error, label))
 
     def prune_tree(self, tree):
         """
@@ -356,50 +533,194 @@ class Kamphir (PhyloKernel):
         """
         Wrapper to calculate mean kernel score for a simulated set
         of trees given proposed model parameters.
-        :param trees = list of Phylo Tree objects from simulations
-                        in case we want to re-evaluate mean score (debugging)
-        :return [mean] mean kernel score
-                [trees] simulated trees (for debugging)
+        :return [mean] mean kernel score, weighted by number of tips
+                of each target tree; None if a simulation failed
         """
+        sums = [0.] * len(self.target_trees)
+        counts = [0] * len(self.target_trees)
+
+        # running sums are updated as each batch of scores arrives
+        for index, scores in self.score_stream():
+            if scores is None:
+                # failed simulation
+                return None
+            sums[index] += sum(scores)
+            counts[index] += len(scores)
+
         retval = 0.
         total_ntips = 0
-
-        # iterate over target trees
-        for target_tree, tree_height, tip_heights, ref_denom in self.target_trees:
+        for (_, _, tip_heights), total, count in zip(self.target_trees, sums, counts):
             ntips = len(tip_heights)
             total_ntips += ntips
+            retval += total/count * ntips
 
-            # simulate trees for this target tree
-            if self.simfunc is None:
-                trees = self.simulate_external(tree_height, tip_heights)
-            else:
-                trees = self.simulate_internal(tree_height, tip_heights)
+        return retval / total_ntips
 
-            if len(trees) == 0:
-                # failed simulation
-                return None
 
-            if self.nthreads > 1:
-                try:
-                    async_results = [apply_async(pool,
-                                                 self.compute,
-                                                 args=(tree, target_tree, ref_denom))
-                                     for tree in trees]
-                except:
-                    # TODO: dump trees to file for debugging
-                    raise
-
-                map(mp.pool.ApplyResult.wait, async_results)
-                results = [r.get() for r in async_results]
-            else:
-                # single-threaded mode
-                results = [self.compute(tree, target_tree, ref_denom) for tree in trees]
+    def evaluate_sequential(self, threshold):
+        """
+        Like evaluate(), but stop simulating as soon as the mean kernel
+        score is clearly below threshold, i.e. the proposal will be rejected.
+        The bound on each target's mean uses a finite population correction,
+        as the score being estimated is the mean over nreps replicates.
+        :param threshold: score that the mean must exceed for acceptance
+        :return: tuple (mean score, number of trees scored); mean score is
+                 None if a simulation failed, and an estimate from the trees
+                 scored so far if stopped early
+        """
+        weights = [len(tip_heights) for _, _, tip_heights in self.target_trees]
+        sums = [0.] * len(self.target_trees)
+        sumsqs = [0.] * len(self.target_trees)
+        counts = [0] * len(self.target_trees)
+
+        stream = self.score_stream()
+        for index, scores in stream:
+            if scores is None:
+                return None, sum(counts)
+            sums[index] += sum(scores)
+            sumsqs[index] += sum(x*x for x in scores)
+            counts[index] += len(scores)
+
+            # upper bound on weighted mean score, scores never exceed 1
+            upper = 0.
+            for weight, total, sumsq, n in zip(weights, sums, sumsqs, counts):
+                if n < self.seq_min:
+                    upper += weight
+                    continue
+                mean = total / n
+                var = max(sumsq/n - mean*mean, 0.) * n / (n-1)
+                fpc = max(self.nreps - n, 0) / (self.nreps - 1.) if self.nreps > 1 else 0.
+                upper += weight * min(1., mean + self.seq_z * math.sqrt(var / n * fpc))
+
+            if upper / sum(weights) < threshold:
+                stream.close()  # stops external simulator
+                break
 
-            # sum weighted by size of tree
-            retval += sum(results)/len(results) * ntips
+        done = [(weight, total/n) for weight, total, n in zip(weights, sums, counts) if n > 0]
+        retval = sum(weight * mean for weight, mean in done) / sum(weight for weight, _ in done)
+        return retval, sum(counts)
 
-        return retval / total_ntips
+    def log_weight(self, params, score, tol):
+        """
+        Log of the unnormalized ABC posterior density at [params], given
+        its mean kernel score; -inf if the simulation failed.
+        """
+        if score is None:
+            return float('-inf')
+        retval = -2.*(1.-score)/tol
+        if self.use_priors:
+            proposed = self.proposed
+            self.proposed = params
+            retval += self.log_priors()['proposal']
+            self.proposed = proposed
+        return retval
+
+    def multiple_try(self, cur_score, tol):
+        """
+        One step of multiple-try Metropolis (Liu, Liang and Wong 2000).
+        [ntries] proposals are evaluated concurrently by the worker pool and
+        one is selected with probability proportional to its posterior
+        weight.  It is accepted by comparing the total weight of the
+        proposals to that of [ntries]-1 reference points drawn around the
+        selected proposal, plus the current state.
+        :return: tuple (accepted, score, acceptance probability), where the
+                 selected proposal is left in self.proposed; score is None
+                 if every simulation failed
+        """
+        tries = []
+        for _ in range(self.ntries):
+            self.proposal()
+            tries.append(dict(self.proposed))
+        scores = self.evaluate_pool(self.try_pool, tries)
+        log_w = [self.log_weight(params, score, tol) for params, score in zip(tries, scores)]
+        if max(log_w) == float('-inf'):
+            return False, None, 0.
+
+        # select a proposal with probability proportional to weight
+        top = max(log_w)
+        weights = [math.exp(w - top) for w in log_w]
+        u = random.random() * sum(weights)
+        for chosen, weight in enumerate(weights):
+            u -= weight
+            if u < 0 and weight > 0:
+                break
+        selected = tries[chosen]
+
+        # reference points around the selected proposal
+        refs = []
+        for _ in range(self.ntries - 1):
+            self.proposal(base=selected)
+            refs.append(dict(self.proposed))
+        ref_scores = self.evaluate_pool(self.try_pool, refs) if refs else []
+        ref_w = [self.log_weight(params, score, tol) for params, score in zip(refs, ref_scores)]
+        ref_w.append(self.log_weight(self.current, cur_score, tol))
+
+        log_ratio = log_sum_exp(log_w) - log_sum_exp(ref_w)
+        accept_prob = math.exp(min(0., log_ratio))
 
+        self.proposed.update(selected)
+        return random.random() < accept_prob, scores[chosen], accept_prob
+
+    def adaptive_scale(self):
+        """
+        Proposal scale factor of adaptive Metropolis as a string, per
+        parameter if componentwise.
+        """
+        if not self.adaptive.componentwise:
+            return '%1.3g' % self.adaptive.scale()
+        keys = [key for key in sorted(self.settings.iterkeys()) if self.settings[key]['sigma'] > 0]
+        return ','.join('%s:%1.3g' % (key, scale) for key, scale in zip(keys, self.adaptive.scale()))
+
+    def write_header(self, logfile, tol0, mintol, decay):
+        """
+        Record settings in logfile header
+        """
+        logfile.write('# Kamphir log\n')
+        logfile.write('# start time: %s\n' % time.ctime())
+        logfile.write('# input file: %s\n' % self.path_to_tree)
+        logfile.write('# annealing settings: tol0=%f, mintol=%f, decay=%f\n' % (tol0, mintol, decay))
+        logfile.write('# MCMC settings: %s\n' % json.dumps(self.settings))
+        logfile.write('# kernel settings: decay=%f normalize=%s tau=%f %s\n' % (
+                      self.decayFactor, self.normalize, self.gaussFactor,
+                      'gibbs' if self.gibbs else ''))
+        if self.cutoff > 0:
+            logfile.write('# approximate kernel: cutoff=%g\n' % self.cutoff)
+
+    def start_diagnostics(self, nchains, tol0, mintol, decay):
+        """
+        Track parameters varied by proposal() and the kernel score.
+        Unless diag_burnin is set, samples are recorded once the annealed
+        tolerance is within 1% of mintol.
+        :return: tuple (ChainDiagnostics, first step to record)
+        """
+        names = [key for key in sorted(self.settings.iterkeys()) if self.settings[key]['sigma'] > 0]
+        burnin = self.diag_burnin
+        if burnin is None:
+            if decay > 0 and tol0 > 1.01 * mintol:
+                burnin = int(math.ceil(math.log((tol0 - mintol) / (0.01 * mintol)) / decay))
+            else:
+                burnin = 0
+        return ChainDiagnostics(names + ['score'], nchains=nchains), burnin
+
+    def diagnose(self, diagnostics, step, logfile):
+        """
+        Write convergence diagnostics to the log as a comment line.
+        :return: True if the ESS and R-hat targets are set and met
+        """
+        if min(diagnostics.n) < 4:
+            return False
+        logfile.write('# diagnostics at state %d: %s\n' % (step, diagnostics.summary()))
+        if self.target_ess <= 0 and self.target_rhat <= 0:
+            return False
+        if self.target_ess > 0 and min(diagnostics.ess().values()) < self.target_ess:
+            return False
+        if self.target_rhat > 0:
+            rhat = diagnostics.rhat()
+            if rhat is None or any(not r <= self.target_rhat for r in rhat.values()):
+                return False
+        print 'convergence targets met at step', step
+        logfile.write('# convergence targets met at state %d\n' % step)
+        return True
 
     def abc_mcmc(self, logfile, max_steps=1e5, tol0=0.01, mintol=0.0005, decay=0.0025, skip=1, first_step=0):
         """
@@ -409,70 +730,490 @@ class Kamphir (PhyloKernel):
         [sigma2] = variance parameter for Gaussian RBF
                    A higher value is more permissive.
         """
-        # record settings in logfile header
-
         # report variables in alphabetical order
         keys = self.current.keys()
         keys.sort()
 
-        logfile.write('# Kamphir log\n')
-        logfile.write('# start time: %s\n' % time.ctime())
-        logfile.write('# input file: %s\n' % self.path_to_tree)
-        logfile.write('# annealing settings: tol0=%f, mintol=%f, decay=%f\n' % (tol0, mintol, decay))
-        logfile.write('# MCMC settings: %s\n' % json.dumps(self.settings))
-        logfile.write('# kernel settings: decay=%f normalize=%s tau=%f %s\n' % (
-                      self.decayFactor, self.normalize, self.gaussFactor,
-                      'gibbs' if self.gibbs else ''))
+        self.write_header(logfile, tol0, mintol, decay)
+        if self.sequential:
+            logfile.write('# sequential evaluation: z=%g min=%d batchsize=%d\n' % (
+                          self.seq_z, self.seq_min, self.batchsize))
+        if self.surrogate is not None:
+            logfile.write('# delayed acceptance: min=%d max=%d refit=%d\n' % (
+                          self.surrogate.min_points, self.surrogate.max_points, self.surrogate.refit))
+        if self.adaptive is not None:
+            logfile.write('# adaptive Metropolis: target=%g n0=%d beta=%g %s\n' % (
+                          self.adaptive.target, self.adaptive.n0, self.adaptive.beta,
+                          'componentwise' if self.adaptive.componentwise else ''))
+        if self.ntries > 1:
+            logfile.write('# multiple-try Metropolis: ntries=%d\n' % self.ntries)
+            # forked workers inherit target trees and simulation settings
+            self.try_pool = mp.Pool(self.ntries, initializer=_init_eval_worker, initargs=(self,))
 
         print 'calculating initial kernel score'
         cur_score = self.evaluate()
         if cur_score is None:
             print 'ERROR: failed to simulate trees under initial parameter values.'
+            if self.try_pool is not None:
+                self.try_pool.terminate()
             sys.exit()
         print cur_score
+        if self.surrogate is not None:
+            self.surrogate.add(self.param_vector(self.current), cur_score)
 
         step = first_step  # in case of restarting chain
+        nskipped = self.newick_reader.nskipped
+        nscreened = 0  # proposals rejected by the surrogate without simulation
+        diagnostics, burnin = self.start_diagnostics(1, tol0, mintol, decay)
         logfile.write('\t'.join(['state', 'score', 'prior'] + keys))
         logfile.write('\n')
         logfile.flush()
 
         # TODO: generalize screen and file log parameters
         while step < max_steps:
-            next_score = None
-            while next_score is None:
-                self.proposal()  # update proposed values
-                next_score = self.evaluate()  # returns None if simulations fail
-                
-            if next_score > 1.0 or next_score < 0.0:
-                print 'ERROR: next_score (', next_score, ') outside interval [0,1], dumping proposal and EXIT'
-                print self.proposal()
-                sys.exit()
-            
             # adjust tolerance, simulated annealing
             tol = (tol0 - mintol) * math.exp(-1. * decay * step) + mintol
-            log_prior = self.log_priors()
 
-            ratio = math.exp(-2.*(1.-next_score)/tol) / math.exp(-2.*(1.-cur_score)/tol)
-            if self.use_priors:
-                ratio *= math.exp(log_prior['proposal'] - log_prior['current'])
-            accept_prob = min(1., ratio)
+            screened = False
+            if self.ntries > 1:
+                accepted, next_score, accept_prob = self.multiple_try(cur_score, tol)
+                log_prior = self.log_priors()
+            else:
+                next_score = None
+                while next_score is None:
+                    self.proposal()  # update proposed values
+                    log_prior = self.log_priors()
+                    # log acceptance ratio, apart from the kernel score term
+                    log_other = log_prior['proposal'] - log_prior['current'] if self.use_priors else 0.
+
+                    if self.surrogate is not None and self.surrogate.ready():
+                        # delayed acceptance (Christen and Fox 2005): first stage is a
+                        # Metropolis test on surrogate scores, and only proposals that
+                        # pass it are simulated
+                        approx_cur = self.surrogate.predict(self.param_vector(self.current))
+                        approx_next = self.surrogate.predict(self.param_vector(self.proposed))
+                        log_ratio = 2.*(approx_next - approx_cur)/tol + log_other
+                        if math.log(1. - random.random()) >= log_ratio:
+                            screened = True
+                            next_score = approx_next
+                            break
+                        # second stage divides out the surrogate ratio; priors cancel
+                        log_other = 2.*(approx_cur - approx_next)/tol
+
+                    if self.sequential:
+                        # draw uniform first; accept iff next_score > threshold
+                        log_u = math.log(1. - random.random())
+                        threshold = cur_score + tol / 2. * (log_u - log_other)
+                        next_score, ntrees = self.evaluate_sequential(threshold)
+                    else:
+                        next_score = self.evaluate()  # returns None if simulations fail
+
+                if screened:
+                    nscreened += 1
+                else:
+                    if next_score > 1.0 or next_score < 0.0:
+                        print 'ERROR: next_score (', next_score, ') outside interval [0,1], dumping proposal and EXIT'
+                        print self.proposal()
+                        sys.exit()
+                    log_ratio = 2.*(next_score - cur_score)/tol + log_other
+
+                    # train surrogate on full evaluations only
+                    if self.surrogate is not None and (
+                            not self.sequential or ntrees >= self.nreps * len(self.target_trees)):
+                        self.surrogate.add(self.param_vector(self.proposed), next_score)
+
+                accept_prob = math.exp(min(0., log_ratio))
+
+                if screened:
+                    accepted = False
+                elif self.sequential:
+                    accepted = next_score > threshold
+                else:
+                    accepted = random.random() < accept_prob
 
             # screen log
             to_screen = '%d\t%1.5f\t%1.5f\t%1.5f\t' % (step, cur_score, log_prior['proposal'], accept_prob)
             to_screen += '\t'.join(map(lambda x: str(round(x, 5)), [self.current[k] for k in keys]))
-            print to_screen
-            
-            if random.random() < accept_prob:
+            if screened:
+                to_screen += '\t(screened)'
+            elif self.sequential:
+                to_screen += '\t(%d trees)' % ntrees
+
+            if accepted:
                 # accept proposal
                 for key in self.current:
                     self.current[key] = self.proposed[key]
                 cur_score = next_score
+
+            if self.adaptive is not None:
+                self.adaptive.update(self.param_vector(self.current), accepted, self.adaptive_component)
+                to_screen += '\tacc %1.3f\tscale %s' % (self.adaptive.acceptance_rate(), self.adaptive_scale())
+            print to_screen
             
+            if self.newick_reader.nskipped > nskipped:
+                logfile.write('# discarded %d mangled trees at state %d\n' % (
+                              self.newick_reader.nskipped - nskipped, step))
+                nskipped = self.newick_reader.nskipped
+
+            if self.adaptive is not None and (step + 1) % 100 == 0:
+                logfile.write('# adaptive Metropolis at state %d: acceptance=%1.3f scale=%s\n' % (
+                              step, self.adaptive.acceptance_rate(), self.adaptive_scale()))
+
+            if (step + 1) % 100 == 0:
+                self.log_score_error(logfile, 'state %d' % step)
+
+            if self.surrogate is not None and (step + 1) % 100 == 0:
+                logfile.write('# delayed acceptance: %d of %d proposals rejected by surrogate '
+                              'without simulation at state %d\n' % (nscreened, step + 1 - first_step, step))
+
             if step % skip == 0:
                 logfile.write('\t'.join(map(str, [step, cur_score, log_prior['proposal']] + [self.current[k] for k in keys])))
                 logfile.write('\n')
                 logfile.flush()
+
+            if step >= burnin:
+                diagnostics.add([self.current[k] for k in diagnostics.names[:-1]] + [cur_score])
+            step += 1
+            if step % self.diag_interval == 0 and self.diagnose(diagnostics, step - 1, logfile):
+                break
+
+        self.log_score_error(logfile, 'end of chain')
+
+        if self.try_pool is not None:
+            self.try_pool.close()
+            self.try_pool.join()
+            self.try_pool = None
+
+    def abc_smc(self, logfile, nparticles=100, ngen=20, nworkers=1, tol0=0.01, mintol=0.0005, quantile=0.5,
+                max_retries=10):
+        """
+        Population Monte Carlo ABC (Beaumont et al. 2009), using the kernel
+        score in place of a distance threshold.  The first generation is
+        drawn from the priors in the settings, and each later generation
+        from Gaussian perturbations of the previous one, with twice its
+        weighted variance.  Particles are importance weighted by
+            prior * exp(-2(1-score)/tol) / proposal density
+        with tol0 in the first generation.  Each later generation takes
+        the weighted [quantile] of the distances 1-score of the previous
+        generation as its tol, which never increases and stops at mintol.
+
+        Parameters with sigma = 0 are held at their initial values, and
+        the others are perturbed on log scale if 'log' is set.  Perturbations
+        are redrawn around the same particle until within min and max, so
+        the proposal density divides each kernel by its in-bounds mass.
+        Particles of a generation are evaluated in parallel by [nworkers]
+        forked processes.  Particles of the first generation whose
+        simulations fail are drawn again from the priors, up to
+        [max_retries] times.  Each generation is written to the log with its
+        normalized weights; kamphir-post resamples the last one.
+        """
+        keys = self.current.keys()
+        keys.sort()
+        free = [key for key in keys if self.settings[key]['sigma'] > 0]
+        logscale = np.array([self.settings[key]['log'].upper()=='TRUE' for key in free])
+        priors = dict((key, self.priors[key] if key in self.priors else eval('stats.'+self.settings[key]['prior']))
+                      for key in free)
+
+        def to_params(z):
+            params = dict(self.current)
+            for key, value, is_log in zip(free, z, logscale):
+                params[key] = math.exp(value) if is_log else value
+            return params
+
+        def in_bounds(params):
+            for key in free:
+                this_min = self.settings[key].get('min', None)
+                this_max = self.settings[key].get('max', None)
+                if (this_min is not None and params[key] < this_min) or \
+                        (this_max is not None and params[key] > this_max):
+                    return False
+            return True
+
+        # min and max of free parameters on transformed scale
+        lower, upper = np.empty(len(free)), np.empty(len(free))
+        for i, (key, is_log) in enumerate(zip(free, logscale)):
+            this_min = self.settings[key].get('min', None)
+            this_max = self.settings[key].get('max', None)
+            lower[i] = float('-inf') if this_min is None or (is_log and this_min <= 0) else \
+                (math.log(this_min) if is_log else this_min)
+            upper[i] = float('inf') if this_max is None else (math.log(this_max) if is_log else this_max)
+
+        self.write_header(logfile, tol0, mintol, 0.)
+        logfile.write('# ABC-SMC settings: nparticles=%d ngen=%d quantile=%g\n' % (nparticles, ngen, quantile))
+        logfile.write('\t'.join(['generation', 'score', 'weight'] + keys))
+        logfile.write('\n')
+        logfile.flush()
+
+        # forked workers inherit target trees and simulation settings
+        pool = mp.Pool(nworkers, initializer=_init_eval_worker, initargs=(self,))
+
+        particles = None  # free parameters of previous generation, transformed
+        weights = None
+        tol = tol0
+        for generation in range(ngen):
+            draws, scores = [], []
+            nfailed = 0
+            for attempt in range(1 + (max_retries if particles is None else 0)):
+                batch = []
+                while len(batch) < nparticles - len(draws):
+                    if particles is None:
+                        params = dict(self.current)
+                        for key in free:
+                            params[key] = priors[key].rvs()
+                        z = [math.log(params[key]) if is_log else params[key]
+                             for key, is_log in zip(free, logscale)]
+                    else:
+                        # perturbation kernel of the chosen particle, truncated to bounds
+                        j = min(np.searchsorted(cumweights, random.random()), len(particles)-1)
+                        params = None
+                        while params is None or not in_bounds(params):
+                            z = np.random.normal(particles[j], scale)
+                            params = to_params(z)
+                    if in_bounds(params):
+                        batch.append((z, params))
+
+                batch_scores = self.evaluate_pool(pool, [params for _, params in batch])
+                nfailed += batch_scores.count(None)
+                if particles is None:
+                    # failed prior draws would get zero weight, so draw them again
+                    batch = [draw for draw, score in zip(batch, batch_scores) if score is not None]
+                    batch_scores = [score for score in batch_scores if score is not None]
+                draws += batch
+                scores += batch_scores
+                if len(draws) == nparticles:
+                    break
+
+            if not draws:
+                print 'ERROR: all simulations failed in generation', generation
+                pool.terminate()
+                sys.exit()
+
+            z = np.array([z for z, _ in draws], dtype=float)
+            log_w = []
+            for (_, params), row, score in zip(draws, z, scores):
+                if score is None:
+                    log_w.append(float('-inf'))  # failed simulation
+                    continue
+                lw = -2.*(1.-score)/tol
+                if particles is not None:
+                    # prior density on natural scale, proposal density on transformed scale
+                    lw += sum(priors[key].logpdf(params[key]) for key in free)
+                    lw += row[logscale].sum()
+                    kern = np.exp(-0.5 * (((row - particles) / scale)**2).sum(axis=1))
+                    lw -= math.log((kern / mass).dot(weights))
+                log_w.append(lw)
+
+            log_w = np.array(log_w)
+            if np.all(np.isinf(log_w)):
+                print 'ERROR: all simulations failed in generation', generation
+                pool.terminate()
+                sys.exit()
+            new_weights = np.exp(log_w - log_w.max())
+            new_weights /= new_weights.sum()
+            ess = 1. / (new_weights**2).sum()
+
+            print 'generation %d\ttol %g\tESS %1.1f' % (generation, tol, ess)
+            logfile.write('# generation %d: tol=%g ess=%1.1f failed=%d\n' % (
+                          generation, tol, ess, nfailed))
+            self.log_score_error(logfile, 'generation %d' % generation)
+            for (_, params), score, weight in zip(draws, scores, new_weights):
+                if score is None:
+                    continue
+                logfile.write('\t'.join(map(str, [generation, score, weight] + [params[k] for k in keys])))
+                logfile.write('\n')
+            logfile.flush()
+
+            keep = new_weights > 0
+            particles = z[keep]
+            weights = new_weights[keep]
+            cumweights = np.cumsum(weights)
+            mean = weights.dot(particles)
+            scale = np.sqrt(2. * weights.dot((particles - mean)**2))
+            scale[scale == 0] = 1e-6  # collapsed dimension
+            # probability that the perturbation kernel of each particle falls within bounds
+            mass = (stats.norm.cdf((upper - particles) / scale) -
+                    stats.norm.cdf((lower - particles) / scale)).prod(axis=1)
+
+            # tolerance of the next generation, from the weighted distances of this one
+            distances = np.array([1. - score if score is not None else 1. for score in scores])
+            order = np.argsort(distances)
+            cum = np.cumsum(new_weights[order])
+            tol = max(mintol, min(tol, distances[order][min(np.searchsorted(cum, quantile), len(cum)-1)]))
+
+        pool.close()
+        pool.join()
+
+    def abc_tempering(self, logfile, nchains=4, ratio=2., nworkers=1, swap_interval=1,
+                      max_steps=1e5, tol0=0.01, mintol=0.0005, decay=0.0025, skip=1, first_step=0):
+        """
+        Parallel tempering ABC-MCMC over a ladder of tolerances: chain i
+        runs at [ratio]**i times the annealed tolerance of abc_mcmc, so
+        that hot chains move freely and pass good states down to the cold
+        chain (i = 0) by swaps of adjacent chains every [swap_interval] steps.
+        With [ratio] = 1 the chains are independent replicates without
+        swaps, and convergence diagnostics include R-hat across chains.
+
+        Chain states are kept in this process; at each step, the proposals
+        of all chains are evaluated by one pool of [nworkers] forked
+        processes, which bounds the total number of simulation processes.
+        Only the cold chain is written to the log, as rows of abc_mcmc.
+        """
+        keys = self.current.keys()
+        keys.sort()
+
+        self.write_header(logfile, tol0, mintol, decay)
+        logfile.write('# parallel tempering: nchains=%d ratio=%g swap=%d\n' % (nchains, ratio, swap_interval))
+
+        # forked workers inherit target trees and simulation settings
+        pool = mp.Pool(nworkers, initializer=_init_eval_worker, initargs=(self,))
+
+        print 'calculating initial kernel score'
+        states = [dict(self.current) for _ in range(nchains)]
+        scores = [self.evaluate()] * nchains
+        if scores[0] is None:
+            print 'ERROR: failed to simulate trees under initial parameter values.'
+            pool.terminate()
+            sys.exit()
+        print scores[0]
+
+        step = first_step  # in case of restarting chain
+        nswaps = [0] * (nchains - 1)  # accepted swaps per adjacent pair
+        ncold = nchains if ratio == 1 else 1  # chains at the target tolerance
+        diagnostics, burnin = self.start_diagnostics(ncold, tol0, mintol, decay)
+        ntried = [0] * (nchains - 1)
+        logfile.write('\t'.join(['state', 'score', 'prior'] + keys))
+        logfile.write('\n')
+        logfile.flush()
+
+        while step < max_steps:
+            # adjust tolerance, simulated annealing
+            tol = (tol0 - mintol) * math.exp(-1. * decay * step) + mintol
+            tols = [tol * ratio**i for i in range(nchains)]
+
+            proposals = []
+            for state in states:
+                self.proposal(base=state)
+                proposals.append(dict(self.proposed))
+            next_scores = self.evaluate_pool(pool, proposals)
+
+            # Metropolis update of each chain at its own tolerance; failed
+            # simulations are rejected
+            for i in range(nchains):
+                log_ratio = (self.log_weight(proposals[i], next_scores[i], tols[i]) -
+                             self.log_weight(states[i], scores[i], tols[i]))
+                if i == 0:
+                    accept_prob = math.exp(min(0., log_ratio))
+                if math.log(1. - random.random()) < log_ratio:
+                    states[i] = proposals[i]
+                    scores[i] = next_scores[i]
+
+            swapped = ''
+            if nchains > 1 and ratio != 1 and step % swap_interval == 0:
+                # propose to swap a random adjacent pair; priors cancel
+                i = random.randint(0, nchains - 2)
+                log_ratio = 2. * (scores[i+1] - scores[i]) * (1./tols[i] - 1./tols[i+1])
+                ntried[i] += 1
+                if math.log(1. - random.random()) < log_ratio:
+                    states[i], states[i+1] = states[i+1], states[i]
+                    scores[i], scores[i+1] = scores[i+1], scores[i]
+                    nswaps[i] += 1
+                    swapped = '\t(swap %d-%d)' % (i, i+1)
+
+            self.current.update(states[0])
+            self.proposed.update(states[0])
+            log_prior = self.log_priors()
+
+            # screen log
+            to_screen = '%d\t%1.5f\t%1.5f\t%1.5f\t' % (step, scores[0], log_prior['proposal'], accept_prob)
+            to_screen += '\t'.join(map(lambda x: str(round(x, 5)), [self.current[k] for k in keys]))
+            print to_screen + swapped
+
+            if (step + 1) % 100 == 0:
+                self.log_score_error(logfile, 'state %d' % step)
+
+            if nchains > 1 and ratio != 1 and (step + 1) % 100 == 0:
+                logfile.write('# swap acceptance at state %d: %s\n' % (step, ' '.join(
+                    '%d-%d=%d/%d' % (i, i+1, nswaps[i], ntried[i]) for i in range(nchains - 1))))
+
+            if step % skip == 0:
+                logfile.write('\t'.join(map(str, [step, scores[0], log_prior['proposal']] + [self.current[k] for k in keys])))
+                logfile.write('\n')
+                logfile.flush()
+
+            if step >= burnin:
+                for i in range(ncold):
+                    diagnostics.add([states[i][k] for k in diagnostics.names[:-1]] + [scores[i]], chain=i)
             step += 1
+            if step % self.diag_interval == 0 and self.diagnose(diagnostics, step - 1, logfile):
+                break
+
+        self.log_score_error(logfile, 'end of chain')
+        pool.close()
+        pool.join()
+
+
+def log_sum_exp(values):
+    top = max(values)
+    if top == float('-inf'):
+        return top
+    return top + math.log(sum(math.exp(v - top) for v in values))
+
+
+def ladderized_terminals(tree):
+    """
+    Tips of a Phylo tree in the order tree.ladderize() would leave them,
+    using explicit stacks instead of Phylo's recursive traversals.
+    The tree is not modified.
+    """
+    ntips = {}
+    stack = [(tree.root, False)]
+    while stack:
+        clade, expanded = stack.pop()
+        if not clade.clades:
+            ntips[id(clade)] = 1
+        elif expanded:
+            ntips[id(clade)] = sum(ntips[id(c)] for c in clade.clades)
+        else:
+            stack.append((clade, True))
+            stack.extend((c, False) for c in clade.clades)
+
+    tips = []
+    stack = [tree.root]
+    while stack:
+        clade = stack.pop()
+        if not clade.clades:
+            tips.append(clade)
+        else:
+            # stable sort by tip count as ladderize(), pushed in reverse
+            stack.extend(reversed(sorted(clade.clades, key=lambda c: ntips[id(c)])))
+    return tips
+
+
+# Kamphir copy in each evaluation worker, inherited when the pool forks
+_eval_kamphir = None
+
+def _init_eval_worker(kam):
+    global _eval_kamphir
+    # kernel pool threads do not survive the fork, so score in this process
+    kam.kernel_pool = None
+    # forked workers inherit the random state of numpy (used by coalescent.py)
+    # and of R, so every worker would simulate the same trees
+    seed = (os.getpid() ^ int(time.time()*1e6)) & 0xffffffff
+    np.random.seed(seed)
+    # an R cluster inherited from the parent must not be shared by workers
+    simulator = getattr(kam.simfunc, 'im_self', None)
+    if hasattr(simulator, 'reset_worker'):
+        simulator.reset_worker(seed)
+    # keep files for external simulations apart from other workers
+    pid = os.getpid()
+    kam.path_to_input_csv = '/tmp/input_%d.csv' % pid
+    kam.path_to_label_csv = '/tmp/tips_%d.csv' % pid
+    kam.path_to_output_nwk = '/tmp/output_%d.nwk' % pid
+    _eval_kamphir = kam
+
+def _evaluate_params(params):
+    _eval_kamphir.proposed.update(params)
+    return _eval_kamphir.evaluate(), _eval_kamphir.max_score_error
 
 if __name__ == '__main__':
     import argparse
@@ -502,6 +1243,15 @@ if __name__ == '__main__':
     parser.add_argument('-driver', choices=['Rscript', 'python'],
                         help='Driver for executing script.')
 
+    # Rcolgem settings
+    parser.add_argument('-simulator', default='rcolgem', choices=['rcolgem', 'python'],
+                        help='Simulate trees of the model with Rcolgem in R, or with the structured '
+                             'coalescent in coalescent.py, which does not require R.')
+    parser.add_argument('-precheck', action='store_true',
+                        help='Solve the model ODE in Python first, and only call Rcolgem if the '
+                             'number of infected at the last sample is not less than the number of tips.  '
+                             'Implied by (-simulator python).')
+
     # log settings
     parser.add_argument('-skip', default=1, help='Number of steps in ABC-MCMC to skip for log.')
     parser.add_argument('-overwrite', action='store_true', help='Allow overwrite of log file.')
@@ -531,6 +1281,44 @@ if __name__ == '__main__':
                         help='Perform component-wise update; otherwise full-dimensional '
                              'Metropolis is the default.')
     parser.add_argument('-prior', action='store_true', help='Use prior distributions.')
+    parser.add_argument('-adaptive', action='store_true',
+                        help='Adaptive Metropolis: learn proposal covariance from the chain and adapt its '
+                             'scale towards a target acceptance rate, per parameter with (-gibbs).  '
+                             'Settings sigmas are used as initial values.')
+    parser.add_argument('-nchains', type=int, default=1,
+                        help='Parallel tempering: number of chains, at tolerances increasing by (-tempratio). '
+                             'Only the coldest chain is logged.')
+    parser.add_argument('-tempratio', type=float, default=2.,
+                        help='Ratio of tolerances of adjacent chains for (-nchains).  If 1, run '
+                             'independent chains without swaps.')
+    parser.add_argument('-swapinterval', type=int, default=1,
+                        help='Number of steps between proposed swaps of adjacent chains for (-nchains).')
+
+    # convergence diagnostics
+    parser.add_argument('-targetess', type=float, default=0.,
+                        help='Stop once the effective sample size of every parameter and the score '
+                             'reaches this value.  Ignored if 0.')
+    parser.add_argument('-targetrhat', type=float, default=0.,
+                        help='Stop once the Gelman-Rubin R-hat of every parameter and the score is below '
+                             'this value, e.g. 1.01.  Requires (-nchains) > 1 with (-tempratio) 1.  Ignored if 0.')
+    parser.add_argument('-diaginterval', type=int, default=100,
+                        help='Number of steps between diagnostics written to the log.')
+    parser.add_argument('-diagburnin', type=int, default=None,
+                        help='Number of steps to discard before computing diagnostics.  Defaults to the '
+                             'step at which annealed tolerance is within 1%% of mintol.')
+
+    # ABC-SMC settings
+    parser.add_argument('-smc', action='store_true',
+                        help='Run population Monte Carlo ABC instead of ABC-MCMC, drawing the first '
+                             'generation from the priors at tolerance (-tol0).')
+    parser.add_argument('-nparticles', type=int, default=100, help='Number of particles per generation for (-smc).')
+    parser.add_argument('-ngen', type=int, default=20, help='Number of generations for (-smc).')
+    parser.add_argument('-smcquantile', type=float, default=0.5,
+                        help='Quantile of the distances (1 - score) of the previous generation used as '
+                             'the tolerance of the next one for (-smc), down to (-mintol).')
+    parser.add_argument('-nworkers', type=int, default=None,
+                        help='Number of processes evaluating particles for (-smc) or chains for (-nchains), '
+                             'each simulating with (-ncores) cores.  Defaults to cpu_count / ncores.')
 
     # kernel settings
     parser.add_argument('-kdecay', default=0.2, type=float,
@@ -541,20 +1329,42 @@ if __name__ == '__main__':
                              'discordance. Lower values penalize more severely.  CAVEAT: if normalize '
                              'is set to "none" then make sure this parameter is scaled to the '
                              'typical branch length of the target tree.')
+    parser.add_argument('-cutoff', default=0., type=float,
+                        help='If > 0, approximate the kernel by skipping node pairs whose Gaussian '
+                             'branch length factor is below this value.  Pays off for small tau.  '
+                             'The largest error bound of a normalized score is written to the log.')
     parser.add_argument('-normalize', default='mean', choices=['none', 'mean', 'median'],
                         help='Scale branch lengths so trees of different lengths can be compared.')
+    parser.add_argument('-engine', default='numpy', choices=['python', 'numpy'],
+                        help='Kernel implementation; "numpy" scores each level of node pairs '
+                             'with array operations and is much faster on large trees.')
 
     # parallelization
     parser.add_argument('-ncores', type=int, default=cpu_count(),
                         help='Number of processes for tree simulation (rcolgem).')
     parser.add_argument('-nthreads', type=int, default=cpu_count(),
                         help='Number of processes for kernel computation.')
+    parser.add_argument('-sequential', action='store_true',
+                        help='Draw the acceptance uniform first and stop simulating a proposal once '
+                             'its mean kernel score is clearly below the resulting threshold.')
+    parser.add_argument('-seqz', type=float, default=3.,
+                        help='z-score of the confidence bound used by -sequential.')
+    parser.add_argument('-seqmin', type=int, default=3,
+                        help='Minimum number of trees per target before -sequential can stop.')
+    parser.add_argument('-delayed', action='store_true',
+                        help='Delayed acceptance: screen proposals with a Gaussian process emulator of '
+                             'the kernel score and only simulate trees for those that pass.')
+    parser.add_argument('-surrogatemin', type=int, default=20,
+                        help='Number of full evaluations needed before -delayed starts screening.')
+    parser.add_argument('-ntries', type=int, default=1,
+                        help='Multiple-try Metropolis: number of proposals per step, each simulated in its '
+                             'own process with (-ncores) cores.')
+    parser.add_argument('-batchsize', type=int, default=None,
+                        help='Number of trees per rcolgem call, scored while the next batch is '
+                             'simulated.  Defaults to ncores if nthreads > 1 or -sequential, otherwise nreps.')
 
     args = parser.parse_args()
 
-    # initialize multiprocessing thread pool at global scope
-    pool = mp.Pool(processes=args.nthreads)
-
     # recover from log file if requested
     if args.restart:
         logfile = open(args.restart, 'rU')
@@ -626,9 +1436,12 @@ if __name__ == '__main__':
             print 'Error: Must specify (-script) if (-model) is "*".'
             sys.exit()
         # simfunc remains set to None
+    elif args.simulator == 'python':
+        import coalescent
+        simfunc = coalescent.Simulator(args.model).simulate_trees
     else:
         import rcolgem
-        r = rcolgem.Rcolgem(ncores=args.ncores, nreps=args.nreps)
+        r = rcolgem.Rcolgem(ncores=args.ncores, nreps=args.nreps, edges=True)
         if args.model == 'SI':
             r.init_SI_model()
             simfunc = r.simulate_SI_trees
@@ -646,6 +1459,37 @@ if __name__ == '__main__':
             print 'Currently only SI, SI2, DiffRisk, and Stages are supported..'
             sys.exit()
 
+    if args.smc and args.restart:
+        print 'ERROR: (-restart) is only supported for ABC-MCMC.'
+        sys.exit()
+
+    if args.ntries > 1 and (args.sequential or args.delayed):
+        print 'ERROR: (-ntries) cannot be combined with (-sequential) or (-delayed).'
+        sys.exit()
+
+    if args.targetrhat > 0 and (args.nchains < 2 or args.tempratio != 1):
+        print 'ERROR: (-targetrhat) requires (-nchains) > 1 and (-tempratio) 1.'
+        sys.exit()
+
+    if args.adaptive and (args.smc or args.ntries > 1 or args.nchains > 1):
+        print 'ERROR: (-adaptive) cannot be combined with (-smc), (-ntries) or (-nchains).'
+        sys.exit()
+
+    if args.nchains > 1 and (args.smc or args.ntries > 1 or args.sequential or args.delayed):
+        print 'ERROR: (-nchains) cannot be combined with (-smc), (-ntries), (-sequential) or (-delayed).'
+        sys.exit()
+
+    feasibility = None
+    if args.precheck and simfunc is not None and args.simulator == 'rcolgem':
+        import fgy
+        feasibility = lambda params, tree_height, tip_heights: fgy.feasible(args.model, params, tree_height,
+                                                                            tip_heights)
+
+    surrogate = None
+    if args.delayed:
+        from surrogate import GPSurrogate
+        surrogate = GPSurrogate(min_points=args.surrogatemin)
+
     kam = Kamphir(settings=settings,
                   driver=args.driver,
                   simfunc=simfunc,
@@ -655,26 +1499,70 @@ if __name__ == '__main__':
                   decayFactor=args.kdecay,
                   normalize=args.normalize,
                   gaussFactor=args.tau,
+                  engine=args.engine,
+                  cutoff=args.cutoff,
                   gibbs=args.gibbs,
                   nreps=args.nreps,
+                  batchsize=args.batchsize,
+                  sequential=args.sequential,
+                  seq_z=args.seqz,
+                  seq_min=args.seqmin,
+                  surrogate=surrogate,
+                  ntries=args.ntries,
+                  target_ess=args.targetess,
+                  target_rhat=args.targetrhat,
+                  diag_interval=args.diaginterval,
+                  diag_burnin=args.diagburnin,
+                  adaptive=args.adaptive,
+                  feasibility=feasibility,
                   use_priors=args.prior)
 
     kam.set_target_trees(args.nwkfile, delimiter=args.delimiter, position=args.datefield,
                         treenum=args.treenum)
 
-    # prevent previous log files from being overwritten
-    modifier = ''
-    tries = 0
-    while os.path.exists(args.logfile+modifier) and not args.overwrite:
-        tries += 1
-        modifier = '.%d' % tries
-
-    logfile = open(args.logfile+modifier, 'w')
-    kam.abc_mcmc(logfile,
-                    max_steps=args.maxsteps,
-                    skip=args.skip,
-                    tol0=args.tol0,
-                    mintol=args.mintol,
-                    decay=args.toldecay)
-    logfile.close()
+    # kernel workers started by set_target_trees() must not outlive the run,
+    # even if the sampler is interrupted
+    try:
+        # prevent previous log files from being overwritten
+        modifier = ''
+        tries = 0
+        while os.path.exists(args.logfile+modifier) and not args.overwrite:
+            tries += 1
+            modifier = '.%d' % tries
+
+        logfile = open(args.logfile+modifier, 'w')
+        nworkers = args.nworkers or max(1, cpu_count() // args.ncores)
+        if args.smc:
+            kam.abc_smc(logfile,
+                        nparticles=args.nparticles,
+                        ngen=args.ngen,
+                        nworkers=nworkers,
+                        tol0=args.tol0,
+                        mintol=args.mintol,
+                        quantile=args.smcquantile)
+        elif args.nchains > 1:
+            kam.abc_tempering(logfile,
+                              nchains=args.nchains,
+                              ratio=args.tempratio,
+                              nworkers=nworkers,
+                              swap_interval=args.swapinterval,
+                              max_steps=args.maxsteps,
+                              skip=args.skip,
+                              tol0=args.tol0,
+                              mintol=args.mintol,
+                              decay=args.toldecay)
+        else:
+            kam.abc_mcmc(logfile,
+                            max_steps=args.maxsteps,
+                            skip=args.skip,
+                            tol0=args.tol0,
+                            mintol=args.mintol,
+                            decay=args.toldecay)
+        if simfunc is not None and args.simulator == 'rcolgem':
+            # forked workers (-nworkers) keep their own caches, which are not counted here
+            logfile.write('# ODE solution cache: %s\n' % r.cache_summary())
+        logfile.close()
+    finally:
+        if kam.kernel_pool is not None:
+            kam.kernel_pool.close()
 
@@ -0,0 +1,112 @@
+"""
+Streaming Newick reader that builds CompactTree objects directly, without
+the intermediate Bio.Phylo object graph.  Intended for the large volume of
+simulated trees scored in each ABC-MCMC step.
+"""
+import re
+from compacttree import CompactTree
+
+# quoted label, comment, delimiter, or unquoted label / branch length
+TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;'\[\]]+")
+
+
+class NewickReader(object):
+    """
+    One-pass Newick parser producing CompactTree objects, with optional
+    ladderizing and branch length normalization folded in.
+
+    Trees that cannot be parsed (e.g. truncated output from a simulator)
+    are skipped by parse() and tallied in [nskipped].
+
+    [ladderize] = order children by number of tips as Phylo's ladderize()
+    [normalize] = 'mean', 'median' or 'none', see CompactTree.normalize()
+    """
+
+    def __init__(self, ladderize=True, normalize='none'):
+        self.ladderize = ladderize
+        self.normalize = normalize
+        self.nskipped = 0
+
+    def read(self, text):
+        """
+        Parse a single Newick tree string.  Labels, comments and the root
+        branch length are discarded.
+        :param text: Newick string, with or without terminal semicolon
+        :return: CompactTree
+        :raises ValueError: if the string is not a strictly bifurcating tree
+        """
+        # per internal node in order of closing parenthesis (postorder):
+        # child indices (-1 for tip) and branch lengths
+        left, right, left_bl, right_bl = [], [], [], []
+
+        stack = []  # open clades, each a list of (index, branch length) of children
+        current = None  # last completed clade, as [index, branch length]
+        after_colon = False
+        closed = False
+
+        for token in TOKEN.findall(text):
+            if after_colon:
+                if current is None:
+                    raise ValueError('Branch length without clade')
+                current[1] = float(token)
+                after_colon = False
+            elif token == '(':
+                if current is not None or closed:
+                    raise ValueError('Unexpected open parenthesis')
+                stack.append([])
+            elif token == ',':
+                if current is None or not stack:
+                    raise ValueError('Unexpected comma')
+                stack[-1].append(current)
+                current = None
+            elif token == ')':
+                if current is None or not stack:
+                    raise ValueError('Unexpected close parenthesis')
+                children = stack.pop()
+                children.append(current)
+                if len(children) != 2:
+                    raise ValueError('CompactTree requires a binary tree, found node '
+                                     'with %d children' % len(children))
+                (c1, bl1), (c2, bl2) = children
+                left.append(c1)
+                right.append(c2)
+                left_bl.append(bl1)
+                right_bl.append(bl2)
+                current = [len(left) - 1, 0.]
+                if not stack:
+                    closed = True
+            elif token == ':':
+                after_colon = True
+            elif token == ';':
+                break
+            elif token[0] == '[':
+                continue  # comment
+            elif current is None and not closed:
+                current = [-1, 0.]  # tip label
+            # otherwise internal node label, ignored
+
+        if stack or after_colon or not closed:
+            raise ValueError('Incomplete Newick tree string')
+
+        tree = CompactTree(left, right, left_bl, right_bl)
+        if self.ladderize:
+            tree.ladderize()
+        tree.normalize(self.normalize)
+        return tree
+
+    def parse(self, lines):
+        """
+        Parse one tree per line from an iterable of Newick strings, such as
+        an open file or a list returned by a simulator.  Blank lines are
+        ignored; lines that fail to parse are skipped and counted.
+        :return: generator of CompactTree objects
+        """
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                tree = self.read(line)
+            except ValueError:
+                self.nskipped += 1
+                continue
+            yield tree
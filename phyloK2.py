@@ -3,8 +3,11 @@
 
 from Bio import Phylo
 from numpy import zeros
+import numpy as np
+from compacttree import CompactTree
 import math
 import multiprocessing as mp
+import traceback
 
 class PhyloKernel:
     def __init__(self, 
@@ -18,11 +21,24 @@ class PhyloKernel:
                 withLengths=True, 
                 decayFactor=0.1, 
                 verbose=False, 
-                resolve_poly=False):
+                resolve_poly=False,
+                engine='python',
+                cutoff=0.):
         """
         requires a list of Phylo.Tree objects
         can cast iterator returned by Phylo.parse() as list
+
+        engine = 'python' for the node-by-node loop of kernel_compact(),
+            'numpy' for the level-batched kernel_numpy()
+        cutoff = if > 0, use kernel_approx() and skip node pairs whose
+            Gaussian branch length factor is below this value
         """
+        if engine not in ('python', 'numpy'):
+            raise ValueError('Unrecognized kernel engine %r' % (engine, ))
+        if not 0 <= cutoff < 1:
+            raise ValueError('cutoff must be in [0, 1)')
+        self.engine = engine
+        self.cutoff = cutoff
         self.resolve_poly = resolve_poly
         self.normalize = normalize
         
@@ -102,7 +118,10 @@ class PhyloKernel:
         This helps us compare trees of different overall size.
         Ignore the root as its branch length is meaningless.
         """
-        
+        if isinstance(t, CompactTree):
+            t.normalize(mode)
+            return
+
         # compute number of branches in tree
         branches = t.get_nonterminals() + t.get_terminals()
         nbranches = len(branches) - 1
@@ -131,6 +150,10 @@ class PhyloKernel:
         """
         Add annotations to Clade objects in place
         """
+        if isinstance(t, CompactTree):
+            t.annotate()
+            return
+
         for tip in t.get_terminals():
             tip.production = 0
         for i, node in enumerate(t.get_nonterminals(order='postorder')):
@@ -141,6 +164,16 @@ class PhyloKernel:
             branch_lengths = [c.branch_length for c in node.clades]
             node.sqbl = sum([bl**2 for bl in branch_lengths])
 
+    def prepare_tree(self, tree):
+        """
+        Ladderize a Phylo.Tree, convert it to a CompactTree and normalize
+        its branch lengths.  CompactTree objects are assumed to be prepared
+        already and are returned unchanged.
+        """
+        if isinstance(tree, CompactTree):
+            return tree
+        return CompactTree.from_phylo(tree, ladderize=True, normalize=self.normalize)
+
     def compute_matrix(self):
         for i in range(self.ntrees):
             for j in range(i, self.ntrees):
@@ -151,7 +184,7 @@ class PhyloKernel:
         
         self.is_kmat_computed = True
 
-    def kernel(self, t1, t2, myrank=None, nprocs=None, output=None):
+    def kernel(self, t1, t2, output=None):
         """
         Recursive function for computing tree convolution
         kernel.  Adapted from Moschitti (2006) Making tree kernels
@@ -159,6 +192,19 @@ class PhyloKernel:
         11th Conference of the European Chapter of the Association 
         for Computational Linguistics.
         """
+        if (self.cutoff > 0 or self.engine == 'numpy' or
+                isinstance(t1, CompactTree) or isinstance(t2, CompactTree)):
+            if self.cutoff > 0:
+                k = self.kernel_approx(t1, t2)[0]
+            elif self.engine == 'numpy':
+                k = self.kernel_numpy(t1, t2)
+            else:
+                k = self.kernel_compact(t1, t2)
+            if output is None:
+                return k
+            output.put(k)
+            return
+
         nodes1 = t1.get_nonterminals(order='postorder')
         nodes2 = t2.get_nonterminals(order='postorder')
         k = 0
@@ -167,67 +213,678 @@ class PhyloKernel:
         if not hasattr(nodes2[0], 'production'):
             self.annotate_tree(t2)
 
-        dp_matrix = [[0 for n2 in nodes2] for n1 in nodes1]
-        
+        # only nodes with the same production can match, so bucket t2
+        # by production (keeping postorder) and enumerate matching pairs only
+        buckets2 = {}
+        rank2 = [0] * len(nodes2)
+        for n2 in nodes2:
+            bucket = buckets2.setdefault(n2.production, [])
+            rank2[n2.index] = len(bucket)
+            bucket.append(n2)
+
+        # sparse DP: row for n1 holds only the nodes of its bucket in t2,
+        # and is released once the parent of n1 has read it
+        dp_rows = [None] * len(nodes1)
+
         # iterate over non-terminals, visiting children before parents
-        for ni, n1 in enumerate(nodes1):
-            if myrank is not None and nprocs and ni % nprocs != myrank:
-                continue
-
-            for n2 in nodes2:
-                if n1.production == n2.production:
-                    bl1 = [c1.branch_length for c1 in n1.clades]
-                    bl2 = [c2.branch_length for c2 in n2.clades]
-                    try:
-                        res = self.decayFactor * math.exp( -1. / self.gaussFactor
-                            * (n1.sqbl + n2.sqbl - 2*sum([(bl1[i]*bl2[i]) for i in range(len(bl1))])))
-                    except:
-                        raise
-
-                    for cn1 in range(2):
-                        c1 = n1.clades[cn1]
-                        c2 = n2.clades[cn1]
-                        
-                        if c1.production != c2.production:
-                            continue
-                        
-                        if c1.production == 0:
-                            # branches are terminal
-                            res *= self.sigma + self.decayFactor
-                        else:
-                            res *= self.sigma + dp_matrix[c1.index][c2.index]
-            
-                    dp_matrix[n1.index][n2.index] = res
-                    k += res
+        for n1 in nodes1:
+            bucket = buckets2.get(n1.production, ())
+            dp_row = [0] * len(bucket)
+            for r, n2 in enumerate(bucket):
+                bl1 = [c1.branch_length for c1 in n1.clades]
+                bl2 = [c2.branch_length for c2 in n2.clades]
+                try:
+                    res = self.decayFactor * math.exp( -1. / self.gaussFactor
+                        * (n1.sqbl + n2.sqbl - 2*sum([(bl1[i]*bl2[i]) for i in range(len(bl1))])))
+                except:
+                    raise
+
+                for cn1 in range(2):
+                    c1 = n1.clades[cn1]
+                    c2 = n2.clades[cn1]
+
+                    if c1.production != c2.production:
+                        continue
+
+                    if c1.production == 0:
+                        # branches are terminal
+                        res *= self.sigma + self.decayFactor
+                    else:
+                        res *= self.sigma + dp_rows[c1.index][rank2[c2.index]]
+
+                dp_row[r] = res
+                k += res
+
+            dp_rows[n1.index] = dp_row
+            for c1 in n1.clades:
+                if c1.production != 0:
+                    dp_rows[c1.index] = None
 
         if output is None:
             return k
 
         output.put(k)
 
-    def kernel_parallel(self, t1, t2, nthreads):
+    def kernel_bounded(self, t1, t2):
+        """
+        Kernel score with an upper bound on the mass dropped by
+        kernel_approx(), so that k <= exact kernel <= k + dropped.
+        :return: tuple (k, dropped); dropped is 0 unless self.cutoff > 0
+        """
+        if self.cutoff > 0:
+            return self.kernel_approx(t1, t2)
+        return self.kernel(t1, t2), 0.
+
+    def kernel_compact(self, t1, t2):
+        """
+        Same computation as kernel(), reading node data from the parallel
+        arrays of CompactTree objects instead of Clade attributes.
+        Phylo.Tree arguments are converted first (they must already be
+        ladderized and normalized).
+        """
+        if not isinstance(t1, CompactTree):
+            t1 = CompactTree.from_phylo(t1)
+        if not isinstance(t2, CompactTree):
+            t2 = CompactTree.from_phylo(t2)
+
+        prod1, sqbl1, lbl1, rbl1, children1 = t1.as_lists()[:5]
+        _, sqbl2, lbl2, rbl2, children2, buckets2, rank2 = t2.as_lists()
+
+        tip_factor = self.sigma + self.decayFactor
+        k = 0
+
+        # sparse DP: row i holds the pairs of node i with its bucket in t2,
+        # and is released once the parent of node i has read it
+        dp_rows = [None] * t1.nnodes
+
+        # iterate over non-terminals, visiting children before parents,
+        # and enumerate only pairs with matching productions
+        for i, p1 in enumerate(prod1):
+            bucket = buckets2[p1]
+            dp_row = [0] * len(bucket)
+            for r, j in enumerate(bucket):
+                res = self.decayFactor * math.exp( -1. / self.gaussFactor
+                    * (sqbl1[i] + sqbl2[j] - 2*(lbl1[i]*lbl2[j] + rbl1[i]*rbl2[j])))
+
+                for (c1, cp1), (c2, cp2) in zip(children1[i], children2[j]):
+                    if cp1 != cp2:
+                        continue
+                    if cp1 == 0:
+                        # branches are terminal
+                        res *= tip_factor
+                    else:
+                        res *= self.sigma + dp_rows[c1][rank2[c2]]
+
+                dp_row[r] = res
+                k += res
+
+            dp_rows[i] = dp_row
+            for c1, cp1 in children1[i]:
+                if cp1 != 0:
+                    dp_rows[c1] = None
+
+        return k
+
+    def kernel_numpy(self, t1, t2):
+        """
+        Vectorized version of kernel_compact().  Nodes of t1 are taken in
+        levels of equal height, and each level is scored against every node
+        of t2 at once, so that all child DP entries a level reads were filled
+        by earlier levels.  Agrees with kernel() up to floating-point
+        rounding in the order of summation.
+        """
+        if not isinstance(t1, CompactTree):
+            t1 = CompactTree.from_phylo(t1)
+        if not isinstance(t2, CompactTree):
+            t2 = CompactTree.from_phylo(t2)
+
+        # sparse DP: one block per production holding only matching pairs,
+        # addressed by the rank of each node within its bucket
+        buckets1, buckets2 = t1.buckets(), t2.buckets()
+        blocks = dict((p, np.zeros((len(buckets1[p]), len(buckets2[p])))) for p in buckets1)
+
+        k = 0.
+        for groups in t1.level_groups():
+            for p, rows in groups:
+                k += self.score_block(t1, t2, p, rows, blocks)
+
+        return k
+
+    def score_columns(self, t1, t2, cols, blocks):
+        """
+        Fill the DP entries pairing every internal node of t1 with the
+        internal nodes [cols] of t2, in place, taking t1 in levels.  Entries
+        for matching descendants of [cols] that are not in [cols] must
+        already have been scored.
+
+        :param cols: index array of internal nodes in t2, in postorder
+        :param blocks: dict of DP blocks keyed by production, as in kernel_numpy()
+        :return: sum of the new DP entries
+        """
+        k = 0.
+        cols_by_production = dict((p, cols[t2.production[cols] == p]) for p in (1, 2, 3))
+        for groups in t1.level_groups():
+            for p, rows in groups:
+                if len(cols_by_production[p]) > 0:
+                    k += self.score_block(t1, t2, p, rows, blocks, cols=cols_by_production[p])
+        return k
+
+    def score_block(self, t1, t2, p, rows, blocks, decay=None, gauss=None, cols=None):
+        """
+        Merge-join step of kernel_numpy() for internal nodes [rows] of t1
+        that all have production [p], against the bucket of t2 sharing it.
+
+        :param decay, gauss: arrays of settings for kernel_multi(), in which
+            case DP blocks and the returned sum have a trailing settings axis;
+            default to self.decayFactor and self.gaussFactor
+        :param cols: part of the bucket of t2 to score against, as in
+            score_columns(); defaults to the whole bucket
+        """
+        whole = cols is None
+        if whole:
+            cols = t2.buckets()[p]
+        if len(cols) == 0:
+            return 0.
+
+        if decay is None:
+            decay, gauss = self.decayFactor, self.gaussFactor
+        tip_factor = self.sigma + decay
+        ranks1, ranks2 = t1.ranks(), t2.ranks()
+        rows2d = rows[:, np.newaxis]
+
+        # Gaussian penalty on branch length discordance for all pairs in block
+        dot = t1.left_bl[rows2d] * t2.left_bl[cols] + t1.right_bl[rows2d] * t2.right_bl[cols]
+        dist = t1.sqbl[rows2d] + t2.sqbl[cols] - 2*dot
+        if np.ndim(decay) > 0:
+            # distances are shared by all settings
+            dist = dist[..., np.newaxis]
+        res = decay * np.exp(-1. / gauss * dist)
+
+        for c1, cp1, c2, cp2 in ((t1.left, t1.left_production, t2.left, t2.left_production),
+                                 (t1.right, t1.right_production, t2.right, t2.right_production)):
+            c1, cp1, c2, cp2 = c1[rows], cp1[rows], c2[cols], cp2[cols]
+            factor = np.ones(res.shape)
+            # pairs of children with the same production q
+            for q in (0, 1, 2, 3):
+                ri = np.flatnonzero(cp1 == q)
+                ci = np.flatnonzero(cp2 == q)
+                if len(ri) == 0 or len(ci) == 0:
+                    continue
+                if q == 0:
+                    # branches are terminal
+                    factor[np.ix_(ri, ci)] = tip_factor
+                else:
+                    factor[np.ix_(ri, ci)] = self.sigma + blocks[q][np.ix_(ranks1[c1[ri]],
+                                                                           ranks2[c2[ci]])]
+            res *= factor
+
+        if whole:
+            blocks[p][ranks1[rows]] = res
+        else:
+            blocks[p][np.ix_(ranks1[rows], ranks2[cols])] = res
+        return res.sum(axis=(0, 1))
+
+    def kernel_multi(self, t1, t2, decayFactors, gaussFactors):
+        """
+        Evaluate kernel_numpy() for several settings of decayFactor and
+        gaussFactor in one pass.  Node pairs, their matching and branch
+        length distances are computed once; only the Gaussian, decay and
+        DP products are repeated per setting.
+
+        :param decayFactors: sequence of decay factors
+        :param gaussFactors: sequence of Gaussian precisions, same length
+        :return: NumPy array of kernel scores, one per setting
+        """
+        decay = np.asarray(decayFactors, dtype=np.float64)
+        gauss = np.asarray(gaussFactors, dtype=np.float64)
+        if decay.ndim != 1 or decay.shape != gauss.shape:
+            raise ValueError('decayFactors and gaussFactors must be sequences of equal length')
+
+        if not isinstance(t1, CompactTree):
+            t1 = CompactTree.from_phylo(t1)
+        if not isinstance(t2, CompactTree):
+            t2 = CompactTree.from_phylo(t2)
+
+        buckets1, buckets2 = t1.buckets(), t2.buckets()
+        blocks = dict((p, np.zeros((len(buckets1[p]), len(buckets2[p]), len(decay))))
+                      for p in buckets1)
+
+        k = np.zeros(len(decay))
+        for groups in t1.level_groups():
+            for p, rows in groups:
+                k += self.score_block(t1, t2, p, rows, blocks, decay, gauss)
+
+        return k
+
+    def pair_bounds(self, t):
+        """
+        Upper bound B[i] on the DP entry of internal node i of t paired with
+        any node of another tree, from the recursion with every Gaussian
+        factor set to its maximum of 1.  Used by kernel_approx().
+        """
+        bounds = np.zeros(t.nnodes)
+        tip_factor = max(1., self.sigma + self.decayFactor)
+        for level in t.levels():
+            res = self.decayFactor * np.ones(len(level))
+            for c, cp in ((t.left[level], t.left_production[level]),
+                          (t.right[level], t.right_production[level])):
+                # pairs of children with different productions contribute a factor 1
+                res *= np.where(cp == 0, tip_factor, np.maximum(1., self.sigma + bounds[c]))
+            bounds[level] = res
+        return bounds
+
+    def kernel_approx(self, t1, t2):
+        """
+        Approximate kernel_numpy() that skips node pairs whose Gaussian
+        branch length factor is below self.cutoff.  Each production bucket
+        of t2 is sorted by left branch length, so that only the window of
+        nodes with |bl1 - bl2| small enough to pass the cutoff is evaluated
+        for each node of t1.
+
+        Skipped pairs are treated as zero.  A second DP, in which skipped
+        pairs take their largest possible value (cutoff times pair_bounds()),
+        gives an upper bound on the exact kernel, so that
+
+            k <= exact kernel <= k + dropped
+
+        Only evaluated pairs are stored in that DP; the value of a skipped
+        pair is recomputed from pair_bounds() when a parent reads it, and
+        the sum over skipped pairs is taken from sorted prefix sums.
+
+        :return: tuple (k, dropped)
+        """
+        if not isinstance(t1, CompactTree):
+            t1 = CompactTree.from_phylo(t1)
+        if not isinstance(t2, CompactTree):
+            t2 = CompactTree.from_phylo(t2)
+
+        buckets1, buckets2 = t1.buckets(), t2.buckets()
+        blocks = dict((p, np.zeros((len(buckets1[p]), len(buckets2[p])))) for p in buckets1)
+        upper = dict((p, np.zeros((len(buckets1[p]), len(buckets2[p])))) for p in buckets1)
+
+        bounds1, bounds2 = self.pair_bounds(t1), self.pair_bounds(t2)
+
+        # sort buckets of t2 by left branch length, and their bounds for prefix sums
+        windows = {}
+        for p, cols in buckets2.iteritems():
+            order = np.argsort(t2.left_bl[cols], kind='mergesort')
+            sorted_bounds = np.sort(bounds2[cols])
+            windows[p] = (order, t2.left_bl[cols][order],
+                          sorted_bounds, np.concatenate(([0.], np.cumsum(sorted_bounds))))
+
+        k = k_upper = 0.
+        for groups in t1.level_groups():
+            for p, rows in groups:
+                res, res_upper = self.score_block_approx(t1, t2, p, rows, blocks, upper, windows[p],
+                                                         bounds1, bounds2)
+                k += res
+                k_upper += res_upper
+
+        return k, max(0., k_upper - k)
+
+    def score_block_approx(self, t1, t2, p, rows, blocks, upper, window, bounds1, bounds2):
+        """
+        Version of score_block() for kernel_approx() that evaluates only the
+        node pairs within the branch length window of each row, and fills
+        the upper bound DP in [upper] alongside [blocks].
+        :return: tuple (sum of new DP entries, sum of new upper bound entries)
+        """
+        cols = t2.buckets()[p]
+        if len(cols) == 0:
+            return 0., 0.
+
+        tip_factor = self.sigma + self.decayFactor
+        ranks1, ranks2 = t1.ranks(), t2.ranks()
+        nrows = len(rows)
+
+        # exp(-d / gaussFactor) < cutoff  <=>  d > max_dist, and d >= (bl1 - bl2)**2
+        max_dist = -self.gaussFactor * math.log(self.cutoff)
+        half_width = math.sqrt(max_dist)
+        order, sorted_bl, sorted_bounds, cum_bounds = window
+        lo = np.searchsorted(sorted_bl, t1.left_bl[rows] - half_width, side='left')
+        hi = np.searchsorted(sorted_bl, t1.left_bl[rows] + half_width, side='right')
+        counts = hi - lo
+
+        # flatten the windows into candidate pairs (ri = row in block, ci = rank in bucket)
+        ri = np.repeat(np.arange(nrows), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ci = order[np.repeat(lo, counts) + offsets]
+        r1, c2 = rows[ri], cols[ci]
+
+        dist = t1.sqbl[r1] + t2.sqbl[c2] - 2*(t1.left_bl[r1] * t2.left_bl[c2] +
+                                              t1.right_bl[r1] * t2.right_bl[c2])
+        gauss = np.exp(-1. / self.gaussFactor * dist)
+        keep = gauss >= self.cutoff
+        ri, ci, r1, c2, gauss = ri[keep], ci[keep], r1[keep], c2[keep], gauss[keep]
+
+        res = self.decayFactor * gauss
+        res_upper = res.copy()
+        for c1, cp1, cc2, cp2 in ((t1.left, t1.left_production, t2.left, t2.left_production),
+                                  (t1.right, t1.right_production, t2.right, t2.right_production)):
+            c1, cp1, cc2, cp2 = c1[r1], cp1[r1], cc2[c2], cp2[c2]
+            factor = np.ones(len(r1))
+            factor_upper = np.ones(len(r1))
+            factor[(cp1 == 0) & (cp2 == 0)] = tip_factor
+            factor_upper[(cp1 == 0) & (cp2 == 0)] = tip_factor
+            for q in (1, 2, 3):
+                idx = np.flatnonzero((cp1 == q) & (cp2 == q))
+                if len(idx) == 0:
+                    continue
+                dp_index = (ranks1[c1[idx]], ranks2[cc2[idx]])
+                factor[idx] = self.sigma + blocks[q][dp_index]
+                # skipped child pairs are stored as 0, take their bound instead
+                factor_upper[idx] = self.sigma + np.maximum(
+                    upper[q][dp_index],
+                    self.cutoff * np.minimum(bounds1[c1[idx]], bounds2[cc2[idx]]))
+            res *= factor
+            res_upper *= factor_upper
+
+        block_rows = ranks1[rows]
+        upper[p][block_rows[ri], ci] = res_upper
+        blocks[p][block_rows[ri], ci] = res
+
+        # skipped pairs are bounded by cutoff times the smaller bound of the two nodes:
+        # sum over the whole bucket of min(b1, b2), minus the evaluated pairs
+        b1 = bounds1[rows]
+        nbelow = np.searchsorted(sorted_bounds, b1)
+        skipped = (cum_bounds[nbelow] + b1 * (len(cols) - nbelow)).sum()
+        skipped -= np.minimum(bounds1[r1], bounds2[c2]).sum()
+
+        return res.sum(), res_upper.sum() + self.cutoff * skipped
+
+    def kernel_parallel(self, t1, t2, nthreads, min_pairs=2000000):
         """
-        Wrapper around kernel().
-        Attempt to use Python multiprocessing module to speed up computation.
-        Borrowing code snippets from:
-          http://sebastianraschka.com/Articles/2014_multiprocessing_intro.html
+        Compute one kernel score with several processes.  The internal
+        nodes of t2 are split into groups of whole subtrees (see
+        CompactTree.split), and each worker scores all of t1 against one
+        group with kernel_numpy()'s level loop.  Every DP entry a worker
+        reads pairs descendants in its own group, so workers do not wait
+        for each other.  The DP blocks are kept in shared memory, and the
+        nodes of t2 above the subtrees are scored here once all workers
+        are done.
 
-        :param t1: first Phylo.Tree to be compared
-        :param t2: second Phylo.Tree to be compared
-        :param nthreads: number of threads in pool
+        Starting four workers takes about 0.02 s, about as long as
+        kernel_numpy() on two trees of 1000 tips (1e6 pairs), where it
+        does not pay off; with 4e6 pairs the slowest group plus the
+        spine takes half the time of kernel_numpy() (see tests/testmp.py).
+        Smaller pairs are therefore scored in this process.
+
+        :param t1: first tree (CompactTree or Phylo.Tree) to be compared
+        :param t2: second tree (CompactTree or Phylo.Tree) to be compared
+        :param nthreads: number of worker processes
+        :param min_pairs: use kernel_numpy() if t1 and t2 have fewer pairs
+                          of internal nodes than this
         :return: kernel score (double)
         """
-        # FIXME: this gives the wrong answer
-        output = mp.Queue()
-        processes = [mp.Process(target=self.kernel, args=(t1, t2, i, nthreads, output))
-                     for i in range(nthreads)]
+        if not isinstance(t1, CompactTree):
+            t1 = CompactTree.from_phylo(t1)
+        if not isinstance(t2, CompactTree):
+            t2 = CompactTree.from_phylo(t2)
+
+        if nthreads < 2 or t1.nnodes * t2.nnodes < min_pairs:
+            return self.kernel_numpy(t1, t2)
+
+        # cache tree annotations before forking so workers inherit them
+        t1.level_groups()
+        t1.ranks()
+        t2.ranks()
+        groups, spine = t2.split(nthreads)
+
+        buckets1, buckets2 = t1.buckets(), t2.buckets()
+        shapes = dict((p, (len(buckets1[p]), len(buckets2[p]))) for p in buckets1)
+        shared = dict((p, mp.RawArray('d', shape[0] * shape[1])) for p, shape in shapes.iteritems())
+
+        results = mp.Queue()
+        processes = [mp.Process(target=_subtree_worker, args=(self, t1, t2, shared, shapes, cols, results))
+                     for cols in groups if len(cols) > 0]
         for p in processes:
+            p.daemon = True
             p.start()
 
-        # exit completed processes
-        for p in processes:
-            p.join()
+        k = 0.
+        try:
+            for p in processes:
+                res = results.get()
+                if isinstance(res, str):
+                    raise RuntimeError('kernel_parallel worker failed:\n' + res)
+                k += res
+        finally:
+            for p in processes:
+                p.join()
 
-        # collect results and calculate sum
-        k = sum([output.get() for p in processes])
-        return k
+        # nodes above the subtrees read entries written by every worker
+        blocks = dict((p, np.frombuffer(shared[p]).reshape(shape)) for p, shape in shapes.iteritems())
+        return k + self.score_columns(t1, t2, spine, blocks)
+
+
+class PreparedTarget:
+    def __init__(self, kernel, tree):
+        """
+        Reference tree that is scored against many simulated trees.
+        Target-side data (node arrays, levels, production buckets and their
+        list forms) is computed once here and reused by every kernel call.
+
+        :param kernel: PhyloKernel whose settings are used for scoring
+        :param tree: Phylo.Tree or prepared CompactTree
+        """
+        self.kernel = kernel
+        self.tree = kernel.prepare_tree(tree)
+
+        # warm the caches of the target tree
+        self.tree.level_groups()
+        self.tree.ranks()
+        if kernel.engine == 'python':
+            self.tree.as_lists()
+
+        # kernel score of target to itself, and bound on its error if approximated
+        self.ref_denom, self.ref_dropped = kernel.kernel_bounded(self.tree, self.tree)
+        self.ref_denoms = {}  # same, for settings passed to score_multi()
+
+    def score(self, tree):
+        """
+        Normalized kernel score of one tree against the target.
+        """
+        return self.score_bounded(tree)[0]
+
+    def score_bounded(self, tree):
+        """
+        Normalized kernel score of one tree against the target, with a
+        bound on its error from the approximate kernel (PhyloKernel.cutoff).
+        Each of the three kernel values lies between its approximation k
+        and k + dropped, and the exact normalized score is at most 1, so
+        the exact score lies within [error] of the returned score.
+        :return: tuple (score, error); error is 0 for the exact kernel
+        """
+        tree = self.kernel.prepare_tree(tree)
+        k, dropped = self.kernel.kernel_bounded(self.tree, tree)
+        tree_denom, tree_dropped = self.kernel.kernel_bounded(tree, tree)
+        score = math.exp(math.log(k) - 0.5*(math.log(self.ref_denom) + math.log(tree_denom)))
+        if dropped == 0 and tree_dropped == 0 and self.ref_dropped == 0:
+            return score, 0.
+        upper = min(1., (k + dropped) / math.sqrt(self.ref_denom * tree_denom))
+        lower = k / math.sqrt((self.ref_denom + self.ref_dropped) * (tree_denom + tree_dropped))
+        return score, max(upper - score, score - lower, 0.)
+
+    def score_multi(self, tree, decayFactors, gaussFactors):
+        """
+        Normalized kernel scores of one tree against the target for several
+        kernel settings at once (see PhyloKernel.kernel_multi).
+        :return: NumPy array of scores, one per setting
+        """
+        key = (tuple(decayFactors), tuple(gaussFactors))
+        if key not in self.ref_denoms:
+            self.ref_denoms[key] = self.kernel.kernel_multi(self.tree, self.tree,
+                                                            decayFactors, gaussFactors)
+        ref_denom = self.ref_denoms[key]
+
+        tree = self.kernel.prepare_tree(tree)
+        k = self.kernel.kernel_multi(self.tree, tree, decayFactors, gaussFactors)
+        tree_denom = self.kernel.kernel_multi(tree, tree, decayFactors, gaussFactors)
+        return np.exp(np.log(k) - 0.5*(np.log(ref_denom) + np.log(tree_denom)))
+
+    def score_batch(self, trees):
+        """
+        Normalized kernel scores of a list of trees, such as the replicates
+        simulated in one step, against the target.
+        :return: list of (score, error) tuples, see score_bounded()
+        """
+        return [self.score_bounded(tree) for tree in trees]
+
+
+def _subtree_worker(kernel, t1, t2, shared, shapes, cols, results):
+    """
+    Worker for PhyloKernel.kernel_parallel().  Scores t1 against the
+    internal nodes [cols] of t2 into the shared DP blocks.
+    """
+    blocks = dict((p, np.frombuffer(shared[p]).reshape(shape)) for p, shape in shapes.iteritems())
+    try:
+        results.put(kernel.score_columns(t1, t2, cols, blocks))
+    except:
+        results.put(traceback.format_exc())
+
+
+class TreeArena:
+    def __init__(self, capacity):
+        """
+        Flat shared-memory arrays holding the internal nodes of a batch of
+        simulated trees back to back, so kernel workers can read them in
+        place instead of receiving pickles.  Worker processes only see an
+        arena that existed when they were forked.
+
+        :param capacity: total number of internal nodes that fit
+        """
+        self.capacity = capacity
+        self.end = 0  # first free node slot
+        size = max(capacity, 1)
+        self.shared = (mp.RawArray('i', size), mp.RawArray('i', size),
+                       mp.RawArray('d', size), mp.RawArray('d', size))
+        self.left, self.right = [np.frombuffer(a, dtype=np.int32) for a in self.shared[:2]]
+        self.left_bl, self.right_bl = [np.frombuffer(a) for a in self.shared[2:]]
+
+    def reset(self):
+        """
+        Reuse the arena from the start, overwriting trees stored so far.
+        """
+        self.end = 0
+
+    def store(self, trees):
+        """
+        Copy trees into the arena after those already stored.
+        :param trees: list of CompactTree objects
+        :return: list of (offset, number of internal nodes), one per tree
+        """
+        slots = []
+        offset = self.end
+        for tree in trees:
+            end = offset + tree.nnodes
+            if end > self.capacity:
+                raise ValueError('Trees exceed TreeArena capacity of %d nodes' % self.capacity)
+            self.left[offset:end] = tree.left
+            self.right[offset:end] = tree.right
+            self.left_bl[offset:end] = tree.left_bl
+            self.right_bl[offset:end] = tree.right_bl
+            slots.append((offset, tree.nnodes))
+            offset = end
+        self.end = offset
+        return slots
+
+    def load(self, offset, nnodes):
+        """
+        CompactTree whose node arrays are views into the arena (no copy).
+        """
+        end = offset + nnodes
+        return CompactTree(self.left[offset:end], self.right[offset:end],
+                           self.left_bl[offset:end], self.right_bl[offset:end])
+
+
+class KernelPool:
+    def __init__(self, targets, nthreads, capacity=0):
+        """
+        Long-lived pool of kernel worker processes.  Prepared target trees
+        and kernel settings are handed to each worker once, when the pool
+        is started.  Simulated trees are passed through a shared TreeArena,
+        so tasks only carry an offset into it and return a float.
+
+        Batches of one step are submitted as they are simulated and stored
+        one after the other in the arena; reset() starts the next step.
+
+        :param targets: list of PreparedTarget objects
+        :param nthreads: number of worker processes
+        :param capacity: initial TreeArena size in internal nodes, e.g.
+            number of replicates times the number of tips per tree
+        """
+        self.targets = targets
+        self.nthreads = nthreads
+        self.pool = None
+        self.pending = []  # AsyncResults of batches submitted since reset()
+        self.start(capacity)
+
+    def start(self, capacity):
+        """
+        (Re)start worker processes with a new TreeArena.
+        """
+        if self.pool is not None:
+            self.close()
+        self.arena = TreeArena(capacity)
+        self.pool = mp.Pool(processes=self.nthreads, initializer=_init_pool_worker,
+                            initargs=(self.targets, self.arena))
+
+    def reset(self):
+        """
+        Wait for batches still being scored, then reuse the TreeArena from the start.
+        """
+        for result in self.pending:
+            result.wait()
+        self.pending = []
+        self.arena.reset()
+
+    def submit(self, index, trees):
+        """
+        Score a batch of trees against one target in the background.
+        :param index: position of the target in the list given to __init__
+        :param trees: list of CompactTree objects
+        :return: AsyncResult whose get() returns a list of (score, error) tuples,
+                 in the order of trees, see PreparedTarget.score_bounded()
+        """
+        nnodes = sum(tree.nnodes for tree in trees)
+        if self.arena.end + nnodes > self.arena.capacity:
+            # workers cannot attach to shared memory allocated after the fork,
+            # so restart them once batches in flight are done
+            for result in self.pending:
+                result.wait()
+            self.pending = []
+            self.start(max(nnodes, 2*self.arena.capacity))
+
+        slots = self.arena.store(trees)
+        result = self.pool.map_async(_pool_score, [(index, offset, n) for offset, n in slots])
+        self.pending.append(result)
+        return result
+
+    def score(self, index, trees):
+        """
+        Normalized kernel scores of trees against one target.
+        :return: list of (score, error) tuples as PreparedTarget.score_batch(),
+                 in the order of trees
+        """
+        self.reset()
+        return self.submit(index, trees).get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# target trees and tree arena resident in a KernelPool worker process
+_pool_targets = None
+_pool_arena = None
+
+
+def _init_pool_worker(targets, arena):
+    global _pool_targets, _pool_arena
+    _pool_targets = targets
+    _pool_arena = arena
+
+
+def _pool_score(task):
+    index, offset, nnodes = task
+    return _pool_targets[index].score_bounded(_pool_arena.load(offset, nnodes))
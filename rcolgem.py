@@ -2,21 +2,245 @@ import sys
 from rpy2.rinterface import set_readconsole
 set_readconsole(None)
 
+from collections import OrderedDict
+import numpy as np
 import rpy2.robjects as robjects  # R is instantiated upon load module
 
+
+# Function solving the ODE system defined in its enclosing environment (demes,
+# births, migrations, deaths, nonDemeDynamics) from t0 to t_last, the time of
+# the last sample.  Parameters are passed as named numeric vectors, so values
+# are not rounded by string formatting.
+SOLVE_FGY = """
+function(parms, x0, t_last) {
+    tfgy <- make.fgy( t0, t_last, births, deaths, nonDemeDynamics, x0, migrations=migrations,
+                      parms=as.list(parms), fgyResolution = fgyResolution, integrationMethod = integrationMethod)
+    list(tfgy=tfgy, demes=demes)
+}
+"""
+
+# As SOLVE_FGY, but switching from parms$beta to beta2 at step fgyRes.1
+# of the time grid from t0 to t_end, for the two-phase SI model
+SOLVE_FGY_SI2 = """
+function(parms, x0, t_last, t_end, fgyRes.1, beta2) {
+    parms <- as.list(parms)
+    times <- seq(t0, t_end, length.out=fgyResolution)
+    fgyRes.2 <- fgyResolution - fgyRes.1
+
+    # solve first ODE
+    tfgy.1 <- make.fgy( t0, times[fgyRes.1], births, deaths, nonDemeDynamics, x0,
+                        migrations=migrations, parms=parms, fgyResolution = fgyRes.1,
+                        integrationMethod = integrationMethod )
+
+    # update model parameter with second beta
+    x1 <- tfgy.1[[5]][fgyRes.1, 2:3]
+    parms$beta <- beta2
+
+    # solve second ODE
+    tfgy.2 <- make.fgy( times[fgyRes.1+1], t_last, births, deaths, nonDemeDynamics, x1,
+                        migrations=migrations, parms=parms, fgyResolution = fgyRes.2,
+                        integrationMethod = integrationMethod)
+
+    # reconstitute the entire tfgy
+    tfgy <- list(c(tfgy.2[[1]], tfgy.1[[1]]), c(tfgy.2[[2]], tfgy.1[[2]]),
+                 c(tfgy.2[[3]], tfgy.1[[3]]), c(tfgy.2[[4]], tfgy.1[[4]]),
+                 rbind(tfgy.1[[5]], tfgy.2[[5]]))
+    list(tfgy=tfgy, demes=demes)
+}
+"""
+
+
+def r_vector(items):
+    """
+    Named R numeric vector, e.g. for model parameters or initial values.
+    :param items: list of (name, value) tuples, in the order R expects
+    """
+    vector = robjects.FloatVector([float(value) for _, value in items])
+    vector.names = robjects.StrVector([name for name, _ in items])
+    return vector
+
+
 class Rcolgem ():
-    def __init__ (self, ncores, nreps, t0=0, fgy_resolution=500., integration_method='rk4'):
+    def __init__ (self, ncores, nreps, t0=0, fgy_resolution=500., integration_method='rk4', edges=False,
+                  cache_size=100):
+        """
+        :param edges: if True, simulate() returns the edge arrays of each tree
+                      instead of Newick strings, except with post=True
+        :param cache_size: number of ODE solutions to keep, see solve()
+        """
         # load Rcolgem package
         robjects.r("require(rcolgem, quietly=TRUE)")
 
         # default settings
         robjects.r('n.cores=%d; nreps=%d; fgyResolution=%d; integrationMethod="%s"; t0=%f' % (
             ncores, nreps, fgy_resolution, integration_method, t0))
+        self.nreps = nreps
+        self.fgy_resolution = int(fgy_resolution)
+        self.t0 = float(t0)
+        self.edges = edges
 
         # set up parallelization environment
         robjects.r("require(parallel, quietly=TRUE)")
         robjects.r("cl <- makeCluster(%d, 'FORK')" % (ncores,))
 
+        # common steps of every model, parsed once
+        robjects.r("""
+        finish.setup <- function(solution, sampleTimes, sample.states) {
+            tfgy <- solution$tfgy
+            demes <- solution$demes
+            demes.t.end <- tfgy[[4]][[1]]
+            n.tips <- length(sampleTimes)
+
+            # number of infected individuals at end of simulation must not be less than number of tips
+            feasible <- sum(demes.t.end) >= n.tips
+
+            sampleStates <- matrix(1, nrow=n.tips, ncol=length(demes))
+            colnames(sampleStates) <- demes
+            rownames(sampleStates) <- 1:n.tips
+            if (feasible && sample.states) {
+                # use prevalence of respective infected classes at end of simulation to determine sample states
+                demes.sample <- sample(rep(1:length(demes), times=round(demes.t.end)), size=n.tips)
+                sampleStates <- matrix(0, nrow=n.tips, ncol=length(demes))
+                colnames(sampleStates) <- demes
+                for (i in 1:n.tips) { sampleStates[i, demes.sample[i]] <- 1 }
+                rownames(sampleStates) <- paste(1:n.tips, demes.sample, sep='_')
+            }
+            list(tfgy=tfgy, sampleTimes=sampleTimes, sampleStates=sampleStates, feasible=feasible)
+        }
+        """)
+        self.finish_setup = robjects.r('finish.setup')
+        self.simulate_trees = robjects.r("""
+        function(setup, n.reps, edges=FALSE) {
+            tfgy <- setup$tfgy
+            trees <- simulate.binary.dated.tree.fgy( tfgy[[1]], tfgy[[2]], tfgy[[3]], tfgy[[4]],
+                                                     setup$sampleTimes, setup$sampleStates,
+                                                     integrationMethod = integrationMethod,
+                                                     n.reps=n.reps, cluster=cl)
+            class(trees) <- 'multiPhylo'
+            if (edges) {
+                # plain vectors, as rpy2 returns matrices flattened
+                lapply(trees, function(tr) list(tr$edge[,1], tr$edge[,2], tr$edge.length))
+            } else {
+                lapply(trees, write.tree)
+            }
+        }
+        """)
+
+        # sampling setup (an R list returned by finish.setup) for the
+        # arguments of the last simulation call
+        self.last_key = None
+        self.setup = None
+        self.feasible = False
+
+        # least recently used ODE solutions first
+        self.cache_size = cache_size
+        self.solutions = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def reset_worker(self, seed):
+        """
+        Prepare a process forked from the one that created this object,
+        e.g. a worker of multiprocessing.Pool.  Workers of the inherited
+        cluster are still connected to the parent, so requests from several
+        processes would interleave on the same sockets.  The connections
+        are closed in this process only (stopCluster would also shut the
+        workers down for the parent), and a new cluster is started.
+        R's random numbers are reseeded, on the cluster too, so that forked
+        processes do not simulate the same trees.
+        :param seed: integer seed, different for each process
+        """
+        seed &= 0x7fffffff  # R integers are signed 32-bit
+        robjects.r("""
+        for (node in cl) close(node$con)
+        cl <- makeCluster(n.cores, 'FORK')
+        set.seed(%d)
+        clusterSetRNGStream(cl, %d)
+        """ % (seed, seed))
+
+    def solve(self, model, solver, parms, x0, ode_args, tree_height, tip_heights, sample_states=False):
+        """
+        Prepare the sampling setup of a simulation call.
+
+        Solutions of the ODE system are cached by the values of [parms],
+        [x0] and [ode_args], which are all that the model's solve function
+        depends on, so that e.g. a Gibbs step that moves a parameter outside
+        of the ODE, or a state revisited by kamphir-post, reuses the
+        solution.  Consecutive calls with the same arguments, e.g. the
+        replicate trees of one step simulated in batches, also reuse the
+        last setup, unless tip states are sampled, which is done anew for
+        each call.
+
+        :param model: name of the model, to keep cache keys apart
+        :param solver: the model's R solve function
+        :param parms: list of (name, value) tuples of the ODE parameters
+        :param x0: list of (name, value) tuples of the initial values
+        :param ode_args: tuple of arguments to [solver] after the time of
+                         the last sample, which is passed first
+        :param sample_states: if True, sample tip states from the prevalence
+                              of each deme at the last sample time
+        """
+        tip_heights = tuple(float(h) for h in tip_heights)  # may be strings for dated tips
+        t_last = float(tree_height) - min(tip_heights)
+        ode_args = (t_last,) + tuple(ode_args)
+        key = (model, tuple(parms), tuple(x0), ode_args, float(tree_height), tip_heights, sample_states)
+        if key == self.last_key and not sample_states:
+            return
+
+        ode_key = key[:4] + (self.fgy_resolution, self.t0)
+        solution = self.solutions.pop(ode_key, None)
+        if solution is None:
+            self.cache_misses += 1
+            solution = solver(r_vector(parms), r_vector(x0), *ode_args)
+        else:
+            self.cache_hits += 1
+        if self.cache_size > 0:
+            self.solutions[ode_key] = solution  # most recently used last
+            if len(self.solutions) > self.cache_size:
+                self.solutions.popitem(last=False)
+
+        sample_times = robjects.FloatVector([float(tree_height) - h for h in tip_heights])
+        self.setup = self.finish_setup(solution, sample_times, sample_states)
+        self.feasible = bool(self.setup.rx2('feasible')[0])
+        self.last_key = key
+
+    def cache_summary(self):
+        """
+        :return: hit rate of the ODE solution cache among calls that did not
+                 reuse the last setup, as a string for logs
+        """
+        total = self.cache_hits + self.cache_misses
+        return 'hits=%d misses=%d rate=%1.3f size=%d' % (
+            self.cache_hits, self.cache_misses, float(self.cache_hits) / total if total else 0.,
+            len(self.solutions))
+
+    def simulate(self, post, nreps):
+        """
+        Simulate trees from the current setup.
+        :return: List of Newick strings, or of (edge, edge_length) NumPy arrays
+                 in ape's numbering if edges=True, see CompactTree.from_edges;
+                 if post=True, then a tuple of ([Newick strings], tfgy)
+        """
+        if not self.feasible:
+            return []
+
+        edges = self.edges and not post
+        try:
+            retval = self.simulate_trees(self.setup, self.nreps if nreps is None else int(nreps), edges)
+        except:
+            return []
+
+        if edges:
+            return [(np.column_stack((np.asarray(tree[0], dtype=np.int32), np.asarray(tree[1], dtype=np.int32))),
+                     np.asarray(tree[2], dtype=np.float64)) for tree in retval]
+
+        # convert R objects into Python strings in Newick format
+        trees = map(lambda x: str(x).split()[-1].strip('" '), retval)
+        if post:
+            return (trees, self.setup.rx2('tfgy').rx2(5))
+        else:
+            return trees
+
     def init_SI_model (self):
         """
         Defines a susceptible-infected-recovered model in rcolgem.
@@ -24,268 +248,117 @@ class Rcolgem ():
         """
 
         # define ODE system - as strings, these will be evaluated with new parameters
-        robjects.r('demes <- c("I")')
+        definitions = """
+            demes <- c("I")
 
-        robjects.r('births <- rbind(c("parms$beta*S*I / (S+I)"))')
-        robjects.r('rownames(births) <- colnames(births) <- demes')
+            births <- rbind(c("parms$beta*S*I / (S+I)"))
+            rownames(births) <- colnames(births) <- demes
 
-        robjects.r('migrations <- rbind(c("0"))')
-        robjects.r('rownames(migrations)=colnames(migrations) <- demes')
+            migrations <- rbind(c("0"))
+            rownames(migrations)=colnames(migrations) <- demes
 
-        robjects.r("deaths <- c('(parms$mu+parms$gamma)*I')")
-        robjects.r('names(deaths) <- demes')
+            deaths <- c('(parms$mu+parms$gamma)*I')
+            names(deaths) <- demes
 
-        robjects.r("nonDemeDynamics <- paste(sep='', '-parms$mu*S + parms$lambd*S + "
-                   "(parms$mu+parms$gamma)*I', '-S*(parms$beta*I) / (S+I)')")
-        robjects.r("names(nonDemeDynamics) <- 'S'")
+            nonDemeDynamics <- paste(sep='', '-parms$mu*S + parms$lambd*S + (parms$mu+parms$gamma)*I',
+                                     '-S*(parms$beta*I) / (S+I)')
+            names(nonDemeDynamics) <- 'S'
+        """
+        self.solve_SI = robjects.r("local({%s\n%s})" % (definitions, SOLVE_FGY))
+        self.solve_SI2 = robjects.r("local({%s\n%s})" % (definitions, SOLVE_FGY_SI2))
 
 
-    def simulate_SI_trees (self, params, tree_height, tip_heights, post=False):
+    def simulate_SI_trees (self, params, tree_height, tip_heights, post=False, nreps=None):
         """
         Simulate coalescent trees under the SI model.
         :param tip_heights:
+        :param nreps: number of trees to simulate, if not the nreps given to __init__
         :return: List of trees; if post=True, then a tuple of ([trees], tfgy)
         """
-        # set parameters
-        robjects.r('N=%f; beta=%f; gamma=%f' % (params['N'], params['beta'], params['gamma']))
-        robjects.r('mu=%f; lambd=%f' % (params['mu'], params.get('lambd', params['mu'])))
-        robjects.r('S = N-1')
-        robjects.r('I = 1')
-        robjects.r('x0 <- c(I=I, S=S)')
-        robjects.r('parms <- list(beta=beta, gamma=gamma, mu=mu, lambd=lambd)')
-
-        robjects.r("n.tips <- %d" % len(tip_heights))
-        robjects.r("tip.heights <- c(%s)" % ','.join(map(str, tip_heights)))
-        robjects.r("t_end <- %f" % (tree_height,))
-
-        robjects.r("sampleTimes <- t_end - tip.heights")
-        robjects.r("sampleStates <- matrix(1, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("rownames(sampleStates) <- 1:n.tips")
-
-        robjects.r("m <- nrow(births)")
-        robjects.r("maxSampleTime <- max(sampleTimes)")
-
-        # solve ODE
-        robjects.r("tfgy <- make.fgy( t0, maxSampleTime, births, deaths, nonDemeDynamics, x0, migrations=migrations, "
-                   "parms=parms, fgyResolution = fgyResolution, integrationMethod = integrationMethod)")
-
-        n_inf = robjects.r("tfgy[[4]][[1]]")[0]
-        if n_inf < len(tip_heights):
-            # number of infected at end of simulation is less than number of tips
-            return []
-
-        # simulate trees
-        try:
-            robjects.r("trees <- simulate.binary.dated.tree.fgy( tfgy[[1]], tfgy[[2]], tfgy[[3]], tfgy[[4]], "
-                       "sampleTimes, sampleStates, integrationMethod = integrationMethod, "
-                       "n.reps=nreps, cluster=cl)")
-        except:
-            return []
+        parms = [('beta', params['beta']), ('gamma', params['gamma']), ('mu', params['mu']),
+                 ('lambd', params.get('lambd', params['mu']))]
+        x0 = [('I', 1), ('S', params['N'] - 1)]
+        self.solve('SI', self.solve_SI, parms, x0, (), tree_height, tip_heights)
+        return self.simulate(post, nreps)
 
-        robjects.r("'multiPhylo' -> class(trees)")
-        try:
-            retval = robjects.r("lapply(trees, write.tree)")
-        except:
-            return []
-
-        trees = map(lambda x: str(x).split()[-1].strip('" '), retval)
-        if post:
-            return (trees, robjects.r("tfgy[[5]]"))
-        else:
-            return trees
-
-    def simulate_SI2_trees(self, params, tree_height, tip_heights, post=False):
+    def simulate_SI2_trees(self, params, tree_height, tip_heights, post=False, nreps=None):
         """
         Simulate coalescent trees under a two-phase SI model.
         :param params:
         :param tip_heights:
+        :param nreps: number of trees to simulate, if not the nreps given to __init__
         :return:
         """
-
-        # set parameters
-        robjects.r('N=%f; beta1=%f; beta2=%f' % (params['N'], params['beta1'], params['beta2']))
-        robjects.r('gamma=%f; mu=%f; lambd=%f' % (params['gamma'], params['mu'], params.get('lambd', params['mu'])))
-        robjects.r('t_end=%f; t_break=%f' % (tree_height, params['t_break']))
-
-        # adjust fgyResolution for t_break
-        robjects.r("times <- seq(t0, t_end, length.out=fgyResolution)")
-        robjects.r("fgyRes.1 <- round(fgyResolution * t_break)")
-        robjects.r("fgyRes.2 <- fgyResolution - fgyRes.1")
+        # adjust fgyResolution for t_break; numpy rounds half to even as R does
+        tp1 = int(np.round(self.fgy_resolution * params['t_break']))
+        tp2 = self.fgy_resolution - tp1
 
         # if break is too close to either limit, return single ODE solution
-        tp1, tp2 = robjects.r("c(fgyRes.1, fgyRes.2)")
         if tp1 < 3:
             params2 = dict((k, v) for k, v in params.iteritems())  # deep copy
             params2.update({'beta': params['beta2']})
-            return self.simulate_SI_trees(params2, tree_height, tip_heights, post)
+            return self.simulate_SI_trees(params2, tree_height, tip_heights, post, nreps)
         if tp2 < 3:
             params2 = dict((k, v) for k, v in params.iteritems())  # deep copy
             params2.update({'beta': params['beta1']})
-            return self.simulate_SI_trees(params2, tree_height, tip_heights, post)
-
-        # set model parameters
-        robjects.r('S = N-1')
-        robjects.r('I = 1')
-        robjects.r('x0 <- c(I=I, S=S)')
-        robjects.r('parms <- list(beta=beta1, gamma=gamma, mu=mu, lambd=lambd)')
-
-        robjects.r("n.tips <- %d" % len(tip_heights))
-        robjects.r("tip.heights <- c(%s)" % ','.join(map(str, tip_heights)))
-
-        robjects.r("sampleTimes <- t_end - tip.heights")
-        robjects.r("sampleStates <- matrix(1, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("rownames(sampleStates) <- 1:n.tips")
-
-        robjects.r("m <- nrow(births)")
-        robjects.r("maxSampleTime <- max(sampleTimes)")
-
-        # solve first ODE
-        robjects.r("tfgy.1 <- make.fgy( t0, times[fgyRes.1], births, deaths, nonDemeDynamics, x0, "
-                   "migrations=migrations, parms=parms, fgyResolution = fgyRes.1, "
-                   "integrationMethod = integrationMethod )")
-
-        # update model parameter with second beta
-        robjects.r("x1 <- tfgy.1[[5]][fgyRes.1, 2:3]")
-        robjects.r("parms$beta <- beta2")
-
-        # solve second ODE
-        robjects.r("tfgy.2 <- make.fgy( times[fgyRes.1+1], maxSampleTime, births, deaths, nonDemeDynamics, x1, "
-                   "migrations=migrations, parms=parms, fgyResolution = fgyRes.2, "
-                   "integrationMethod = integrationMethod)")
-
-        n_inf = robjects.r("tfgy.2[[4]][[1]]")[0]
-        if n_inf < len(tip_heights):
-            # number of infected at end of simulation is less than number of tips
-            return []
+            return self.simulate_SI_trees(params2, tree_height, tip_heights, post, nreps)
 
-        # reconstitute the entire tfgy
-        robjects.r("y.times <- c(tfgy.2[[1]], tfgy.1[[1]])")
-        robjects.r("y.births <- c(tfgy.2[[2]], tfgy.1[[2]])")
-        robjects.r("y.migrations <- c(tfgy.2[[3]], tfgy.1[[3]])")
-        robjects.r("y.demeSizes <- c(tfgy.2[[4]], tfgy.1[[4]])")
-
-        # simulate trees
-        try:
-            robjects.r("trees <- simulate.binary.dated.tree.fgy(y.times, y.births, y.migrations, y.demeSizes, "
-                       "sampleTimes, sampleStates, integrationMethod=integrationMethod, "
-                       "n.reps=nreps, cluster=cl)")
-        except:
-            return []
-
-        # convert R objects into Python strings in Newick format
-        robjects.r("class(trees) <- 'multiPhylo'")
-        try:
-            retval = robjects.r("lapply(trees, write.tree)")
-        except:
-            # error converting trees
-            return []
-
-        trees = map(lambda x: str(x).split()[-1].strip('" '), retval)
-        if post:
-            return (trees, robjects.r("rbind(tfgy.1[[5]], tfgy.2[[5]])"))
-        else:
-            return trees
+        parms = [('beta', params['beta1']), ('gamma', params['gamma']), ('mu', params['mu']),
+                 ('lambd', params.get('lambd', params['mu']))]
+        x0 = [('I', 1), ('S', params['N'] - 1)]
+        self.solve('SI2', self.solve_SI2, parms, x0, (float(tree_height), tp1, float(params['beta2'])),
+                   tree_height, tip_heights)
+        return self.simulate(post, nreps)
 
 
     def init_DiffRisk_model(self):
         """
         Define ODE system for differential risk SI model.
         """
+        definitions = """
+            demes <- c('I1', 'I2')
+
+            p11 <- '(parms$rho + (1-parms$rho) * parms$c1*(S1+I1) / (parms$c1*(S1+I1) + parms$c2*(S2+I2)))'
+            p12 <- '(1-parms$rho) * parms$c2*(S2+I2) / (parms$c1*(S1+I1) + parms$c2*(S2+I2))'
+            p21 <- '(1-parms$rho) * parms$c1*(S1+I1) / (parms$c1*(S1+I1) + parms$c2*(S2+I2))'
+            p22 <- '(parms$rho + (1-parms$rho) * parms$c2*(S2+I2) / (parms$c1*(S1+I1) + parms$c2*(S2+I2)))'
+            births <- rbind(c(paste(sep='*', 'parms$beta*parms$c1', p11, 'I1/(S1+I1)*S1'),
+                              paste(sep='*', 'parms$beta*parms$c2', p21, 'I1/(S1+I1)*S2')),
+                            c(paste(sep='*', 'parms$beta*parms$c1', p12, 'I2/(S2+I2)*S1'),
+                              paste(sep='*', 'parms$beta*parms$c2', p22, 'I2/(S2+I2)*S2')))
+            rownames(births)=colnames(births) <- demes
+
+            migrations <- rbind(c('0', '0'), c('0', '0'))
+            rownames(migrations)=colnames(migrations) <- demes
+
+            deaths <- c('(parms$mu+parms$gamma)*I1', '(parms$mu+parms$gamma)*I2')
+            names(deaths) <- demes
+
+            nonDemeDynamics <- c(paste(sep='', '-parms$mu*S1 + parms$mu*S1 + (parms$mu+parms$gamma)*I1',
+                                       paste(sep='*', '-S1*(parms$beta*parms$c1', p11, 'I1/(S1+I1) + parms$beta*parms$c1', p12,
+                                             'I2/(S2+I2))')),
+                                 paste(sep='', '-parms$mu*S2 + parms$mu*S2 + (parms$mu+parms$gamma)*I2',
+                                       paste(sep='*', '-S2*(parms$beta*parms$c2', p21, 'I1/(S1+I1) + parms$beta*parms$c2', p22,
+                                             'I2/(S2+I2))')))
+            names(nonDemeDynamics) <- c('S1', 'S2')
+        """
+        self.solve_DiffRisk = robjects.r("local({%s\n%s})" % (definitions, SOLVE_FGY))
 
-        robjects.r("demes <- c('I1', 'I2')")
-
-        robjects.r("p11 <- '(parms$rho + (1-parms$rho) * parms$c1*(S1+I1) / (parms$c1*(S1+I1) + parms$c2*(S2+I2)))'")
-        robjects.r("p12 <- '(1-parms$rho) * parms$c2*(S2+I2) / (parms$c1*(S1+I1) + parms$c2*(S2+I2))'")
-        robjects.r("p21 <- '(1-parms$rho) * parms$c1*(S1+I1) / (parms$c1*(S1+I1) + parms$c2*(S2+I2))'")
-        robjects.r("p22 <- '(parms$rho + (1-parms$rho) * parms$c2*(S2+I2) / (parms$c1*(S1+I1) + parms$c2*(S2+I2)))'")
-        robjects.r("births <- rbind(c(paste(sep='*', 'parms$beta*parms$c1', p11, 'I1/(S1+I1)*S1'),"
-				   "paste(sep='*', 'parms$beta*parms$c2', p21, 'I1/(S1+I1)*S2')),"
-		    	   "c(paste(sep='*', 'parms$beta*parms$c1', p12, 'I2/(S2+I2)*S1'),"
-			       "paste(sep='*', 'parms$beta*parms$c2', p22, 'I2/(S2+I2)*S2')))")
-        robjects.r("rownames(births)=colnames(births) <- demes")
-
-        robjects.r("migrations <- rbind(c('0', '0'), c('0', '0'))")
-        robjects.r("rownames(migrations)=colnames(migrations) <- demes")
-
-        robjects.r("deaths <- c('(parms$mu+parms$gamma)*I1', '(parms$mu+parms$gamma)*I2')")
-        robjects.r("names(deaths) <- demes")
-
-        robjects.r("nonDemeDynamics <- c(paste(sep='', '-parms$mu*S1 + parms$mu*S1 + (parms$mu+parms$gamma)*I1', "
-                   "paste(sep='*', '-S1*(parms$beta*parms$c1', p11, 'I1/(S1+I1) + parms$beta*parms$c1', p12, "
-                   "'I2/(S2+I2))')), paste(sep='', '-parms$mu*S2 + parms$mu*S2 + (parms$mu+parms$gamma)*I2', "
-                   "paste(sep='*', '-S2*(parms$beta*parms$c2', p21, 'I1/(S1+I1) + parms$beta*parms$c2', p22, "
-                   "'I2/(S2+I2))')))")
-        robjects.r("names(nonDemeDynamics) <- c('S1', 'S2')")
-
-    def simulate_DiffRisk_trees(self, params, tree_height, tip_heights, post=False):
+    def simulate_DiffRisk_trees(self, params, tree_height, tip_heights, post=False, nreps=None):
         """
 
         :param params:
         :param tip_heights:
+        :param nreps: number of trees to simulate, if not the nreps given to __init__
         :return:
         """
-
-        # set parameters
-        robjects.r('N=%f; beta=%f; c1=%f; c2=%f' % (params['N'], params['beta'], params['c1'], params['c2']))
-        robjects.r('rho=%f; p=%f; gamma=%f; mu=%f' % (params['rho'], params['p'], params['gamma'], params['mu']))
-        robjects.r('t_end=%f' % (tree_height,))
-
-        # update model parameters
-        robjects.r("S1=p*N-1; S2=(1-p)*N; I1=1; I2=0")
-        robjects.r("x0 <- c(I1=I1, I2=I2, S1=S1, S2=S2)")
-        robjects.r("parms <- list(beta=beta, gamma=gamma, mu=mu, c1=c1, c2=c2, rho=rho)")
-
-        robjects.r("n.tips <- %d" % len(tip_heights))
-        robjects.r("tip.heights <- c(%s)" % ','.join(map(str, tip_heights)))
-
-        robjects.r("sampleTimes <- t_end - tip.heights")
-        robjects.r("sampleStates <- matrix(1, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("rownames(sampleStates) <- 1:n.tips")
-
-        robjects.r("m <- nrow(births)")
-        robjects.r("maxSampleTime <- max(sampleTimes)")
-
-        # solve ODE
-        robjects.r("tfgy <- make.fgy( t0, maxSampleTime, births, deaths, nonDemeDynamics, x0, migrations=migrations, "
-                   "parms=parms, fgyResolution = fgyResolution, integrationMethod = integrationMethod)")
-
-        # use prevalence of respective infected classes at end of simulation to determine sample states
-        robjects.r("demes.t.end <- tfgy[[4]][[1]]")
-
-        if robjects.r("sum(demes.t.end)")[0] < len(tip_heights):
-            # number of infected individuals at end of simulation is less than number of tips
-            return []
-
-        robjects.r("demes.sample <- sample(rep(1:length(demes), times=round(demes.t.end)), size=n.tips)")
-        robjects.r("sampleStates <- matrix(0, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("for (i in 1:n.tips) { sampleStates[i, demes.sample[i]] <- 1 }")
-        robjects.r("rownames(sampleStates) <- paste(1:n.tips, demes.sample, sep='_')")
-
-        # simulate trees
-        try:
-            robjects.r("trees <- simulate.binary.dated.tree.fgy( tfgy[[1]], tfgy[[2]], tfgy[[3]], tfgy[[4]], "
-                       "sampleTimes, sampleStates, integrationMethod = integrationMethod, "
-                       "n.reps=nreps, cluster=cl)")
-        except:
-            return []
-
-        # convert R objects into Python strings in Newick format
-        robjects.r("class(trees) <- 'multiPhylo'")
-        try:
-            retval = robjects.r("lapply(trees, write.tree)")
-        except:
-            # error converting trees
-            return []
-
-        trees = map(lambda x: str(x).split()[-1].strip('" '), retval)
-        if post:
-            return (trees, robjects.r("tfgy[[5]]"))
-        else:
-            return trees
+        parms = [('beta', params['beta']), ('gamma', params['gamma']), ('mu', params['mu']),
+                 ('c1', params['c1']), ('c2', params['c2']), ('rho', params['rho'])]
+        x0 = [('I1', 1), ('I2', 0), ('S1', params['p'] * params['N'] - 1),
+              ('S2', (1 - params['p']) * params['N'])]
+        self.solve('DiffRisk', self.solve_DiffRisk, parms, x0, (), tree_height, tip_heights,
+                   sample_states=True)
+        return self.simulate(post, nreps)
 
     def init_stages_model (self):
         """
@@ -293,92 +366,42 @@ class Rcolgem ():
         the infected class moves through three stages: acute, asymptomatic, and chronic.
         :return:
         """
-        robjects.r("demes <- c('I1', 'I2', 'I3')")
-
-        # transition from susceptible by infection (from any stage) to stage one only
-        robjects.r("births <- rbind(c('parms$beta1*S*I1 / (S+I1+I2+I3)', '0', '0'), "
-                   "c('parms$beta2*S*I2 / (S+I1+I2+I3)', '0', '0'), "
-                   "c('parms$beta3*S*I3 / (S+I1+I2+I3)', '0', '0'))")
-        robjects.r("rownames(births)=colnames(births) <- demes")
-
-        # transition between stages of infection by "migration"
-        robjects.r("migrations <- rbind(c('0', 'parms$alpha1 * I1', '0'), "
-                   "c('0', '0', 'parms$alpha2 * I2'),"
-                   "c('0', '0', '0'))")
-        robjects.r("rownames(migrations)=colnames(migrations) <- demes")
-
-        # assume that increased death rate only at final stage
-        robjects.r("deaths <- c('(parms$mu)*I1', '(parms$mu)*I2', '(parms$mu+parms$gamma)*I3')")
-        robjects.r("names(deaths) <- demes")
-
-        # dynamics of susceptible class (replacement of deaths, loss to infection)
-        robjects.r("nonDemeDynamics <- paste(sep='', '-parms$mu*S + parms$mu*(S+I1+I2) + (parms$mu+parms$gamma)*I3', "
-                   "'-S*(parms$beta1*I1 + parms$beta2*I2 + parms$beta3*I3) / (S+I1+I2+I3)')")
-        robjects.r("names(nonDemeDynamics) <- 'S'")
-
-    def simulate_stages_trees(self, params, tree_height, tip_heights, post=False):
+        definitions = """
+            demes <- c('I1', 'I2', 'I3')
+
+            # transition from susceptible by infection (from any stage) to stage one only
+            births <- rbind(c('parms$beta1*S*I1 / (S+I1+I2+I3)', '0', '0'),
+                            c('parms$beta2*S*I2 / (S+I1+I2+I3)', '0', '0'),
+                            c('parms$beta3*S*I3 / (S+I1+I2+I3)', '0', '0'))
+            rownames(births)=colnames(births) <- demes
+
+            # transition between stages of infection by "migration"
+            migrations <- rbind(c('0', 'parms$alpha1 * I1', '0'),
+                                c('0', '0', 'parms$alpha2 * I2'),
+                                c('0', '0', '0'))
+            rownames(migrations)=colnames(migrations) <- demes
+
+            # assume that increased death rate only at final stage
+            deaths <- c('(parms$mu)*I1', '(parms$mu)*I2', '(parms$mu+parms$gamma)*I3')
+            names(deaths) <- demes
+
+            # dynamics of susceptible class (replacement of deaths, loss to infection)
+            nonDemeDynamics <- paste(sep='', '-parms$mu*S + parms$mu*(S+I1+I2) + (parms$mu+parms$gamma)*I3',
+                                     '-S*(parms$beta1*I1 + parms$beta2*I2 + parms$beta3*I3) / (S+I1+I2+I3)')
+            names(nonDemeDynamics) <- 'S'
         """
+        self.solve_stages = robjects.r("local({%s\n%s})" % (definitions, SOLVE_FGY))
 
-        :return:
+    def simulate_stages_trees(self, params, tree_height, tip_heights, post=False, nreps=None):
         """
-        # set parameters
-        robjects.r('N=%f; beta1=%f; beta2=%f; beta3=%f' % (params['N'], params['beta1'], params['beta2'],
-                                                           params['beta3']))
-        robjects.r('alpha1=%f; alpha2=%f' % (params['alpha1'], params['alpha2']))
-        robjects.r('gamma=%f; mu=%f' % (params['gamma'], params['mu']))
-        robjects.r('t_end=%f' % (tree_height,))
-
-        # update model parameters
-        robjects.r("S=N-1; I1=1; I2=0; I3=0")
-        robjects.r("x0 <- c(I1=I1, I2=I2, I3=I3, S=S)")
-        robjects.r("parms <- list(beta1=beta1, beta2=beta2, beta3=beta3, alpha1=alpha1, alpha2=alpha2, "
-                   "gamma=gamma, mu=mu)")
-
-        robjects.r("n.tips <- %d" % len(tip_heights))
-        robjects.r("tip.heights <- c(%s)" % ','.join(map(str, tip_heights)))
-
-        robjects.r("sampleTimes <- t_end - tip.heights")
-        robjects.r("sampleStates <- matrix(1, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("rownames(sampleStates) <- 1:n.tips")
-
-        robjects.r("m <- nrow(births)")
-        robjects.r("maxSampleTime <- max(sampleTimes)")
-
-        # solve ODE
-        robjects.r("tfgy <- make.fgy( t0, maxSampleTime, births, deaths, nonDemeDynamics, x0, migrations=migrations, "
-                   "parms=parms, fgyResolution = fgyResolution, integrationMethod = integrationMethod)")
-
-        # use prevalence of respective infected classes at end of simulation to determine sample states
-        robjects.r("demes.t.end <- tfgy[[4]][[1]]")
-        if robjects.r("sum(demes.t.end)")[0] < len(tip_heights):
-            # number of infected individuals at end of simulation is less than number of tips
-            return []
-
-        robjects.r("demes.sample <- sample(rep(1:length(demes), times=round(demes.t.end)), size=n.tips)")
-        robjects.r("sampleStates <- matrix(0, nrow=n.tips, ncol=length(demes))")
-        robjects.r("colnames(sampleStates) <- demes")
-        robjects.r("for (i in 1:n.tips) { sampleStates[i, demes.sample[i]] <- 1 }")
-        robjects.r("rownames(sampleStates) <- paste(1:n.tips, demes.sample, sep='_')")
-
-        # simulate trees
-        try:
-            robjects.r("trees <- simulate.binary.dated.tree.fgy( tfgy[[1]], tfgy[[2]], tfgy[[3]], tfgy[[4]], "
-                       "sampleTimes, sampleStates, integrationMethod = integrationMethod, "
-                       "n.reps=nreps, cluster=cl)")
-        except:
-            return []
 
-        # convert R objects into Python strings in Newick format
-        robjects.r("class(trees) <- 'multiPhylo'")
-        try:
-            retval = robjects.r("lapply(trees, write.tree)")
-        except:
-            # error converting trees
-            return []
-
-        trees = map(lambda x: str(x).split()[-1].strip('" '), retval)
-        if post:
-            return (trees, robjects.r("tfgy[[5]]"))
-        else:
-            return trees
\ No newline at end of file
+        :param nreps: number of trees to simulate, if not the nreps given to __init__
+        :return:
+        """
+        parms = [('beta1', params['beta1']), ('beta2', params['beta2']), ('beta3', params['beta3']),
+                 ('alpha1', params['alpha1']), ('alpha2', params['alpha2']),
+                 ('gamma', params['gamma']), ('mu', params['mu'])]
+        x0 = [('I1', 1), ('I2', 0), ('I3', 0), ('S', params['N'] - 1)]
+        self.solve('Stages', self.solve_stages, parms, x0, (), tree_height, tip_heights,
+                   sample_states=True)
+        return self.simulate(post, nreps)
@@ -0,0 +1,87 @@
+"""
+Cheap emulators of the mean kernel score as a function of model parameters,
+used to screen proposals in delayed-acceptance ABC-MCMC.
+"""
+import numpy as np
+
+
+class GPSurrogate(object):
+    """
+    Gaussian process regression of kernel scores on parameter vectors,
+    trained online from the full evaluations of an ABC-MCMC chain.
+
+    Parameters are standardized per dimension, and a squared exponential
+    covariance is used.  The length scale and noise variance are chosen
+    by marginal likelihood from a small grid, scaled by the median
+    pairwise distance and the score variance respectively.
+
+    [max_points] = fit to at most this many of the most recent points
+    [min_points] = number of points needed before predictions are made
+    [refit] = refit after this many new points
+    """
+
+    def __init__(self, max_points=200, min_points=20, refit=10):
+        self.max_points = max_points
+        self.min_points = min_points
+        self.refit = refit
+
+        self.X = []
+        self.y = []
+        self.nnew = 0
+        self.alpha = None  # weights of training points, set by fit()
+
+    def add(self, x, y):
+        """
+        Record the full evaluation y (mean kernel score) at parameter vector x.
+        """
+        self.X.append(list(x))
+        self.y.append(y)
+        self.nnew += 1
+        if len(self.y) >= self.min_points and (self.alpha is None or self.nnew >= self.refit):
+            self.fit()
+
+    def ready(self):
+        return self.alpha is not None
+
+    def fit(self):
+        X = np.array(self.X[-self.max_points:], dtype=float)
+        y = np.array(self.y[-self.max_points:], dtype=float)
+        self.nnew = 0
+
+        self.center = X.mean(axis=0)
+        self.scale = X.std(axis=0)
+        self.scale[self.scale == 0] = 1.
+        Z = (X - self.center) / self.scale
+        d2 = ((Z[:, np.newaxis, :] - Z[np.newaxis, :, :])**2).sum(axis=2)
+
+        self.ymean = y.mean()
+        yvar = max(y.var(), 1e-12)
+        r = y - self.ymean
+        median_d2 = np.median(d2[d2 > 0]) if np.any(d2 > 0) else 1.
+
+        best = None
+        for ell2 in (0.25*median_d2, 0.5*median_d2, median_d2, 2*median_d2):
+            for noise in (0.01*yvar, 0.1*yvar, 0.5*yvar):
+                K = yvar * np.exp(-d2 / (2*ell2)) + noise * np.eye(len(y))
+                try:
+                    L = np.linalg.cholesky(K)
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = np.linalg.solve(L.T, np.linalg.solve(L, r))
+                loglik = -0.5 * r.dot(alpha) - np.log(np.diag(L)).sum()
+                if best is None or loglik > best[0]:
+                    best = (loglik, ell2, alpha)
+
+        if best is None:
+            return
+        _, self.ell2, self.alpha = best
+        self.yvar = yvar
+        self.Z = Z
+
+    def predict(self, x):
+        """
+        Posterior mean of the kernel score at parameter vector x.
+        """
+        z = (np.asarray(x, dtype=float) - self.center) / self.scale
+        k = self.yvar * np.exp(-((self.Z - z)**2).sum(axis=1) / (2*self.ell2))
+        return self.ymean + k.dot(self.alpha)
@@ -0,0 +1,79 @@
+"""
+Compare trees from the Python structured coalescent (coalescent.py) with
+trees from simulate.binary.dated.tree.fgy in R, by two-sample
+Kolmogorov-Smirnov tests on the distributions of tree statistics.
+Requires R with rcolgem and rpy2.
+"""
+import sys
+sys.path.append('..')  # make modules in parent dir available
+import time
+import numpy as np
+import scipy.stats as stats
+from compacttree import CompactTree
+from coalescent import Simulator
+from rcolgem import Rcolgem
+
+nreps = 200
+ntips = 100
+tree_height = 30.
+
+models = [('SI', {'beta': 0.4, 'gamma': 0.05, 'mu': 0.02, 'N': 2000.}),
+          ('SI2', {'beta1': 0.4, 'beta2': 0.2, 'gamma': 0.05, 'mu': 0.02, 'N': 2000., 't_break': 0.6}),
+          ('DiffRisk', {'beta': 0.3, 'gamma': 0.05, 'mu': 0.02, 'c1': 2., 'c2': 0.5, 'rho': 0.3,
+                        'p': 0.2, 'N': 4000.}),
+          ('Stages', {'beta1': 0.8, 'beta2': 0.1, 'beta3': 0.3, 'alpha1': 2., 'alpha2': 0.2,
+                      'gamma': 0.3, 'mu': 0.02, 'N': 10000.})]
+
+isochronous = [0.] * ntips
+heterochronous = list(np.random.uniform(0, 5, ntips))
+
+
+def statistics(tree):
+    """ Root height, tree length, number of cherries and Sackin index """
+    nodes = tree.nnodes
+    depth = np.zeros(nodes)
+    tip_depths = []
+    for i in reversed(range(nodes)):  # root is last
+        for child, bl in ((tree.left[i], tree.left_bl[i]), (tree.right[i], tree.right_bl[i])):
+            if child < 0:
+                tip_depths.append(depth[i] + bl)
+            else:
+                depth[child] = depth[i] + bl
+
+    ntips = np.zeros(nodes)
+    for i in range(nodes):
+        for child in (tree.left[i], tree.right[i]):
+            ntips[i] += ntips[child] if child >= 0 else 1
+
+    return {'height': max(tip_depths),
+            'length': tree.left_bl.sum() + tree.right_bl.sum(),
+            'cherries': (tree.production == 3).sum(),
+            'sackin': ntips.sum()}
+
+
+rcolgem = Rcolgem(ncores=1, nreps=nreps, edges=True)
+rcolgem.init_SI_model()
+rcolgem.init_DiffRisk_model()
+rcolgem.init_stages_model()
+rfuncs = {'SI': rcolgem.simulate_SI_trees, 'SI2': rcolgem.simulate_SI2_trees,
+          'DiffRisk': rcolgem.simulate_DiffRisk_trees, 'Stages': rcolgem.simulate_stages_trees}
+
+for model, params in models:
+    for label, tip_heights in [('isochronous', isochronous), ('heterochronous', heterochronous)]:
+        results = {}
+        for simulator, func in [('R', rfuncs[model]), ('python', Simulator(model).simulate_trees)]:
+            t0 = time.time()
+            trees = func(params, tree_height, tip_heights, nreps=nreps)
+            elapsed = time.time() - t0
+            print model, label, simulator, len(trees), 'trees in', elapsed, 'seconds'
+            results[simulator] = [statistics(CompactTree.from_edges(edge, edge_length))
+                                  for edge, edge_length in trees]
+
+        if not results['R'] or not results['python']:
+            print '  no trees to compare'
+            continue
+        for key in ['height', 'length', 'cherries', 'sackin']:
+            r = [s[key] for s in results['R']]
+            py = [s[key] for s in results['python']]
+            d, p = stats.ks_2samp(r, py)
+            print '  %-8s R %10.3f python %10.3f  KS D=%.3f p=%.3f' % (key, np.mean(r), np.mean(py), d, p)
@@ -0,0 +1,81 @@
+"""
+Compare the Python ODE engine (fgy.py) with make.fgy in R, as called by the
+model solvers of rcolgem.py: times, F, G, Y and the ODE solution (ox) must
+agree within rtol for every model, with both integration methods.
+Requires R with rcolgem and rpy2.
+"""
+import sys
+sys.path.append('..')  # make modules in parent dir available
+import numpy as np
+import rpy2.robjects as robjects
+import fgy
+from rcolgem import Rcolgem
+
+resolution = 500
+tree_height = 30.
+ntips = 10
+
+# same fixed steps give the same solution up to rounding; adaptive lsoda steps
+# of deSolve and scipy differ within their tolerances (1e-6) of each local step
+rtols = {'rk4': 1e-8, 'lsoda': 1e-3}
+
+# t_break of 0.6 splits the time grid; 0.002 and 0.998 leave fewer than 3 steps
+# on one side, so that a single solution with beta2 or beta1 is returned
+si2 = {'beta1': 0.4, 'beta2': 0.2, 'gamma': 0.05, 'mu': 0.02, 'N': 2000.}
+models = [('SI', {'beta': 0.4, 'gamma': 0.05, 'mu': 0.02, 'N': 2000.}),
+          ('SI2', dict(si2, t_break=0.6)),
+          ('SI2', dict(si2, t_break=0.002)),
+          ('SI2', dict(si2, t_break=0.998)),
+          ('DiffRisk', {'beta': 0.3, 'gamma': 0.05, 'mu': 0.02, 'c1': 2., 'c2': 0.5, 'rho': 0.3,
+                        'p': 0.2, 'N': 4000.}),
+          ('Stages', {'beta1': 0.8, 'beta2': 0.1, 'beta3': 0.3, 'alpha1': 2., 'alpha2': 0.2,
+                      'gamma': 0.3, 'mu': 0.02, 'N': 10000.})]
+
+# the last sample before the tree height ends the solution early, and SI2
+# then places its break on the grid up to the tree height
+isochronous = [0.] * ntips
+heterochronous = [1. + 4. * i / ntips for i in range(ntips)]
+
+
+def to_array(x):
+    """ R vector or matrix as a NumPy array, matrices being stored by column """
+    values = np.array(list(x), dtype=float)
+    dim = x.do_slot('dim') if 'dim' in x.list_attrs() else None
+    return values if dim is None else values.reshape(tuple(dim), order='F')
+
+
+def check(label, value, expected, rtol):
+    value, expected = np.asarray(value), np.asarray(expected)
+    assert value.shape == expected.shape, '%s: shape %r != %r' % (label, value.shape, expected.shape)
+    # entries near zero, e.g. the empty demes at t0, are compared to the largest entry
+    atol = rtol * np.abs(expected).max()
+    assert np.allclose(value, expected, rtol=rtol, atol=atol), \
+        '%s: max difference %g' % (label, np.abs(value - expected).max())
+
+
+# the ODE cache is keyed without the integration method, so keep it off
+rcolgem = Rcolgem(ncores=1, nreps=1, fgy_resolution=resolution, edges=True, cache_size=0)
+rcolgem.init_SI_model()
+rcolgem.init_DiffRisk_model()
+rcolgem.init_stages_model()
+rfuncs = {'SI': rcolgem.simulate_SI_trees, 'SI2': rcolgem.simulate_SI2_trees,
+          'DiffRisk': rcolgem.simulate_DiffRisk_trees, 'Stages': rcolgem.simulate_stages_trees}
+
+for method in ('rk4', 'lsoda'):
+    robjects.r('integrationMethod="%s"' % method)
+    rcolgem.last_key = None
+    for model, params in models:
+        for label, tip_heights in (('isochronous', isochronous), ('heterochronous', heterochronous)):
+            rfuncs[model](params, tree_height, tip_heights, nreps=1)
+            tfgy = rcolgem.setup.rx2('tfgy')
+            solution = fgy.solve(model, params, tree_height, tip_heights, resolution=resolution,
+                                 method=method)
+
+            name = '%s %s %s %s' % (method, model, params.get('t_break', ''), label)
+            rtol = rtols[method]
+            check(name + ' times', solution.times, to_array(tfgy[0]), rtol)
+            check(name + ' F', solution.F, [to_array(m) for m in tfgy[1]], rtol)
+            check(name + ' G', solution.G, [to_array(m) for m in tfgy[2]], rtol)
+            check(name + ' Y', solution.Y, [to_array(y) for y in tfgy[3]], rtol)
+            check(name + ' ox', solution.ox, to_array(tfgy[4]), rtol)
+            print name, 'OK'
@@ -0,0 +1,122 @@
+"""
+Check that the kernel engines agree with the original dense kernel on the
+hivepi trees, for several kernel settings, and that kernel_approx brackets
+the exact kernel with its reported bound.
+"""
+import sys
+sys.path.append('..')  # make modules in parent dir available
+import math
+import numpy as np
+import phyloK2
+from compacttree import CompactTree
+from newick import NewickReader
+from Bio import Phylo
+
+paths = ['../projects/hivepi/data/SIRTree.n100.nwk',
+         '../projects/hivepi/data/SIRTree.n100.RLRootToTip.timetree.nwk',
+         '../projects/hivepi/data/SIRTree.n300.nwk']
+settings = [(0.2, 2.), (0.5, 0.5), (0.05, 10.)]  # (decayFactor, gaussFactor)
+cutoffs = [1e-4, 1e-2, 0.1]
+rtol = 1e-9
+
+
+def reference_kernel(pk, t1, t2):
+    # kernel as first released: dense DP over all pairs of annotated Clades
+    nodes1 = t1.get_nonterminals(order='postorder')
+    nodes2 = t2.get_nonterminals(order='postorder')
+    dp_matrix = [[0 for n2 in nodes2] for n1 in nodes1]
+    k = 0
+    for n1 in nodes1:
+        for n2 in nodes2:
+            if n1.production != n2.production:
+                continue
+            bl1 = [c1.branch_length for c1 in n1.clades]
+            bl2 = [c2.branch_length for c2 in n2.clades]
+            res = pk.decayFactor * math.exp(-1. / pk.gaussFactor
+                * (n1.sqbl + n2.sqbl - 2*sum([(bl1[i]*bl2[i]) for i in range(len(bl1))])))
+            for cn1 in range(2):
+                c1 = n1.clades[cn1]
+                c2 = n2.clades[cn1]
+                if c1.production != c2.production:
+                    continue
+                if c1.production == 0:
+                    res *= pk.sigma + pk.decayFactor
+                else:
+                    res *= pk.sigma + dp_matrix[c1.index][c2.index]
+            dp_matrix[n1.index][n2.index] = res
+            k += res
+    return k
+
+
+def check(label, value, expected):
+    assert abs(value - expected) <= rtol * abs(expected), \
+        '%s: %r != %r' % (label, value, expected)
+
+
+pk = phyloK2.PhyloKernel(engine='python', normalize='mean')
+phylo = []
+compact = []
+reader = NewickReader(ladderize=True, normalize='mean')
+for path in paths:
+    tree = Phylo.read(path, 'newick')
+    tree.root.branch_length = tree.root.branch_length or 0.
+    tree.ladderize()
+    pk.normalize_tree(tree, 'mean')
+    pk.annotate_tree(tree)
+    phylo.append(tree)
+
+    compact.append(CompactTree.from_phylo(Phylo.read(path, 'newick'), ladderize=True, normalize='mean'))
+    parsed = reader.read(open(path, 'rU').read().strip())
+    for key in ('left', 'right', 'left_bl', 'right_bl', 'production', 'sqbl'):
+        assert np.allclose(getattr(parsed, key), getattr(compact[-1], key), rtol=rtol), (path, key)
+
+pairs = [(i, j) for i in range(len(paths)) for j in range(i, len(paths))]
+for decay, gauss in settings:
+    pk.decayFactor, pk.gaussFactor = decay, gauss
+    for i, j in pairs:
+        expected = reference_kernel(pk, phylo[i], phylo[j])
+        t1, t2 = compact[i], compact[j]
+        check('kernel', pk.kernel(phylo[i], phylo[j]), expected)
+        check('kernel_compact', pk.kernel_compact(t1, t2), expected)
+        check('kernel_numpy', pk.kernel_numpy(t1, t2), expected)
+
+        # score_columns over subtrees of t2 and then the spine, as kernel_parallel
+        blocks = dict((p, np.zeros((len(b), len(t2.buckets()[p])))) for p, b in t1.buckets().iteritems())
+        groups, spine = t2.split(3)
+        assert sorted(np.concatenate(groups + [spine])) == range(t2.nnodes)
+        check('score_columns', sum(pk.score_columns(t1, t2, cols, blocks) for cols in groups + [spine]),
+              expected)
+
+        # every DP entry is bounded by the smaller bound of its two nodes
+        bounds1, bounds2 = pk.pair_bounds(t1), pk.pair_bounds(t2)
+        for p, block in blocks.iteritems():
+            limit = np.minimum.outer(bounds1[t1.buckets()[p]], bounds2[t2.buckets()[p]])
+            assert np.all(block <= limit * (1 + rtol)), ('pair_bounds', p)
+
+        for cutoff in cutoffs:
+            pk.cutoff = cutoff
+            k, dropped = pk.kernel_approx(t1, t2)
+            pk.cutoff = 0.
+            assert k <= expected * (1 + rtol) and expected <= (k + dropped) * (1 + rtol), \
+                ('kernel_approx', cutoff, k, dropped, expected)
+
+        print 'decay=%g tau=%g %s vs %s: %g OK' % (decay, gauss, paths[i], paths[j], expected)
+
+# all settings in one pass
+decays, gausses = zip(*settings)
+for i, j in pairs:
+    multi = pk.kernel_multi(compact[i], compact[j], decays, gausses)
+    for (decay, gauss), value in zip(settings, multi):
+        pk.decayFactor, pk.gaussFactor = decay, gauss
+        check('kernel_multi', value, pk.kernel_numpy(compact[i], compact[j]))
+print 'kernel_multi OK'
+
+# normalized scores of the approximate kernel are within their error bound
+for cutoff in cutoffs:
+    approx = phyloK2.PhyloKernel(engine='numpy', normalize='mean', decayFactor=0.5, gaussFactor=0.5, cutoff=cutoff)
+    exact = phyloK2.PhyloKernel(engine='numpy', normalize='mean', decayFactor=0.5, gaussFactor=0.5)
+    target, exact_target = phyloK2.PreparedTarget(approx, compact[0]), phyloK2.PreparedTarget(exact, compact[0])
+    for tree in compact[1:]:
+        score, error = target.score_bounded(tree)
+        assert abs(exact_target.score(tree) - score) <= error * (1 + rtol) + 1e-12, (cutoff, score, error)
+        print 'cutoff=%g score %g error bound %g exact %g' % (cutoff, score, error, exact_target.score(tree))
@@ -1,29 +1,50 @@
+"""
+Compare kernel_parallel with kernel_numpy on trees of 1000 to 4000 tips,
+built by joining the hivepi trees.  Besides wall times, print the time
+of the slowest subtree group plus the spine when the groups are scored
+one after another, which is the parallel time on a machine with at
+least nthreads free cores, apart from starting the workers.
+"""
 import sys
 sys.path.append('..')  # make modules in parent dir available
 import time
+import numpy as np
+import multiprocessing as mp
 import phyloK2
-from Bio import Phylo
+from newick import NewickReader
 
-pk = phyloK2.PhyloKernel()
+nthreads = 4
+reader = NewickReader(ladderize=True, normalize='mean')
+pk = phyloK2.PhyloKernel(engine='numpy')
 
-t1 = Phylo.read('large1.nwk', 'newick')
-t2 = Phylo.read('large2.nwk', 'newick')
-t1.ladderize()
-t2.ladderize()
-pk.normalize_tree(t1)
-pk.normalize_tree(t2)
-pk.annotate_tree(t1)
-pk.annotate_tree(t2)
+a = open('../projects/hivepi/data/SIRTree.n1000.nwk').read().strip().rstrip(';')
+b = open('../projects/hivepi/data/SIRTree.n1000.RLRootToTip.timetree.nwk').read().strip().rstrip(';')
+pairs = [(1000, a, b),
+         (2000, '(%s:1,%s:1)' % (a, b), '(%s:1,%s:1)' % (b, a)),
+         (4000, '((%s:1,%s:1):1,(%s:1,%s:1):1)' % (a, b, b, a), '((%s:1,%s:1):1,(%s:1,%s:1):1)' % (b, a, a, b))]
 
-# single-threaded
-t0 = time.time()
-k = pk.kernel(t1, t2)
-elapsed = time.time() - t0
+print mp.cpu_count(), 'cores,', nthreads, 'workers, default min_pairs', \
+    pk.kernel_parallel.im_func.func_defaults[0]
+for ntips, newick1, newick2 in pairs:
+    t1, t2 = reader.read(newick1), reader.read(newick2)
 
-print 'SP', k, elapsed, 'seconds'
+    t0 = time.time()
+    k = pk.kernel_numpy(t1, t2)
+    sp = time.time() - t0
 
-t0 = time.time()
-k = pk.kernel_parallel(t1, t2, 6)
-elapsed = time.time() - t0
+    # min_pairs=0 to start workers for every size
+    t0 = time.time()
+    k_mp = pk.kernel_parallel(t1, t2, nthreads, min_pairs=0)
+    mp_time = time.time() - t0
+    assert abs(k_mp - k) <= 1e-9 * k
 
-print 'MP', k, elapsed, 'seconds'
+    groups, spine = t2.split(nthreads)
+    blocks = dict((p, np.zeros((len(rows), len(t2.buckets()[p])))) for p, rows in t1.buckets().iteritems())
+    times = []
+    for cols in groups + [spine]:
+        t0 = time.time()
+        pk.score_columns(t1, t2, cols, blocks)
+        times.append(time.time() - t0)
+
+    print '%d tips, %d pairs: SP %1.3f s, MP %1.3f s, critical path %1.3f s, kernel %g' % (
+        ntips, t1.nnodes * t2.nnodes, sp, mp_time, max(times[:-1]) + times[-1], k)
@@ -0,0 +1,87 @@
+import sys
+sys.path.append('..')  # make modules in parent dir available
+import time
+import numpy as np
+import phyloK2
+from kamphir import ladderized_terminals
+from compacttree import CompactTree
+from Bio import Phylo
+from cStringIO import StringIO
+
+pk = phyloK2.PhyloKernel()
+nreps = 20
+
+def old_prepare(tree):
+    # sequence of Bio.Phylo traversals formerly run by Kamphir.compute
+    tree.root.branch_length = tree.root.branch_length or 0.
+    tree.ladderize()
+    pk.normalize_tree(tree, 'mean')
+    pk.annotate_tree(tree)
+
+def new_prepare(tree):
+    CompactTree.from_phylo(tree, ladderize=True, normalize='mean')
+
+
+def check_agreement(label, newick):
+    # arrays and kernel value of the new path must match the legacy annotations
+    old = Phylo.read(StringIO(newick), 'newick')
+    old_prepare(old)
+    new = CompactTree.from_phylo(Phylo.read(StringIO(newick), 'newick'), ladderize=True, normalize='mean')
+    nodes = old.get_nonterminals(order='postorder')
+    assert new.nnodes == len(nodes)
+    assert np.array_equal(new.production, [node.production for node in nodes])
+    assert np.allclose(new.sqbl, [node.sqbl for node in nodes], rtol=1e-12)
+    assert np.allclose(new.left_bl, [node.clades[0].branch_length for node in nodes], rtol=1e-12)
+    assert np.allclose(new.right_bl, [node.clades[1].branch_length for node in nodes], rtol=1e-12)
+    # target height and tip order as Kamphir.set_target_trees computes them
+    raw = Phylo.read(StringIO(newick), 'newick')
+    height = CompactTree.from_phylo(raw, ladderize=True).tip_depths().max() + (raw.root.branch_length or 0.)
+    assert abs(height - max(raw.depths().values())) <= 1e-12 * height
+    assert [tip.name for tip in ladderized_terminals(raw)] == [tip.name for tip in old.get_terminals()]
+    k_old = pk.kernel(old, old)
+    k_new = pk.kernel(new, new)
+    assert abs(k_old - k_new) <= 1e-9 * k_old, (k_old, k_new)
+    print label, 'agrees with legacy preparation, kernel', k_new
+
+
+for path in ['../projects/hivepi/data/SIRTree.n100.nwk',
+             '../projects/hivepi/data/SIRTree.n100.RLRootToTip.timetree.nwk']:
+    check_agreement(path, open(path, 'rU').read().strip())
+
+# caterpillar with unequal branch lengths, shallow enough for the legacy path
+newick = '(' * 199 + 't0:0.5'
+for i in range(1, 200):
+    newick += ',t%d:%g):%g' % (i, 1. + i % 7, 0.1 * (i % 5 + 1))
+check_agreement('caterpillar', newick + ';')
+
+
+for path in ['../projects/hivepi/data/SIRTree.n1000.nwk',
+             '../projects/hivepi/data/SIRTree.n1000.RLRootToTip.timetree.nwk']:
+    for label, func in [('old', old_prepare), ('new', new_prepare)]:
+        trees = [Phylo.read(path, 'newick') for _ in range(nreps)]
+        t0 = time.time()
+        for tree in trees:
+            func(tree)
+        elapsed = time.time() - t0
+        print label, path, elapsed / nreps, 'seconds per tree'
+
+
+# caterpillar tree deep enough to exceed the default recursion limit
+ntips = 2*sys.getrecursionlimit()
+newick = '(' * (ntips-1) + 't0:1'
+for i in range(1, ntips):
+    newick += ',t%d:1):1' % i
+tree = Phylo.read(StringIO(newick + ';'), 'newick')
+
+try:
+    old_prepare(tree)
+    print 'old caterpillar', ntips, 'tips OK'
+except RuntimeError as e:
+    print 'old caterpillar', ntips, 'tips FAILED:', e
+
+new_prepare(tree)
+print 'new caterpillar', ntips, 'tips OK'
+compact = CompactTree.from_phylo(tree, ladderize=True)
+assert compact.tip_depths().max() == ntips - 1
+assert [tip.name for tip in ladderized_terminals(tree)] == ['t%d' % i for i in range(ntips - 1, 1, -1) + [0, 1]]
+print 'caterpillar height and ladderized tips OK'